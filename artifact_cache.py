@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+'''
+Local cache of the rendered report artifacts (chart images & workbooks), keyed by a fingerprint of the input records
+each artifact is built from, so unchanged tracks are copied from the cache instead of re-rendered.
+
+The cache is enabled by setting a directory (artifact_cache_dir in the context or REPORT_ARTIFACT_CACHE_DIR in the
+environment). It is bounded to artifact_cache_mb / REPORT_ARTIFACT_CACHE_MB, evicting the least recently used entries
+'''
+from __future__ import print_function
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+DEFAULT_MAX_MB = 2048
+MANIFEST = 'manifest.json'
+MB = 1024.0 * 1024.0
+
+_lock = threading.Lock()
+_cache = {'dir': None, 'max_bytes': DEFAULT_MAX_MB * MB, 'hits': 0, 'misses': 0}
+
+def configure(ctx=None):
+    '''enables the cache from the context, falling back to the environment'''
+    ctx = ctx or {}
+    cache_dir = ctx.get('artifact_cache_dir', os.environ.get('REPORT_ARTIFACT_CACHE_DIR', None))
+    max_mb = ctx.get('artifact_cache_mb', os.environ.get('REPORT_ARTIFACT_CACHE_MB', None))
+    _cache['dir'] = cache_dir or None
+    _cache['max_bytes'] = float(max_mb) * MB if max_mb not in (None, '') else DEFAULT_MAX_MB * MB
+    if _cache['dir']:
+        if not os.path.exists(_cache['dir']):
+            os.makedirs(_cache['dir'])
+        print('artifact cache: {}, max {:.0f} MB'.format(_cache['dir'], _cache['max_bytes'] / MB))
+
+def enabled():
+    '''returns True if a cache dir is configured'''
+    return _cache['dir'] is not None
+
+def fingerprint(kind, *inputs):
+    '''returns the fingerprint of the artifact kind & its inputs. list inputs are hashed record by record'''
+    hasher = hashlib.sha256(kind.encode('utf-8'))
+    for part in inputs:
+        records = part if isinstance(part, (list, tuple)) else [part]
+        hasher.update('|{}|'.format(len(records)).encode('utf-8'))
+        for record in records:
+            hasher.update(json.dumps(record, sort_keys=True, default=str).encode('utf-8'))
+    return hasher.hexdigest()
+
+def restore(key, work_dir='.', filename=None):
+    '''copies the cached artifact files into the work dir, naming a single file artifact filename if given. Returns
+    the restored paths, or None if the artifact is not cached'''
+    if not enabled():
+        return None
+    entry = os.path.join(_cache['dir'], key)
+    with _lock:
+        try:
+            with open(os.path.join(entry, MANIFEST), 'r') as fin:
+                names = json.load(fin)
+            paths = []
+            for name in names:
+                path = filename if filename is not None and len(names) == 1 else os.path.join(work_dir, name)
+                shutil.copyfile(os.path.join(entry, name), path)
+                paths.append(path)
+            os.utime(entry, None) # marks the entry as recently used
+        except (IOError, OSError, ValueError):
+            _cache['misses'] += 1
+            return None
+        _cache['hits'] += 1
+    print('restored from artifact cache: {}'.format(', '.join(paths)))
+    return paths
+
+def store(key, paths):
+    '''copies the artifact files into the cache under the key, then evicts down to the size bound'''
+    if not enabled():
+        return
+    entry = os.path.join(_cache['dir'], key)
+    with _lock:
+        if os.path.exists(entry):
+            return
+        tmp_entry = tempfile.mkdtemp(dir=_cache['dir'], prefix='.tmp-')
+        try:
+            for path in paths:
+                shutil.copyfile(path, os.path.join(tmp_entry, os.path.basename(path)))
+            with open(os.path.join(tmp_entry, MANIFEST), 'w') as outf:
+                json.dump([os.path.basename(path) for path in paths], outf)
+            os.rename(tmp_entry, entry) # entries only appear once complete
+        except (IOError, OSError) as err:
+            print('failed to cache {}: {}'.format(', '.join(paths), err))
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        evict()
+
+def evict():
+    '''removes the least recently used entries until the cache is within its size bound'''
+    entries = []
+    total = 0
+    for key in os.listdir(_cache['dir']):
+        entry = os.path.join(_cache['dir'], key)
+        if key.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+        total += size
+    for mtime, size, entry in sorted(entries):
+        if total <= _cache['max_bytes']:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def get_stats():
+    '''returns the cache hits & misses'''
+    with _lock:
+        return {'hits': _cache['hits'], 'misses': _cache['misses']}
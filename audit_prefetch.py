@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+'''
+Fetches the acquisition-list audit trail of whole AOIs (one or many, by a terms filter) in a single query streamed
+through a scroll cursor and partitions it by AOI & track in memory, instead of querying the audit trail once per AOI &
+track. Batches of AOIs are bounded by their number of audit trail products
+'''
+from __future__ import print_function
+import grq
+import profiling
+
+AUDIT_TRAIL_IDX = 'grq_*_s1-gunw-acqlist-audit_trail'
+AOI_BATCH = 100 # max aois per query
+BATCH_HITS = 50000 # max audit trail products per query & held in memory at once, unless a single aoi has more
+PAGE_SIZE = 1000
+
+_trails = {} # audit trail objects by track, by aoi id
+
+def fetch(aoi_ids):
+    '''fetches the audit trail of all the aois, replacing the previously fetched aois'''
+    _trails.clear()
+    for aoi_id in aoi_ids:
+        _trails[aoi_id] = {}
+    es_query = {"query":{"terms":{"metadata.aoi.raw":sorted(aoi_ids)}},"size":PAGE_SIZE}
+    count = 0
+    with profiling.phase('grq_query'):
+        for hits in grq.scroll_pages(grq.get_search_url(AUDIT_TRAIL_IDX), es_query):
+            for obj in hits:
+                met = obj.get('_source', {}).get('metadata', {})
+                _trails.setdefault(met.get('aoi'), {}).setdefault(str(met.get('track_number')), []).append(obj)
+            count += len(hits)
+    print('fetched {} audit trail products for {} aois'.format(count, len(aoi_ids)))
+
+def get(aoi_id, track):
+    '''returns the fetched audit trail of the aoi & track, None if the aoi has not been fetched'''
+    if aoi_id not in _trails:
+        return None
+    return _trails[aoi_id].get(str(track), [])
+
+def get_counts(aoi_ids):
+    '''returns the number of audit trail products of each aoi, from a terms aggregation'''
+    es_query = {"query":{"terms":{"metadata.aoi.raw":sorted(aoi_ids)}},
+                "aggs":{"aois":{"terms":{"field":"metadata.aoi.raw","size":len(aoi_ids)}}}}
+    aggs = grq.query_es_aggs(grq.get_search_url(AUDIT_TRAIL_IDX), es_query)
+    return dict((bucket['key'], bucket['doc_count']) for bucket in aggs.get('aois', {}).get('buckets', []))
+
+def batches(aoi_ids):
+    '''yields the aoi ids in batches of at most AOI_BATCH aois & BATCH_HITS audit trail products, fetching the audit
+    trail of each batch'''
+    counts = get_counts(aoi_ids) if aoi_ids else {}
+    batch = []
+    batch_hits = 0
+    for aoi_id in aoi_ids:
+        hits = counts.get(aoi_id, 0)
+        if batch and (len(batch) >= AOI_BATCH or batch_hits + hits > BATCH_HITS):
+            fetch(batch)
+            for batch_id in batch:
+                yield batch_id
+            batch = []
+            batch_hits = 0
+        batch.append(aoi_id)
+        batch_hits += hits
+    if batch:
+        fetch(batch)
+        for batch_id in batch:
+            yield batch_id
+    _trails.clear()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the hot paths of the report generators over synthetic GRQ fixtures, reporting the time & peak
+memory of each
+'''
+from __future__ import print_function
+import gc
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+from openpyxl import Workbook
+import synthetic_grq
+import profiling
+import enumeration as enum_compare
+import gen_ops_report
+import gen_enumeration_report
+
+def gen_test_enumeration(count, offset=0):
+    '''generates count unique date pairs on a 6 day repeat cycle, each date paired with its next 3 neighbours'''
+    start = datetime.date(2014, 10, 1) + datetime.timedelta(days=6 * offset)
+    date_pairs = []
+    i = 0
+    while len(date_pairs) < count:
+        secondary = start + datetime.timedelta(days=6 * (i // 3))
+        reference = secondary + datetime.timedelta(days=6 * (i % 3 + 1))
+        date_pairs.append('{}-{}'.format(reference.strftime('%Y%m%d'), secondary.strftime('%Y%m%d')))
+        i += 1
+    return date_pairs
+
+def load_fixtures(scale):
+    '''generates the synthetic fixtures for the scale as lists, keyed by object type'''
+    fixtures = synthetic_grq.gen_fixtures(scale)
+    return dict((object_type, list(hits)) for object_type, hits in fixtures.items())
+
+def get_benchmarks(fixtures):
+    '''returns the list of (name, function) benchmarks over the fixtures. inputs of each function are
+    staged beforehand so only the function itself is measured'''
+    ops = gen_ops_report
+    acq_lists = fixtures['acq-list']
+    audit_trail = fixtures['audit_trail']
+    allowed_hashes = set(ops.store_by_hash(audit_trail).keys())
+    acq_dct = ops.store_by_id(fixtures['acq'])
+    acq_map_dct = ops.store_by_slc_id(fixtures['acq'])
+    slc_dct = ops.store_by_id(fixtures['slc'])
+    acq_list_dct = ops.store_by_hash(acq_lists)
+    ifg_cfg_dct = ops.store_by_hash(fixtures['ifg-cfg'])
+    ifg_dct = ops.store_by_hash(fixtures['ifg'])
+    aoi_track_dct = ops.store_by_gunw(fixtures['aoi_track'])
+    slc_idx = ops.slc_index.build_slc_index(acq_list_dct, slc_dct)
+    enumeration = sorted(set(gen_enumeration_report.gen_date_pair(obj) for obj in acq_lists))
+    input_pairs = gen_test_enumeration(len(acq_lists))
+    hysds_pairs = gen_test_enumeration(len(acq_lists), offset=len(acq_lists) // 6)
+    aoi = fixtures['aoi'][0]
+    track = synthetic_grq.DEFAULTS['track']
+    return [
+        ('gen_hash', lambda: [ops.gen_hash(obj) for obj in acq_lists]),
+        ('gen_date_pair', lambda: [ops.gen_date_pair(obj) for obj in acq_lists]),
+        ('store_by_hash', lambda: ops.store_by_hash(acq_lists)),
+        ('filter_hashes', lambda: ops.filter_hashes(fixtures['ifg'], allowed_hashes)),
+        ('sort_into_hash_list', lambda: ops.sort_into_hash_list(acq_list_dct)),
+        ('build_slc_index', lambda: ops.slc_index.build_slc_index(acq_list_dct, slc_dct)),
+        ('merge_date_pairs', lambda: list(enum_compare.merge_date_pairs([input_pairs, hysds_pairs]))),
+        ('write_current_status', lambda: ops.write_current_status(Workbook(), acq_list_dct, ifg_cfg_dct, ifg_dct,
+                                                                  slc_idx, acq_map_dct, aoi_track_dct)),
+        ('write_slcs', lambda: ops.write_slcs(Workbook(), slc_dct)),
+        ('write_missing_slcs', lambda: ops.write_missing_slcs(Workbook(), slc_idx)),
+        ('write_acqs', lambda: ops.write_acqs(Workbook(), acq_dct)),
+        ('write_acq_lists', lambda: ops.write_acq_lists(Workbook(), acq_list_dct)),
+        ('write_ifg_cfgs', lambda: ops.write_ifg_cfgs(Workbook(), ifg_cfg_dct)),
+        ('write_ifgs', lambda: ops.write_ifgs(Workbook(), ifg_dct)),
+        ('write_current_products', lambda: gen_enumeration_report.write_current_products(Workbook(), acq_list_dct,
+                                                                                         ifg_cfg_dct, ifg_dct)),
+        ('write_enumeration_comparison', lambda: gen_enumeration_report.write_enumeration_comparison(
+            Workbook(), acq_lists, enumeration, audit_trail)),
+        ('ops report generate', lambda: in_tempdir(ops.generate, 'AOI_Ops_Report-benchmark', aoi, track,
+                                                   fixtures['acq'], fixtures['slc'], acq_lists, fixtures['ifg-cfg'],
+                                                   fixtures['ifg'], audit_trail, fixtures['aoi_track'])),
+        ('enumeration report generate', lambda: in_tempdir(gen_enumeration_report.generate,
+                                                           'AOI_Enumeration_Report-benchmark', aoi, track, acq_lists,
+                                                           fixtures['ifg-cfg'], fixtures['ifg'], audit_trail,
+                                                           enumeration))
+    ]
+
+def in_tempdir(func, *args):
+    '''runs the function from a temporary work dir, which is removed afterwards'''
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='report_benchmark_')
+    try:
+        os.chdir(work_dir)
+        return func(*args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+def measure(func, repeat=1, trace_memory=True):
+    '''returns the best wall time in seconds of the function over the repeats, and its peak traced memory in
+    bytes (None if not traced). memory is traced in a separate run so it doesn't skew the timing'''
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    peak = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+def run(scales, names=None, repeat=1, trace_memory=True):
+    '''runs the benchmarks at each scale, printing as it goes. returns the list of result dicts'''
+    results = []
+    print('{:>9} {:<30} {:>10} {:>12}'.format('scale', 'benchmark', 'seconds', 'peak MB'))
+    for scale in scales:
+        fixtures = load_fixtures(scale)
+        for name, func in get_benchmarks(fixtures):
+            if names and name not in names:
+                continue
+            profiling.reset()
+            seconds, peak = measure(func, repeat=repeat, trace_memory=trace_memory)
+            peak_mb = None if peak is None else peak / 1024.0 / 1024.0
+            print('{:>9} {:<30} {:>10.3f} {:>12}'.format(scale, name, seconds,
+                                                          '-' if peak_mb is None else '{:.1f}'.format(peak_mb)))
+            results.append({'scale': scale, 'benchmark': name, 'seconds': seconds, 'peak_mb': peak_mb})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks the report generator hot paths on synthetic fixtures')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of acquisition-lists to generate fixtures for (1k - 1M)')
+    parser.add_argument('--benchmarks', nargs='+', help='only run these benchmarks')
+    parser.add_argument('--repeat', type=int, default=1, help='timing repeats, the best is reported')
+    parser.add_argument('--no_memory', action='store_true', help='skip tracing peak memory')
+    parser.add_argument('--json', help='also write the results to this json file, for tracking regressions')
+    args = parser.parse_args()
+    bench_results = run(args.scales, names=args.benchmarks, repeat=args.repeat, trace_memory=not args.no_memory)
+    if args.json:
+        with open(args.json, 'w') as outf:
+            json.dump(bench_results, outf, indent=2)
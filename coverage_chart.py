@@ -6,15 +6,21 @@ Generates a lat band chart from given information
 from builtins import range
 from builtins import object
 from dateutil import parser
+import math
 import datetime as dt
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as font_manager
 import matplotlib.dates
+from matplotlib.collections import PolyCollection
 from matplotlib.dates import DAILY,WEEKLY,MONTHLY, DateFormatter, rrulewrapper, RRuleLocator 
 import numpy as np
 import random
+import gantt
+
+MAX_HEIGHT = 40 # inches
+MAX_OBJECTS = 5000 # objects per image, more are paginated by time
 
 class coverage_chart(object):
     def __init__(self):
@@ -23,31 +29,51 @@ class coverage_chart(object):
     def add(self, starttime, endtime, minlat, maxlat, uid, color='orange'):
         self.objects.append([starttime, endtime, minlat, maxlat, uid, color])
 
-    def build(self, filename, title):
-        '''builds the chart from self.objects'''
+    def build(self, filename, title, max_objects=MAX_OBJECTS):
+        '''builds the chart from self.objects. the figure height is capped at MAX_HEIGHT, and with more than
+        max_objects objects they are paginated by starttime into multiple images sharing the latitude axis.
+        Returns the list of image filenames written'''
         #determine the min and max latitude across all objects
         overall_minlat = min([x[2] for x in self.objects])
         overall_maxlat = max([x[3] for x in self.objects])
         print('overall minmax: {} {}'.format(overall_minlat, overall_maxlat))
+        if len(self.objects) <= max_objects:
+            self.build_page(filename, title, self.objects, overall_minlat, overall_maxlat)
+            return [filename]
+        objects = sorted(self.objects, key=lambda x: x[0])
+        pages = int(math.ceil(len(objects) / float(max_objects)))
+        filenames = []
+        for page in range(pages):
+            page_filename = gantt.get_page_filename(filename, page + 1)
+            page_title = '{} ({}/{})'.format(title, page + 1, pages)
+            page_objects = objects[page * max_objects:(page + 1) * max_objects]
+            self.build_page(page_filename, page_title, page_objects, overall_minlat, overall_maxlat)
+            filenames.append(page_filename)
+        return filenames
+
+    def build_page(self, filename, title, objects, overall_minlat, overall_maxlat):
+        '''builds a single image of the objects over the latitude range'''
         lat_height = overall_maxlat - overall_minlat
         height_multiplier = 2.0
-        num = len(self.objects)
         #pos = np.arange(0.5, lat_height, 0.5)
-        fig_height = height_multiplier * lat_height
+        fig_height = min(height_multiplier * lat_height, MAX_HEIGHT)
         fig = plt.figure(figsize=(20, fig_height))
         ax = fig.add_subplot(111)
         #ylabels = [float('%.4g' % x) for x in np.arange(overall_minlat, overall_maxlat, 0.5)]
         #ylabels = ylabels.extend(float('%.4g' % overall_maxlat))
-        ylabels = np.linspace(overall_minlat, overall_maxlat, num=int(lat_height * height_multiplier), endpoint=True)
+        ylabels = np.linspace(overall_minlat, overall_maxlat, num=int(fig_height), endpoint=True)
         ylabels = [float('%.4g' % x) for x in ylabels]
         pos = [float(x) - overall_minlat for x in ylabels]
-        for obj in self.objects:
-            starttime, endtime, minlat, maxlat, uid, color = obj
-            start = matplotlib.dates.date2num(starttime)
-            end = matplotlib.dates.date2num(endtime)
-            element_height =  (maxlat - minlat)
-            yposition = (minlat - overall_minlat)
-            ax.barh(yposition, end - start, left=start, height=element_height, align='edge', edgecolor='darkorange', color=color, alpha = 0.5)
+        #draw all bars as a single collection
+        starts = matplotlib.dates.date2num([obj[0] for obj in objects])
+        ends = matplotlib.dates.date2num([obj[1] for obj in objects])
+        bottoms = np.array([obj[2] for obj in objects], dtype=float) - overall_minlat
+        tops = np.array([obj[3] for obj in objects], dtype=float) - overall_minlat
+        bars = PolyCollection(gantt.bar_vertices(starts, ends, bottoms, tops),
+                              facecolors=[obj[5] for obj in objects], edgecolors='darkorange', alpha=0.5)
+        bars.sticky_edges.x.append(starts.min()) # no margin before the first bar, as barh autoscales
+        ax.add_collection(bars)
+        ax.autoscale_view()
         locsy, labelsy = plt.yticks(pos, ylabels)
         plt.setp(labelsy, fontsize = 14)
         #plt.gca().invert_yaxis()
@@ -55,7 +81,7 @@ class coverage_chart(object):
         ax.grid(color = 'g', linestyle = ':')
         ax.xaxis_date()
         #rule = rrulewrapper(WEEKLY, interval=1)
-        rule = rrulewrapper(MONTHLY, interval=1)
+        rule = rrulewrapper(MONTHLY, interval=gantt.get_tick_interval(starts.min(), ends.max(), 30.4))
         loc = RRuleLocator(rule)
         formatter = DateFormatter("%Y-%m-%d")
         ax.xaxis.set_major_locator(loc)
@@ -68,6 +94,7 @@ class coverage_chart(object):
         fig.autofmt_xdate()
         plt.title(title)
         plt.savefig(filename)
+        plt.close(fig)
 
 if __name__ == '__main__':
     filename = 'test.png'
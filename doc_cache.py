@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+In-process cache of the product documents fetched by the email job, so AOIs overlapping on the same tracks reuse the
+already decoded documents. Each product query is first run for the matching ids only, which is cheap, then only the
+documents not yet cached are fetched by id. The reuse across AOIs comes from the document cache, the id queries are
+run for every AOI as their geometry differs.
+
+The document cache is bounded to an approximate size in MB (the json size of the documents), evicting the least
+recently used
+'''
+from __future__ import print_function
+import json
+from collections import OrderedDict
+import grq
+
+IDS_BATCH = 1000 # ids per fetch query
+MB = 1024 * 1024
+
+_docs = OrderedDict() # (document, approximate bytes) by (index, id), least recently used first
+_cache = {'max_bytes': 0, 'bytes': 0, 'hits': 0, 'misses': 0}
+
+def configure(max_mb):
+    '''sets the approximate size of the cached documents in MB, 0 or None disables the cache'''
+    _cache.update({'max_bytes': int(float(max_mb or 0) * MB), 'bytes': 0})
+    _docs.clear()
+    if _cache['max_bytes'] > 0:
+        print('document cache: max {} MB'.format(max_mb))
+
+def enabled():
+    '''returns True if the cache is configured'''
+    return _cache['max_bytes'] > 0
+
+def fetch(grq_url, es_query, run_query):
+    '''returns the objects of the query. the ids of the query are listed with run_query (a function of the query) &
+    only the objects missing from the cache are fetched'''
+    id_query = json.loads(json.dumps(es_query))
+    # only the sort fields, which windowed queries are merged on
+    id_query['_source'] = [field for field, descending in grq.get_sort_fields(es_query)] or False
+    ids = [(hit['_index'], hit['_id']) for hit in run_query(id_query)]
+    fetched = fetch_ids(grq_url, [doc_id for doc_id in ids if doc_id not in _docs])
+    results = []
+    for doc_id in ids:
+        if doc_id in fetched:
+            results.append(fetched[doc_id])
+        elif doc_id in _docs:
+            _docs.move_to_end(doc_id)
+            results.append(_docs[doc_id][0])
+            _cache['hits'] += 1
+    _cache['misses'] += len(fetched)
+    for doc_id, obj in fetched.items():
+        size = len(json.dumps(obj)) # once per fetched document
+        _docs[doc_id] = (obj, size)
+        _cache['bytes'] += size
+    while _cache['bytes'] > _cache['max_bytes'] and _docs:
+        _cache['bytes'] -= _docs.popitem(last=False)[1][1]
+    return results
+
+def fetch_ids(grq_url, doc_ids):
+    '''fetches the objects by (index, id), returns them by (index, id)'''
+    fetched = {}
+    for i in range(0, len(doc_ids), IDS_BATCH):
+        batch = doc_ids[i:i + IDS_BATCH]
+        es_query = {"query":{"ids":{"values":sorted(set(_id for index, _id in batch))}},"from":0,"size":IDS_BATCH}
+        for obj in grq.query_es(grq_url, es_query):
+            fetched[(obj.get('_index'), obj.get('_id'))] = obj
+    return dict((doc_id, fetched[doc_id]) for doc_id in doc_ids if doc_id in fetched)
+
+def get_stats():
+    '''returns the cache hits & misses, in documents, & the cached documents & MB'''
+    return {'hits': _cache['hits'], 'misses': _cache['misses'], 'cached': len(_docs),
+            'cached_mb': round(_cache['bytes'] / float(MB), 1)}
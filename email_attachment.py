@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+'''
+Streams the rows of the ops report email tables into a gzipped csv or a write only xlsx workbook, attached to the
+email in place of the full html when it exceeds the size limit. Rows are buffered in memory until the html is known to
+exceed the limit, so reports that fit create no file. From then on rows are streamed to the file as the tables are
+generated, keeping only the per AOI row counts of each table in memory
+'''
+from __future__ import print_function
+import re
+import os
+import csv
+import gzip
+
+FORMATS = ['csv', 'xlsx']
+COLUMNS = ['aoi', 'track', 'table', 'date_pair', 'missing_acq_ids', 'acquisition_list', 'missing_slc_ids', 'ifg_cfg',
+           'gunw', 'previously']
+# maps the html table headers to the attachment columns
+HEADER_COLUMNS = {
+    'Missing SLCs': 'missing_slc_ids',
+    'New Missing SLCs': 'missing_slc_ids',
+    'Resolved Missing SLCs': 'missing_slc_ids',
+    'Date Pair': 'date_pair',
+    'New: Date Pair': 'date_pair',
+    'Resolved: Date Pair': 'date_pair',
+    'Missing ACQ IDs': 'missing_acq_ids',
+    'Acquisition-List': 'acquisition_list',
+    'Missing SLC IDs': 'missing_slc_ids',
+    'IFG-CFG': 'ifg_cfg',
+    'GUNW': 'gunw',
+    'Previously': 'previously'
+}
+TAG_REG = re.compile('<[^>]+>')
+
+class detail_writer(object):
+    '''writes the table rows of every AOI & track to the attachment file, buffering them until the file is opened'''
+    def __init__(self, filename, file_format='csv'):
+        if file_format not in FORMATS:
+            raise Exception('invalid attachment format: {}, expected one of {}'.format(file_format, FORMATS))
+        self.file_format = file_format
+        self.filename = filename + ('.csv.gz' if file_format == 'csv' else '.xlsx')
+        self.counts = {} # rows by table, by aoi id
+        self.rows = 0
+        self.state = 'buffered' # then open & closed
+        self.buffer = []
+        self.append = self.buffer.append
+
+    def open(self):
+        '''creates the attachment file & writes the buffered rows, later rows are streamed to it'''
+        if self.state != 'buffered':
+            return
+        if self.file_format == 'csv':
+            self.fout = gzip.open(self.filename, 'wt')
+            self.append = csv.writer(self.fout).writerow
+            self.append(COLUMNS)
+        else:
+            import excel # openpyxl is only loaded for xlsx attachments
+            self.excel = excel
+            self.wb = excel.new_workbook(low_memory=True)
+            self.append = excel.sheet_writer(self.wb, 'Ops Report', COLUMNS, first=True).append
+        for row in self.buffer:
+            self.append(row)
+        self.buffer = None
+        self.state = 'open'
+
+    def write(self, aoi_id, track, header, data):
+        '''writes the rows of the table, mapping its header onto the attachment columns'''
+        if not data:
+            return
+        table = header[0]
+        indices = [COLUMNS.index(HEADER_COLUMNS.get(column, 'previously')) for column in header]
+        for row in data:
+            row = [row] if type(row) != list else row
+            out_row = [aoi_id, track, table] + [''] * (len(COLUMNS) - 3)
+            for index, cell in zip(indices, row):
+                out_row[index] = TAG_REG.sub('', str(cell))
+            self.append(out_row)
+        aoi_counts = self.counts.setdefault(aoi_id, {})
+        aoi_counts[table] = aoi_counts.get(table, 0) + len(data)
+        self.rows += len(data)
+
+    def close(self):
+        '''finishes writing the file if it was opened, drops the buffered rows otherwise'''
+        if self.state == 'open':
+            if self.file_format == 'csv':
+                self.fout.close()
+            else:
+                self.excel.add_sheet_index(self.wb)
+                self.wb.save(self.filename)
+        self.buffer = None
+        self.state = 'closed'
+
+    def discard(self):
+        '''closes & removes the file, if any'''
+        opened = self.state == 'open'
+        if opened and self.file_format == 'csv':
+            self.fout.close()
+        # an unsaved xlsx workbook never reaches the file, openpyxl removes its worksheet temp files on exit
+        self.buffer = None
+        self.state = 'closed'
+        if opened and os.path.exists(self.filename):
+            os.remove(self.filename)
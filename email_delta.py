@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''
+Delta state of the ops report email. The outstanding rows of each AOI & track are stored between runs as row hashes
+& status codes in a gzipped json file, so the email only lists the rows that newly appeared or were resolved.
+
+Product rows are keyed by their acquisition-list hash & missing SLC rows by a short hash of the SLC id. A product row
+status is made of the STATUS_FLAGS of what it is missing, a missing SLC row status is always M
+'''
+from __future__ import print_function
+import os
+import gzip
+import json
+import hashlib
+import datetime
+
+STATE_VERSION = 1
+STATUS_FLAGS = [('A', 'acquisitions'), ('S', 'SLCs'), ('C', 'IFG-CFG'), ('G', 'GUNW'), ('R', 'greylisted'),
+                ('B', 'blacklisted')]
+SLC_STATUS = 'M'
+
+def load_state(path):
+    '''returns the track states of the previous run by track key, empty if there is no state file yet'''
+    if not os.path.exists(path):
+        print('no previous email state at {}, reporting all rows as new'.format(path))
+        return {}
+    with gzip.open(path, 'rt') as fin:
+        state = json.load(fin)
+    if state.get('version') != STATE_VERSION:
+        print('ignoring email state of version {} at {}'.format(state.get('version'), path))
+        return {}
+    return state.get('tracks', {})
+
+def save_state(path, tracks):
+    '''writes the track states by track key, replacing the state file once fully written'''
+    state = {'version': STATE_VERSION, 'created': datetime.datetime.now().isoformat(), 'tracks': tracks}
+    tmp_path = '{}.tmp'.format(path)
+    with gzip.open(tmp_path, 'wt') as outf:
+        json.dump(state, outf, separators=(',', ':'))
+    os.rename(tmp_path, path)
+
+def new_delta(previous):
+    '''returns the delta of a run: the previous track states & the current ones, filled in as tracks are reported'''
+    return {'previous': previous, 'current': {}}
+
+def track_key(aoi_id, track):
+    '''returns the key of the aoi & track in the state'''
+    return '{}/{}'.format(aoi_id, track)
+
+def slc_hash(slc_id):
+    '''returns the short hash of the slc id'''
+    return hashlib.md5(slc_id.encode('utf-8')).hexdigest()[:16]
+
+def gen_status(missing_acqs, missing_slcs, missing_ifg_cfg, missing_ifg, greylisted, blacklisted):
+    '''returns the status code of a product row'''
+    flags = (missing_acqs, missing_slcs, missing_ifg_cfg, missing_ifg, greylisted, blacklisted)
+    return ''.join(flag for (flag, name), is_set in zip(STATUS_FLAGS, flags) if is_set)
+
+def describe_status(status):
+    '''returns the readable form of a product row status'''
+    names = dict(STATUS_FLAGS)
+    missing = [names[flag] for flag in status if flag in 'ASCG']
+    listed = [names[flag] for flag in status if flag in 'RB']
+    return ', '.join((['missing ' + ', '.join(missing)] if missing else []) + listed)
+
+def diff(previous, current):
+    '''compares the previous & current {row hash: status} dicts. Returns the set of new rows (including rows whose
+    status changed), the list of resolved row hashes & the count of unchanged rows'''
+    new = set(row_hash for row_hash, status in current.items() if previous.get(row_hash) != status)
+    resolved = [row_hash for row_hash in previous if row_hash not in current]
+    return new, resolved, len(current) - len(new)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+Compares date pair enumerations for the Standard Product Enumeration Report
+'''
+from __future__ import print_function
+import re
+import bz2
+import gzip
+import heapq
+import datetime
+import itertools
+from operator import itemgetter
+
+DATE_REG = re.compile('^([0-9]{2}|[0-9]{4})([0-9]{2})([0-9]{2})$')
+PAIR_SEP_REG = re.compile('\\s*[-_]\\s*')
+TOKEN_SEP_REG = re.compile('[,;\\s]+')
+MAX_REPORTED = 25
+
+def merge_date_pairs(enumerations, reverse=False):
+    '''merge joins the input date pair enumerations. Yields (date_pair, membership) for every unique date pair
+    in order, where membership is a tuple of booleans of whether each enumeration contains the date pair'''
+    sources = [tag_date_pairs(sorted(set(enumeration), reverse=reverse), idx)
+               for idx, enumeration in enumerate(enumerations)]
+    merged = heapq.merge(*sources, key=itemgetter(0), reverse=reverse)
+    for date_pair, group in itertools.groupby(merged, key=itemgetter(0)):
+        membership = [False] * len(enumerations)
+        for _, idx in group:
+            membership[idx] = True
+        yield date_pair, tuple(membership)
+
+def tag_date_pairs(date_pairs, idx):
+    '''yields (date_pair, idx) for each date pair'''
+    for date_pair in date_pairs:
+        yield date_pair, idx
+
+def load_enumeration(date_pair_string=False, date_pair_file=False):
+    '''parses the enumeration from the date pair string and/or date pair file (plain text or csv, optionally
+    gzip or bz2 compressed). Returns the unique date pairs as YYYYMMdd-YYYYMMdd, sorted by endtime'''
+    date_pairs = set()
+    if date_pair_string:
+        date_pairs.update(parse_enumeration([date_pair_string]))
+    if date_pair_file:
+        with open_enumeration_file(date_pair_file) as fin:
+            date_pairs.update(parse_enumeration(fin))
+    return sorted(date_pairs)
+
+def open_enumeration_file(path):
+    '''opens the enumeration file for reading as text, decompressing by extension'''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt')
+    return open(path, 'r')
+
+def parse_enumeration(lines):
+    '''streams the date pairs from the lines. Pairs are separated by commas, semicolons or whitespace, and each
+    pair is two YYMMdd or YYYYMMdd dates joined by - or _ (or two csv columns). Malformed entries are skipped &
+    reported together. Returns the unique date pairs sorted by endtime'''
+    date_pairs = set()
+    malformed = []
+    for line_number, line in enumerate(lines, 1):
+        line = PAIR_SEP_REG.sub('-', line.strip())
+        if not line or line.startswith('#'):
+            continue
+        if line_number == 1 and not re.search('[0-9]', line):
+            continue # csv header
+        tokens = [token for token in TOKEN_SEP_REG.split(line) if token]
+        if len(tokens) == 2 and DATE_REG.match(tokens[0]) and DATE_REG.match(tokens[1]):
+            tokens = ['-'.join(tokens)] # csv row of reference & secondary columns
+        for token in tokens:
+            try:
+                date_pairs.add(parse_date_pair(token))
+            except ValueError:
+                malformed.append((line_number, token))
+    report_malformed(malformed)
+    return sorted(date_pairs)
+
+def parse_date_pair(token):
+    '''parses a single date pair token into YYYYMMdd-YYYYMMdd with the later date first. raises ValueError if the
+    token is malformed'''
+    dates = token.split('-')
+    if len(dates) != 2:
+        raise ValueError('expected two dates: {}'.format(token))
+    first_date = parse_date(dates[0])
+    second_date = parse_date(dates[1])
+    if first_date < second_date:
+        first_date, second_date = second_date, first_date
+    return '{}-{}'.format(first_date.strftime('%Y%m%d'), second_date.strftime('%Y%m%d'))
+
+def parse_date(date_string):
+    '''fixed format parser for YYMMdd & YYYYMMdd dates. raises ValueError if the date is malformed'''
+    match = DATE_REG.match(date_string)
+    if match is None:
+        raise ValueError('invalid date: {}'.format(date_string))
+    year, month, day = [int(x) for x in match.groups()]
+    if len(match.group(1)) == 2:
+        year = expand_year(year)
+    return datetime.date(year, month, day)
+
+def expand_year(year):
+    '''expands a two digit year into the century within 50 years of the current year, the same as dateutil'''
+    current_year = datetime.date.today().year
+    year += current_year // 100 * 100
+    if year >= current_year + 50:
+        year -= 100
+    elif year < current_year - 50:
+        year += 100
+    return year
+
+def report_malformed(malformed):
+    '''prints all the malformed enumeration entries in one block'''
+    if not malformed:
+        return
+    print('Failed parsing {} date pairs. skipping:'.format(len(malformed)))
+    for line_number, token in malformed[:MAX_REPORTED]:
+        print('    line {}: {}'.format(line_number, token))
+    if len(malformed) > MAX_REPORTED:
+        print('    ... and {} more'.format(len(malformed) - MAX_REPORTED))
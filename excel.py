@@ -8,32 +8,111 @@ import re
 import json
 import pickle
 import hashlib
+import weakref
 from openpyxl import Workbook
 import dateutil.parser
+import enumeration as enum_compare
+import slc_index
+import profiling
+import artifact_cache
+
+MAX_SHEET_ROWS = 1048576 # rows of an excel sheet, including the header row
+INDEX_SHEET = 'Sheet Index'
+
+_sheet_parts = weakref.WeakKeyDictionary() # parts of each sheet by title, by workbook
+
+def new_workbook(low_memory=False):
+    '''returns a new workbook. low memory workbooks are write only, streaming rows to disk on save'''
+    if low_memory:
+        return Workbook(write_only=True)
+    return Workbook()
+
+def first_sheet(wb, title):
+    '''returns the first sheet of the workbook with the given title. write only workbooks start without sheets'''
+    if wb.write_only:
+        return wb.create_sheet(title)
+    ws = wb.active
+    ws.title = title
+    return ws
+
+class sheet_writer(object):
+    '''appends rows to a sheet, continuing on new sheets (repeating the header row) once the sheet reaches max_rows.
+    The parts of continued sheets are listed by add_sheet_index'''
+    def __init__(self, wb, title, header, first=False, max_rows=MAX_SHEET_ROWS):
+        self.wb = wb
+        self.title = title
+        self.header = header
+        self.max_rows = max_rows
+        self.parts = _sheet_parts.setdefault(wb, {}).setdefault(title, []) # [title, first row, rows] of each part
+        self.rows = 0
+        self.new_part(first)
+
+    def new_part(self, first=False):
+        '''starts the next sheet'''
+        part_title = self.title
+        if self.parts: # sheet titles are limited to 31 characters
+            part_title = '{} ({})'.format(self.title[:25].rstrip(), len(self.parts) + 1)
+        self.ws = first_sheet(self.wb, part_title) if first else self.wb.create_sheet(part_title)
+        self.ws.append(self.header)
+        self.parts.append([part_title, self.rows + 1, 0])
+
+    def append(self, row):
+        '''appends the row, to a new sheet if the current one is full'''
+        if self.parts[-1][2] + 1 >= self.max_rows:
+            self.new_part()
+        self.ws.append(row)
+        self.parts[-1][2] += 1
+        self.rows += 1
+
+def add_sheet_index(wb):
+    '''adds a sheet listing the parts & row ranges of the sheets continued past the row limit, if any'''
+    continued = [(title, parts) for title, parts in _sheet_parts.get(wb, {}).items() if len(parts) > 1]
+    if not continued:
+        return
+    ws = wb.create_sheet(INDEX_SHEET)
+    ws.append(['sheet', 'part', 'part sheet', 'first row', 'last row'])
+    for title, parts in continued:
+        for part, (part_title, first_row, rows) in enumerate(parts):
+            ws.append([title, part + 1, part_title, first_row, first_row + rows - 1])
 
 def generate(aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration=False):
     '''ingests the various products and stages them by track for generating worksheets'''
     # unique tracks based on acquisition list
     print('generating workbook for track {}'.format(track))
+    if not artifact_cache.enabled():
+        generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration)
+        return
+    filename = get_filename(aoi, track)
+    with profiling.phase('fingerprint'):
+        key = artifact_cache.fingerprint('workbook', aoi.get('_id'), track, acqs, slcs, acq_lists, ifg_cfgs, ifgs,
+                                         audit_trail, enumeration)
+    if artifact_cache.restore(key, filename=filename):
+        return
     generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration)
+    artifact_cache.store(key, [filename])
+
+def get_filename(aoi, track):
+    '''returns the workbook filename of the track'''
+    return '{}_T{}.xlsx'.format(aoi.get('_id', 'AOI'), track)
 
+@profiling.timed('workbook')
 def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration):
     '''generates excel sheet for given track, inputs are lists'''
     # stage products
-    filename = '{}_T{}.xlsx'.format(aoi.get('_id', 'AOI'), track)
-    acq_dct = convert_to_dict(acqs) # converts to dict based on id
-    slc_dct = convert_to_dict(slcs) # converts to dict based on id
-    acq_map = resolve_slcs_from_acqs(acqs) # converts acquisition ids to slc ids
-    slc_map = resolve_acqs_from_slcs(acqs) # converts slc ids to acq_ids
-    acq_list_dct = convert_to_hash_dict(acq_lists, conversion_dict=acq_map) # converts dict where key is hash of master/slave slc ids
-    ifg_cfg_dct = convert_to_hash_dict(ifg_cfgs, conversion_dict=acq_map) # converts dict where key is hash of master/slave slc ids
-    ifg_dct = convert_to_hash_dict(ifgs, conversion_dict=False) # converts dict where key is hash of master/slave slc ids
+    filename = get_filename(aoi, track)
+    with profiling.phase('hash_index'):
+        acq_dct = convert_to_dict(acqs) # converts to dict based on id
+        slc_dct = convert_to_dict(slcs) # converts to dict based on id
+        acq_map = resolve_slcs_from_acqs(acqs) # converts acquisition ids to slc ids
+        slc_map = resolve_acqs_from_slcs(acqs) # converts slc ids to acq_ids
+        acq_list_dct = store_by_hash(acq_lists, conversion_dict=acq_map) # converts dict where key is hash of master/slave slc ids
+        ifg_cfg_dct = store_by_hash(ifg_cfgs, conversion_dict=acq_map) # converts dict where key is hash of master/slave slc ids
+        ifg_dct = store_by_hash(ifgs, conversion_dict=False) # converts dict where key is hash of master/slave slc ids
+        slc_idx = slc_index.build_slc_index(acq_list_dct, slc_dct, conversion_dict=acq_map) # missing slcs by hash
     
     # generate the acquisition sheet
-    wb = Workbook()
-    ws1 = wb.active
-    ws1.title = "Enumerated Products"
-    all_missing_slcs = [] # list of missing slcs by acquisition id
+    wb = new_workbook(profiling.low_memory())
+    ws1 = first_sheet(wb, "Enumerated Products")
     titlerow = ['acquisition-list id', 'slcs localized?', 'ifg-cfg generated?', 'ifg generated?', 'missing slc ids', 'missing acq ids']
     ws1.append(titlerow)
     # for each acquisition list, determine relevant metrics
@@ -42,13 +121,12 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
         acqlistid = obj.get('_source', {}).get('id', 'No acquisition id found')
         missing_acq_str = ''
         missing_slc_str = ''
-        missing_slcs = get_missing_slcs(obj, acq_map, slc_dct) # get list of any missing slc ids
+        missing_slcs = slc_index.get_missing_slcs(slc_idx, hkey) # get list of any missing slc ids
         slcs_are_localized = False
         if not missing_slcs:
            slcs_are_localized = True
         if len(missing_slcs) > 0:
             slcs_are_localized = False
-            all_missing_slcs.extend(missing_slcs) # add to master list for later
             missing_slc_str = ', '.join(missing_slcs)
             missing_acqs = [slc_map.get(x, 'id_not_found') for x in missing_slcs]
             missing_acq_str = ', '.join(missing_acqs)
@@ -56,7 +134,7 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
         ws1.append(row)
     # generate missing slc list
     ws2 = wb.create_sheet("Missing SLCs")
-    all_missing_slcs = sorted(list(set(all_missing_slcs)))
+    all_missing_slcs = sorted(slc_idx.get('missing'))
     title_row = ['slc id', 'acquisition id', 'starttime', 'endtime']
     ws2.append(title_row)
     for slc_id in all_missing_slcs:
@@ -71,18 +149,17 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
     all_date_pairs = []
     title_row = ['expected date pairs']
     ws3.append(title_row)
-    for key in list(acq_list_dct.keys()):
-        acq_list = acq_list_dct[key]
-        st = dateutil.parser.parse(acq_list.get('_source').get('starttime')).strftime('%Y%m%d')
-        et = dateutil.parser.parse(acq_list.get('_source').get('endtime')).strftime('%Y%m%d')
-        ts = '{}-{}'.format(et, st)
-        all_date_pairs.append(ts)
+    with profiling.phase('date_parse'):
+        for key in list(acq_list_dct.keys()):
+            acq_list = acq_list_dct[key]
+            st = dateutil.parser.parse(acq_list.get('_source').get('starttime')).strftime('%Y%m%d')
+            et = dateutil.parser.parse(acq_list.get('_source').get('endtime')).strftime('%Y%m%d')
+            ts = '{}-{}'.format(et, st)
+            all_date_pairs.append(ts)
     for dt in sorted(list(set(all_date_pairs))):
         ws3.append([dt])
     #all acquisitions
-    ws4 = wb.create_sheet('Acquisitions')
-    title_row = ['acquisition_id', 'starttime', 'endtime', 'slc_id', 'ipf_version']
-    ws4.append(title_row)
+    ws4 = sheet_writer(wb, 'Acquisitions', ['acquisition_id', 'starttime', 'endtime', 'slc_id', 'ipf_version'])
     for key in sorted(acq_dct.keys()):
         acq = acq_dct[key]
         acq_id = acq.get('_id', 'UNKNOWN')
@@ -92,9 +169,7 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
         ipf_version = acq.get('_source', {}).get('metadata', {}).get('processing_version', False)
         ws4.append([acq_id, acq_st, acq_et, slc_id, ipf_version])
     #all slcs
-    ws5 = wb.create_sheet('Localized SLCs')
-    title_row = ['slc_id', 'starttime', 'endtime']
-    ws5.append(title_row)
+    ws5 = sheet_writer(wb, 'Localized SLCs', ['slc_id', 'starttime', 'endtime'])
     for key in sorted(slc_dct.keys()):
         slc = slc_dct[key]
         slc_id = slc.get('_id', 'UNKNOWN')
@@ -129,12 +204,11 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
             acq_list = acq_list.get('_id', False)
         ws7.append([slc_id, slc_st, slc_et, acq_list, ifg_cfg])
     #audit trail
-    ws8 = wb.create_sheet('Audit Trail')
     #just write all keys
     title_row = list(audit_trail[0].get('_source', {}).get('metadata', {}).keys())
     for x in ['union_geojson', 'context']:
         title_row.remove(x)
-    ws8.append(title_row)
+    ws8 = sheet_writer(wb, 'Audit Trail', title_row)
     for element in audit_trail:
         met = element.get('_source', {}).get('metadata', {})
         publish_row = []
@@ -157,7 +231,9 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
 
     #if there is an enumeration, generate the appropriate pages
     if enumeration is False:
-        wb.save(filename)
+        with profiling.phase('save'):
+            add_sheet_index(wb)
+            wb.save(filename)
         return
     # print the human enumerated list
     ws10 = wb.create_sheet('Input Enumerated Date Pairs')
@@ -171,23 +247,20 @@ def generate_track(track, aoi, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trai
     ws11.append(title_row)
     alg_date_pairs = all_date_pairs
     human_date_pairs = enumeration
-    total_date_pairs = sorted(list(set(alg_date_pairs + human_date_pairs)))
+    total_date_pairs = enum_compare.merge_date_pairs([human_date_pairs, alg_date_pairs])
     comment_dict = build_audit_dict(audit_trail, 'comment')
     failure_dict = build_audit_dict(audit_trail, 'failure_reason')
-    for date_pair in total_date_pairs:
-        in_human_enumeration = False
-        if date_pair in human_date_pairs:
-            in_human_enumeration = True
-        in_alg_enumeration = False
-        if date_pair in alg_date_pairs:
-            in_alg_enumeration = True
+    for date_pair, (in_human_enumeration, in_alg_enumeration) in total_date_pairs:
         comment = comment_dict.get(date_pair, '')
         failure_reason = failure_dict.get(date_pair, '')
         ref_failure = failure_dict.get(date_pair[:8], '')
         ws11.append([date_pair, in_human_enumeration, in_alg_enumeration, failure_reason, comment, ref_failure])
-    wb.save(filename)
+    with profiling.phase('save'):
+        add_sheet_index(wb)
+        wb.save(filename)
  
 
+@profiling.timed('date_parse')
 def build_audit_dict(audit_trail, field):
     '''builds a dict that goes by YMD-YMD as key which returns the metadata field desired'''
     obj_dict = {}
@@ -293,20 +366,6 @@ def is_covered(obj, slc_dct):
             return False
     return True
 
-def get_missing_slcs(obj, acq_map, slc_dct):
-    '''returns the slc ids enumerated in the object that are not contained in the slc dict'''
-    master = get_scenes(obj, stype='master')
-    slave = get_scenes(obj, stype='slave')
-    acq_ids = list(set(master + slave))
-    #convert the acquisition ids to slc ids
-    slc_ids = [acq_map.get(x, 'slc_id_not_found') for x in acq_ids]
-    #if the slc ids are not in the slc dict
-    missing = []
-    for slc_id in slc_ids:
-        if slc_dct.get(slc_id, False) is False:
-            missing.append(slc_id)
-    return missing
-
 def convert_to_dict(input_list):
     '''attempts to convert the input list to a dict where the keys are object_id'''
     out_dict = {}
@@ -323,6 +382,7 @@ def convert_to_dt_dict(input_list):
         out_dict[starttime] = obj
     return out_dict
     
+@profiling.timed('date_parse')
 def parse_start_time(obj):
     '''gets start time'''
     st = obj.get('_source', {}).get('starttime', False)
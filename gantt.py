@@ -6,46 +6,76 @@ Generates a gantt chart from given information
 from builtins import range
 from builtins import object
 from dateutil import parser
+import os
+import math
 import datetime as dt
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as font_manager
 import matplotlib.dates
+from matplotlib.collections import PolyCollection
 from matplotlib.dates import DAILY,WEEKLY,MONTHLY, DateFormatter, rrulewrapper, RRuleLocator 
 import numpy as np
 
+MAX_ROWS = 100 # rows per image, bounding the figure height to 5 + MAX_ROWS * 0.25 inches
+MAX_XTICKS = 60
+LAYOUTS = ['paginate', 'aggregate']
 
 class gantt_chart(object):
     def __init__(self):
-        self.objects = [] #contains list of tuples: (startime, endtime, title, color)
+        self.objects = [] #contains list of tuples: (startime, endtime, title, color, row)
     
-    def add(self, starttime, endtime, uid, color='orange'):
-        self.objects.append([starttime, endtime, uid, color])
+    def add(self, starttime, endtime, uid, color='orange', row=None):
+        '''adds a bar. bars with the same row label share a row when the chart is aggregated'''
+        self.objects.append([starttime, endtime, uid, color, row])
 
-    def build_gantt(self, filename, title):
-        '''builds the chart from self.objects'''
-        num = len(self.objects)
+    def build_gantt(self, filename, title, layout='paginate', max_rows=MAX_ROWS):
+        '''builds the chart from self.objects, one row per object. with more than max_rows rows the objects are
+        either aggregated onto their row labels or the rows are paginated into multiple images (aggregated rows
+        are also paginated if still too many). Returns the list of image filenames written'''
+        if layout not in LAYOUTS:
+            raise Exception('unknown gantt layout: {}, expected one of {}'.format(layout, LAYOUTS))
+        labels = [obj[2] for obj in self.objects]
+        row_idx = np.arange(len(self.objects))
+        if layout == 'aggregate' and len(self.objects) > max_rows:
+            labels, row_idx = aggregate_rows([obj[4] or obj[2] for obj in self.objects])
+        pages = int(math.ceil(len(labels) / float(max_rows))) or 1
+        filenames = []
+        for page in range(pages):
+            first = page * max_rows
+            page_labels = labels[first:first + max_rows]
+            on_page = np.nonzero((row_idx >= first) & (row_idx < first + len(page_labels)))[0]
+            page_filename = filename if pages == 1 else get_page_filename(filename, page + 1)
+            page_title = title if pages == 1 else '{} ({}/{})'.format(title, page + 1, pages)
+            self.build_page(page_filename, page_title, [self.objects[i] for i in on_page], row_idx[on_page] - first,
+                            page_labels)
+            filenames.append(page_filename)
+        return filenames
+
+    def build_page(self, filename, title, objects, row_idx, ylabels):
+        '''builds a single image with the objects drawn on their row indices'''
+        num = len(ylabels)
         pos = np.arange(0.5,num*0.5+0.5,0.5)
         fig_height = 5 + num * 0.25
         fig = plt.figure(figsize=(20,fig_height))
         ax = fig.add_subplot(111)
-        ylabels = []
-        i = 0
-        for obj in self.objects:
-            starttime, endtime, uid, color = obj
-            start = matplotlib.dates.date2num(starttime)
-            end = matplotlib.dates.date2num(endtime)
-            ylabels.append(uid)
-            ax.barh((i*0.5)+0.5, end - start, left=start, height=0.3, align='center', edgecolor='darkorange', color=color, alpha = 0.8)
-            i+=1
+        #draw all bars as a single collection
+        starts = matplotlib.dates.date2num([obj[0] for obj in objects])
+        ends = matplotlib.dates.date2num([obj[1] for obj in objects])
+        centers = np.asarray(row_idx) * 0.5 + 0.5
+        bars = PolyCollection(bar_vertices(starts, ends, centers - 0.15, centers + 0.15),
+                              facecolors=[obj[3] for obj in objects], edgecolors='darkorange', alpha=0.8)
+        bars.sticky_edges.x.append(starts.min()) # no margin before the first bar, as barh autoscales
+        ax.add_collection(bars)
+        ax.autoscale_view()
         locsy, labelsy = plt.yticks(pos, ylabels)
         plt.setp(labelsy, fontsize = 14)
         ax.set_ylim(ymin = -0.1, ymax = num*0.5+0.5)
         ax.grid(color = 'g', linestyle = ':')
         ax.xaxis_date()
         #rule = rrulewrapper(WEEKLY, interval=1)
-        rule = rrulewrapper(WEEKLY, interval=1)
+        rule = rrulewrapper(WEEKLY, interval=get_tick_interval(starts.min(), ends.max(), 7.0))
         loc = RRuleLocator(rule)
         formatter = DateFormatter("%d-%b")
         ax.xaxis.set_major_locator(loc)
@@ -58,6 +88,33 @@ class gantt_chart(object):
         fig.autofmt_xdate()
         plt.title(title)
         plt.savefig(filename)
+        plt.close(fig)
+
+def aggregate_rows(row_labels):
+    '''returns the unique row labels in order of appearance & the row index of each object'''
+    labels = []
+    index = {}
+    row_idx = []
+    for label in row_labels:
+        if label not in index:
+            index[label] = len(labels)
+            labels.append(label)
+        row_idx.append(index[label])
+    return labels, np.array(row_idx, dtype=int)
+
+def get_page_filename(filename, page):
+    '''returns the filename of the numbered page image'''
+    base, ext = os.path.splitext(filename)
+    return '{}_page{:03d}{}'.format(base, page, ext)
+
+def get_tick_interval(start, end, period_days):
+    '''returns the date tick interval (in periods) keeping at most MAX_XTICKS ticks over the date num span'''
+    return max(1, int(math.ceil((end - start) / period_days / MAX_XTICKS)))
+
+def bar_vertices(starts, ends, bottoms, tops):
+    '''returns the (n, 4, 2) array of rectangle vertices for the bars'''
+    return np.stack([np.column_stack([starts, bottoms]), np.column_stack([starts, tops]),
+                     np.column_stack([ends, tops]), np.column_stack([ends, bottoms])], axis=1)
 
 if __name__ == '__main__':
     filename = 'test.png'
@@ -8,79 +8,126 @@ from builtins import range
 import re
 import os
 import json
+import argparse
 import shutil
-import urllib3
 import hashlib
 import datetime
-import requests
-from openpyxl import Workbook
 import dateutil.parser
-from hysds.celery import app
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import enumeration as enum_compare
+import excel
+import profiling
+import artifact_cache
+import grq
+import audit_prefetch
+import hash_order
 
 VERSION = 'v2.0'
 PRODUCT_NAME = 'AOI_Enumeration_Report-{}-TN{}-{}-{}'
 IDX_DCT = {'audit_trail': 'grq_*_s1-gunw-acqlist-audit_trail', 'ifg':'grq_*_s1-gunw',
            'acq-list':'grq_*_s1-gunw-acq-list', 'ifg-cfg': 'grq_*_s1-gunw-ifg-cfg',
-           'ifg-blacklist':'grq_*_blacklist', 'slc': 'grq_*_s1-iw_slc', 'acq': 'grq_*_acquisition-s1-iw_slc'}
+           'ifg-blacklist':'grq_*_blacklist', 'slc': 'grq_*_s1-iw_slc', 'acq': 'grq_*_acquisition-s1-iw_slc',
+           'enumeration_report': 'grq_*_aoi_enumeration_report'}
 
-def main():
+def main(grq_url=None):
     '''
     Queries for relevant products & builds the report by track.
     '''
     ctx = load_context()
+    profiling.configure_memory(ctx)
+    artifact_cache.configure(ctx)
+    grq.set_grq_url(grq_url or ctx.get('grq_url'))
+    grq.configure_snapshot(ctx)
+    grq.set_fetch_window(ctx.get('fetch_window'), ctx.get('fetch_workers'))
+    hash_order.set_endtime_sort(str(ctx.get('endtime_sort', False)).lower() == 'true')
     aoi_id = ctx.get('aoi_id', False)
     aoi_index = ctx.get('aoi_index', False)
     if aoi_id is False or aoi_index is False:
         raise Exception('invalid inputs of aoi_id: {}, aoi_index: {}'.format(aoi_id, aoi_index))
     aoi = get_aoi(aoi_id, aoi_index)
-    enumeration = ctx.get('date_pairs', False) #list of date pairs
+    if str(ctx.get('audit_prefetch', False)).lower() == 'true':
+        audit_prefetch.fetch([aoi.get('_source').get('id')]) #the audit trail of all tracks in one query
+    enumeration = validate_enumeration(ctx.get('date_pairs', False), ctx.get('date_pairs_file', False))
+    skip_unchanged = str(ctx.get('skip_unchanged', False)).lower() == 'true'
     track_acq_lists = sort_by_track(get_objects('acq-list', aoi))
     for track in list(track_acq_lists.keys()):
         print('For track: {}'.format(track))
+        profiling.reset()
         audit_trail = get_objects('audit_trail', aoi, track)
         if len(audit_trail) < 1:
             print('no audit trail products found for track {}'.format(track))
             continue
-        allowed_hashes = list(set(store_by_hash(audit_trail).keys())) #allow only hashes foud in audit-trail
+        allowed_hashes = set(store_by_hash(audit_trail).keys()) #allow only hashes foud in audit-trail
         acq_lists = filter_hashes(get_objects('acq-list', aoi, track), allowed_hashes)
         ifg_cfgs = filter_hashes(get_objects('ifg-cfg', aoi, track), allowed_hashes)
         ifgs = filter_hashes(get_objects('ifg', aoi, track), allowed_hashes)
         now = datetime.datetime.now().strftime('%Y%m%dT%H%M')
         product_id = PRODUCT_NAME.format(aoi_id, track, now, VERSION)
-        generate(product_id, aoi, track, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration)
-        print('generated product {} for track: {}'.format(product_id, track))
+        if generate(product_id, aoi, track, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration,
+                    skip_unchanged=skip_unchanged):
+            print('generated product {} for track: {}'.format(product_id, track))
 
-def generate(product_id, aoi, track, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration_string):
-    '''generates an enumeration comparison report for the given aoi & track'''
+def generate(product_id, aoi, track, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration, skip_unchanged=False):
+    '''generates an enumeration comparison report for the given aoi & track. With skip_unchanged no product is
+    created if the product set & enumeration match the latest report's, returns False if skipped'''
+    count_documents(acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration)
+    with profiling.phase('hash_index'):
+        acq_list_dct = store_by_hash(acq_lists) # converts dict where key is hash of master/slave slc ids
+        ifg_cfg_dct = store_by_hash(ifg_cfgs) # converts dict where key is hash of master/slave slc ids
+        ifg_dct = store_by_hash(ifgs) # converts dict where key is hash of master/slave slc ids
+    with profiling.phase('fingerprint'):
+        input_fingerprint = gen_input_fingerprint(enumeration, acq_list_dct, ifg_cfg_dct, ifg_dct,
+                                                  store_by_hash(audit_trail))
+    if skip_unchanged and input_fingerprint == get_latest_fingerprint(aoi, track):
+        print('products unchanged since the latest report for track {}, skipping {}'.format(track, product_id))
+        profiling.log_report(product_id)
+        return False
     # unique tracks based on acquisition list
     if os.path.exists(product_id):
         shutil.rmtree(product_id)
     os.mkdir(product_id)
     filename = '{}.xlsx'.format(product_id)
     output_path = os.path.join(product_id, filename)
-    acq_list_dct = store_by_hash(acq_lists) # converts dict where key is hash of master/slave slc ids
-    ifg_cfg_dct = store_by_hash(ifg_cfgs) # converts dict where key is hash of master/slave slc ids
-    ifg_dct = store_by_hash(ifgs) # converts dict where key is hash of master/slave slc ids
+    with profiling.phase('fingerprint'):
+        # the input fingerprint & the ids of the whole audit trail, which the comparison sheet reads
+        key = None
+        if artifact_cache.enabled():
+            key = artifact_cache.fingerprint('enumeration_workbook-{}'.format(VERSION), input_fingerprint,
+                                             sorted(obj.get('_id') for obj in audit_trail))
+    if key and artifact_cache.restore(key, filename=output_path):
+        gen_product_met(aoi, product_id, track, input_fingerprint)
+        profiling.log_report(product_id)
+        return True
     #create workbook
-    wb = Workbook()
-    write_current_products(wb, acq_list_dct, ifg_cfg_dct, ifg_dct)
-    write_hysds_enumerated_date_pairs(wb, acq_list_dct)
-    enumeration = validate_enumeration(enumeration_string)
-    write_input_enumerated_date_pairs(wb, enumeration)
-    write_enumeration_comparison(wb, acq_lists, enumeration, audit_trail)
+    with profiling.phase('workbook'):
+        wb = excel.new_workbook(profiling.low_memory()) # write only once over the memory budget
+        hash_list = sort_into_hash_list(acq_list_dct) # acq-list hashes by endtime, shared by both sheets
+        write_current_products(wb, acq_list_dct, ifg_cfg_dct, ifg_dct, hash_list)
+        write_hysds_enumerated_date_pairs(wb, acq_list_dct, hash_list)
+        write_input_enumerated_date_pairs(wb, enumeration)
+        write_enumeration_comparison(wb, acq_lists, enumeration, audit_trail)
     #save output 
-    wb.save(output_path)
-    gen_product_met(aoi, product_id, track)
+    with profiling.phase('save'):
+        wb.save(output_path)
+        if key:
+            artifact_cache.store(key, [output_path])
+    gen_product_met(aoi, product_id, track, input_fingerprint)
+    profiling.log_report(product_id)
+    return True
 
-def write_current_products(wb, acq_list_dct, ifg_cfg_dct, ifg_dct):
-    '''generate the sheet for enumerated products'''
-    ws = wb.active
-    ws.title = 'Current Products'
+def count_documents(acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration):
+    '''records the number of each object type in the report'''
+    for object_type, obj_list in (('acq-list', acq_lists), ('ifg-cfg', ifg_cfgs), ('ifg', ifgs),
+                                  ('audit_trail', audit_trail), ('enumeration', enumeration)):
+        profiling.count_documents(object_type, len(obj_list))
+
+def write_current_products(wb, acq_list_dct, ifg_cfg_dct, ifg_dct, hash_list=None):
+    '''generate the sheet for enumerated products, in the order of hash_list if given'''
+    ws = excel.first_sheet(wb, 'Current Products')
     title = ['date pair', 'acquisition-list', 'ifg-cfg', 'ifg', 'hash']
     ws.append(title)
-    for id_hash in sort_into_hash_list(acq_list_dct):
+    if hash_list is None:
+        hash_list = sort_into_hash_list(acq_list_dct)
+    for id_hash in hash_list:
         acq_list = acq_list_dct.get(id_hash, {})
         ifg_cfg = ifg_cfg_dct.get(id_hash, {})
         ifg_cfg_id = ifg_cfg.get('_id', 'MISSING')
@@ -91,12 +138,12 @@ def write_current_products(wb, acq_list_dct, ifg_cfg_dct, ifg_dct):
         ifg_id = ifg.get('_id', 'MISSING')
         ws.append([date_pair, acq_list_id, ifg_cfg_id, ifg_id, id_hash])
 
-def write_hysds_enumerated_date_pairs(wb, acq_list_dct):
+def write_hysds_enumerated_date_pairs(wb, acq_list_dct, hash_list=None):
     '''writes the sheet that lists all the date pairs from the acquisition lists'''
     ws = wb.create_sheet('HySDS Enumerated Date Pairs')
     ws.append(['date pair'])
     date_pairs = set()
-    for id_hash in sort_into_hash_list(acq_list_dct):
+    for id_hash in hash_list if hash_list is not None else sort_into_hash_list(acq_list_dct):
         date_pair = gen_date_pair(acq_list_dct.get(id_hash))
         date_pairs.add(date_pair)
     for date_pair in sorted(date_pairs, reverse=True):
@@ -118,12 +165,12 @@ def write_enumeration_comparison(wb, acq_list, enumeration, audit_trail):
     ws.append(['date pair', 'input enumeration', 'hysds enumeration', 'audit trail', 'audit comment', 'hash'])
     audit_dct = store_by_date_pair(audit_trail)
     acq_dct = store_by_date_pair(acq_list)
-    all_date_pairs = list(set(list(audit_dct.keys()) + list(acq_dct.keys()) + enumeration))
-    for date_pair in sorted(all_date_pairs, reverse=True):
+    all_date_pairs = enum_compare.merge_date_pairs([enumeration, acq_dct, audit_dct], reverse=True)
+    for date_pair, (in_enumeration, _, _) in all_date_pairs:
         acq_list = acq_dct.get(date_pair, {})
         acq_id = acq_list.get('_id', 'MISSING')
         enum_id = 'MISSING'
-        if date_pair in enumeration:
+        if in_enumeration:
             enum_id = 'PAIRED'
         audit_trail = audit_dct.get(date_pair, {})
         audit_trail_id = audit_trail.get('_id', 'MISSING')
@@ -131,7 +178,29 @@ def write_enumeration_comparison(wb, acq_list, enumeration, audit_trail):
         acq_hash = get_hash(acq_list)
         ws.append([date_pair, enum_id, acq_id, audit_trail_id, audit_comment, acq_hash]) 
 
-def gen_product_met(aoi, product_id, track):
+def gen_input_fingerprint(enumeration, *obj_dicts):
+    '''returns the fingerprint of the input enumeration & the deduplicated product set, the sorted (key, id) pairs of
+    each product dict'''
+    id_lists = [sorted([key, obj.get('_id')] for key, obj in obj_dict.items()) for obj_dict in obj_dicts]
+    return artifact_cache.fingerprint('enumeration_report-{}'.format(VERSION), sorted(enumeration), *id_lists)
+
+def get_latest_fingerprint(aoi, track):
+    '''returns the input fingerprint in the met.json of the latest enumeration report for the aoi & track, None if
+    there is none (or it can't be queried)'''
+    grq_url = grq.get_search_url(IDX_DCT.get('enumeration_report'))
+    grq_query = {"query":{"bool":{"must":[{"term":{"metadata.aoi_id.raw": aoi.get('_id')}},
+                 {"term":{"metadata.track_number": track}}]}}, "sort":[{"creation_timestamp":{"order":"desc"}}],
+                 "_source":["metadata.input_fingerprint"], "from":0, "size":1}
+    try:
+        results = grq.query_es_page(grq_url, grq_query)
+    except Exception as err:
+        print('failed to query the latest report for track {}: {}'.format(track, err))
+        return None
+    if not results:
+        return None
+    return results[0].get('_source', {}).get('metadata', {}).get('input_fingerprint')
+
+def gen_product_met(aoi, product_id, track, input_fingerprint=None):
     '''generates the appropriate product json files in the product directory'''
     location = aoi.get('_source', {}).get('location', False)
     starttime = aoi.get('_source', {}).get('starttime', False)
@@ -140,30 +209,18 @@ def gen_product_met(aoi, product_id, track):
     outpath = os.path.join(product_id, '{}.dataset.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(ds_json, outf)
-    met_json = {'track_number': track}
+    met_json = {'track_number': track, 'aoi_id': aoi.get('_id'), 'input_fingerprint': input_fingerprint}
+    met_json.update(profiling.get_report()) # timing by phase & document counts
     outpath = os.path.join(product_id, '{}.met.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(met_json, outf)
 
-def validate_enumeration(date_pair_string):
-    '''validates the enumeration date pair list to be the appropriate format. Returns as a list sorted by endtime'''
-    date_pairs = date_pair_string.replace(' ', '').replace('_', '-').split(',')
-    pair_dict = {}
-    output_pairs = []
-    for date_pair in date_pairs:
-        dates = date_pair.split('-')
-        if len(dates) < 2:
-            print('Failed parsing date pair: {}. skipping.'.format(date_pair))
-            continue
-        first_date = dateutil.parser.parse(dates[0])
-        second_date = dateutil.parser.parse(dates[1])
-        if first_date < second_date:
-            first_date, second_date = second_date, first_date
-        output_date = '{}-{}'.format(first_date.strftime('%Y%m%d'), second_date.strftime('%Y%m%d'))
-        pair_dict[output_date] = output_date
-    for key in sorted(pair_dict.keys()):
-        output_pairs.append(pair_dict.get(key))
-    return output_pairs
+def validate_enumeration(date_pair_string, date_pair_file=False):
+    '''validates the enumeration date pair list (string and/or local file) to be the appropriate format. Returns
+    as a list sorted by endtime'''
+    if not date_pair_string and not date_pair_file:
+        raise Exception('no enumeration given, date_pairs or date_pairs_file is required')
+    return enum_compare.load_enumeration(date_pair_string, date_pair_file)
 
 def filter_hashes(obj_list, allowed_hashes):
     '''filters out all objects in the object list that aren't storing any of the allowed hashes'''
@@ -179,12 +236,13 @@ def store_by_hash(obj_list):
     result_dict = {}
     for obj in obj_list:
         full_id_hash = get_hash(obj)
-        if full_id_hash in list(result_dict.keys()):
+        if full_id_hash in result_dict:
             result_dict[full_id_hash] = get_most_recent(obj, result_dict.get(full_id_hash))
         else:
             result_dict[full_id_hash] = obj
     return result_dict
 
+@profiling.timed('date_parse')
 def get_most_recent(obj1, obj2):
     '''returns the object with the most recent ingest time'''
     ctime1 = dateutil.parser.parse(obj1.get('_source', {}).get('creation_timestamp', False))
@@ -266,6 +324,7 @@ def gen_hash(es_obj):
     id_hash = hashlib.md5(json.dumps([master_ids_str, slave_ids_str]).encode("utf8")).hexdigest()
     return id_hash
 
+@profiling.timed('date_parse')
 def gen_date_pair(obj):
     '''returns the date pair string for the input object'''
     st = obj.get('_source', {}).get('metadata', {}).get('secondary_date', False)
@@ -291,12 +350,7 @@ def gen_date_pair(obj):
 
 def sort_into_hash_list(obj_dict):
     '''builds a list of hashes where the hashes are sorted by the objects endtime'''
-    sorted_obj = sorted(list(obj_dict.keys()), key=lambda x: get_endtime(obj_dict.get(x)), reverse=True)
-    return sorted_obj#[obj.get('_source', {}).get('metadata', {}).get('full_id_hash', '') for obj in sorted_obj]
-
-def get_endtime(obj):
-    '''returns the endtime'''
-    return dateutil.parser.parse(obj.get('_source', {}).get('endtime'))
+    return hash_order.sort_by_endtime(obj_dict)
 
 def get_objects(object_type, aoi, track_number=False):
     '''returns all objects of the object type ['ifg, acq-list, 'ifg-blacklist'] that intersect both
@@ -306,8 +360,7 @@ def get_objects(object_type, aoi, track_number=False):
     starttime = aoi.get('_source', {}).get('starttime')
     endtime = aoi.get('_source', {}).get('endtime')
     location = aoi.get('_source', {}).get('location')
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, idx)
+    grq_url = grq.get_search_url(idx)
     track_field = 'track_number'
     if object_type == 'slc' and track_number:
         track_field = 'trackNumber'
@@ -321,53 +374,25 @@ def get_objects(object_type, aoi, track_number=False):
                      "filter":{"bool":{"must":[{"range":{"endtime":{"gte":starttime}}},
                      {"range":{"starttime":{"lte":endtime}}}]}}}},
                      "from":0,"size":1000}
+    if object_type == 'acq-list' and hash_order.get_sort():
+        grq_query['sort'] = hash_order.get_sort() #acq-lists arrive in report order
+    if object_type == 'audit_trail':
+        audit_trail = audit_prefetch.get(aoi.get('_source').get('id'), track_number)
+        if audit_trail is not None:
+            return audit_trail
     if object_type == 'audit_trail':
         grq_query = {"query":{"bool":{"must":[{"term":{"metadata.aoi.raw":aoi.get('_source').get('id')}},{"term":{"metadata.track_number": track_number}}]}},"from":0,"size":1000}
-    results = query_es(grq_url, grq_query)
+        return grq.query_es(grq_url, grq_query)
+    results = grq.query_es_windowed(grq_url, grq_query, starttime, endtime)
     return results
 
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in list(es_query.keys()):
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10
-        es_query['size'] = iterator_size
-    if 'from' in list(es_query.keys()):
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    #run the query and iterate until all the results have been returned
-    #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    #print('status code: {}'.format(response.status_code))
-    #print('response text: {}'.format(response.text))
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
-
 def get_aoi(aoi_id, aoi_index):
     '''
     retrieves the AOI from ES
     '''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, aoi_index)
+    grq_url = grq.get_search_url(aoi_index)
     es_query = {"query":{"bool":{"must":[{"term":{"id.raw":aoi_id}}]}}}
-    result = query_es(grq_url, es_query)
+    result = grq.query_es(grq_url, es_query)
     if len(result) < 1:
         raise Exception('Found no results for AOI: {}'.format(aoi_id))
     return result[0]
@@ -384,4 +409,10 @@ def load_context():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grq_url', help='GRQ endpoint, defaults to $GRQ_URL or the hysds celery GRQ_ES_URL')
+    args = parser.parse_args()
+    try:
+        main(grq_url=args.grq_url)
+    finally:
+        grq.write_metrics('enumeration_report')
@@ -8,88 +8,141 @@ from builtins import range
 import re
 import os
 import json
+import argparse
 import shutil
-import urllib3
 import hashlib
 import datetime
-import requests
-from openpyxl import Workbook
 import dateutil.parser
-from hysds.celery import app
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import slc_index
+import excel
+import enumeration as enum_compare
+import profiling
+import artifact_cache
+import grq
+import audit_prefetch
+import hash_order
+import product_store
 
 VERSION = 'v2.0'
 PRODUCT_NAME = 'AOI_Ops_Report-{}-TN{}-{}-{}'
 IDX_DCT = {'audit_trail': 'grq_*_s1-gunw-acqlist-audit_trail', 'ifg':'grq_*_s1-gunw',
            'acq-list':'grq_*_s1-gunw-acq-list', 'ifg-cfg': 'grq_*_s1-gunw-ifg-cfg',
            'ifg-blacklist':'grq_*_blacklist', 'slc': 'grq_*_s1-iw_slc', 'acq': 'grq_*_acquisition-s1-iw_slc',
-           'aoi_track': 'grq_*_s1-gunw-aoi_track'}
+           'aoi_track': 'grq_*_s1-gunw-aoi_track', 'ops_report': 'grq_*_aoi_ops_report'}
 
-def main():
+def main(grq_url=None):
     '''
     Queries for relevant products & builds the report by track.
     '''
     ctx = load_context()
+    profiling.configure_memory(ctx)
+    artifact_cache.configure(ctx)
+    product_store.configure(ctx)
+    grq.set_grq_url(grq_url or ctx.get('grq_url'))
+    grq.configure_snapshot(ctx)
+    grq.set_fetch_window(ctx.get('fetch_window'), ctx.get('fetch_workers'))
+    hash_order.set_endtime_sort(str(ctx.get('endtime_sort', False)).lower() == 'true')
     aoi_id = ctx.get('aoi_id', False)
     aoi_index = ctx.get('aoi_index', False)
     if aoi_id is False or aoi_index is False:
         raise Exception('invalid inputs of aoi_id: {}, aoi_index: {}'.format(aoi_id, aoi_index))
     aoi = get_aoi(aoi_id, aoi_index)
+    if str(ctx.get('audit_prefetch', False)).lower() == 'true':
+        audit_prefetch.fetch([aoi.get('_source').get('id')]) #the audit trail of all tracks in one query
+    skip_unchanged = str(ctx.get('skip_unchanged', False)).lower() == 'true'
     track_acq_lists = sort_by_track(get_objects('acq-list', aoi))
     for track in list(track_acq_lists.keys()):
         print('For track: {}'.format(track))
+        profiling.reset()
         acqs = get_objects('acq', aoi, track)
         slcs = get_objects('slc', aoi, track)
         audit_trail = get_objects('audit_trail', aoi, track)
         if len(audit_trail) < 1:
             print('no audit trail products found for track {}'.format(track))
             continue
-        allowed_hashes = list(set(store_by_hash(audit_trail).keys())) #allow only hashes foud in audit-trail
+        allowed_hashes = set(store_by_hash(audit_trail).keys()) #allow only hashes foud in audit-trail
         acq_lists = filter_hashes(get_objects('acq-list', aoi, track), allowed_hashes)
         ifg_cfgs = filter_hashes(get_objects('ifg-cfg', aoi, track), allowed_hashes)
         ifgs = filter_hashes(get_objects('ifg', aoi, track), allowed_hashes)
         aoi_tracks = get_objects('aoi_track', aoi, track)
         now = datetime.datetime.now().strftime('%Y%m%dT%H%M')
         product_id = PRODUCT_NAME.format(aoi_id, track, now, VERSION)
-        generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks)
-        print('generated {} for track: {}'.format(product_id, track))
-
-def generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks):
-    '''generates an enumeration comparison report for the given aoi & track'''
+        if generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks,
+                    skip_unchanged=skip_unchanged):
+            print('generated {} for track: {}'.format(product_id, track))
+
+def generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks,
+             skip_unchanged=False):
+    '''generates an enumeration comparison report for the given aoi & track. With skip_unchanged no product is
+    created if the product set matches the latest report's, returns False if skipped'''
+    count_documents(acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks)
+    with profiling.phase('hash_index'):
+        acq_dct = store_by_id(acqs)
+        acq_map_dct = store_by_slc_id(acqs)
+        slc_dct = store_by_id(slcs)
+        acq_list_dct = store_by_hash(acq_lists) # converts dict where key is hash of master/slave slc ids
+        ifg_cfg_dct = store_by_hash(ifg_cfgs) # converts dict where key is hash of master/slave slc ids
+        ifg_dct = store_by_hash(ifgs) # converts dict where key is hash of master/slave slc ids
+        aoi_track_dct = store_by_gunw(aoi_tracks)
+        hash_list = sort_into_hash_list(acq_list_dct) # acq-list hashes by endtime, once per track
+        if not product_store.enabled():
+            slc_idx = slc_index.build_slc_index(acq_list_dct, slc_dct) # referenced & missing slcs by acq-list hash
+    if product_store.enabled():
+        slc_idx = product_store.sync_track(aoi.get('_id'), track, get_hash, slcs, acq_lists) # joined in sqlite
+    with profiling.phase('fingerprint'):
+        input_fingerprint = gen_input_fingerprint(acq_dct, slc_dct, acq_list_dct, ifg_cfg_dct, ifg_dct,
+                                                  store_by_id(aoi_tracks))
+    if skip_unchanged and input_fingerprint == get_latest_fingerprint(aoi, track):
+        print('products unchanged since the latest report for track {}, skipping {}'.format(track, product_id))
+        profiling.log_report(product_id)
+        return False
     # unique tracks based on acquisition list
     if os.path.exists(product_id):
         shutil.rmtree(product_id)
     os.mkdir(product_id)
     filename = '{}.xlsx'.format(product_id)
     output_path = os.path.join(product_id, filename)
-    acq_dct = store_by_id(acqs)
-    acq_map_dct = store_by_slc_id(acqs)
-    slc_dct = store_by_id(slcs)
-    acq_list_dct = store_by_hash(acq_lists) # converts dict where key is hash of master/slave slc ids
-    ifg_cfg_dct = store_by_hash(ifg_cfgs) # converts dict where key is hash of master/slave slc ids
-    ifg_dct = store_by_hash(ifgs) # converts dict where key is hash of master/slave slc ids
-    aoi_track_dct = store_by_gunw(aoi_tracks)
+    key = input_fingerprint if artifact_cache.enabled() else None # the workbook only depends on the product set
+    if key and artifact_cache.restore(key, filename=output_path):
+        gen_product_met(aoi, product_id, track, input_fingerprint)
+        profiling.log_report(product_id)
+        return True
     #create workbook
-    wb = Workbook()
-    write_current_status(wb, acq_list_dct, ifg_cfg_dct, ifg_dct, slc_dct, acq_map_dct, aoi_track_dct)
-    write_slcs(wb, slc_dct)
-    write_missing_slcs(wb, slc_dct, acq_lists)
-    write_acqs(wb, acq_dct)
-    write_acq_lists(wb, acq_list_dct)
-    write_ifg_cfgs(wb, ifg_cfg_dct)
-    write_ifgs(wb, ifg_dct)
+    with profiling.phase('workbook'):
+        wb = excel.new_workbook(profiling.low_memory()) # write only once over the memory budget
+        write_current_status(wb, acq_list_dct, ifg_cfg_dct, ifg_dct, slc_idx, acq_map_dct, aoi_track_dct,
+                             hash_list)
+        write_slcs(wb, slc_dct)
+        write_missing_slcs(wb, slc_idx)
+        write_acqs(wb, acq_dct)
+        write_acq_lists(wb, acq_list_dct)
+        write_ifg_cfgs(wb, ifg_cfg_dct)
+        write_ifgs(wb, ifg_dct)
     #save output 
-    wb.save(output_path)
-    gen_product_met(aoi, product_id, track)
-
-def write_current_status(wb, acq_list_dict, ifg_cfg_dct, ifg_dct, slc_dct, acq_map_dct, aoi_track_dct):
-    '''generate the sheet for enumerated products'''
-    ws = wb.active
-    ws.title = 'Current Product Status'
+    with profiling.phase('save'):
+        excel.add_sheet_index(wb)
+        wb.save(output_path)
+        if key:
+            artifact_cache.store(key, [output_path])
+    gen_product_met(aoi, product_id, track, input_fingerprint)
+    profiling.log_report(product_id)
+    return True
+
+def count_documents(acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks):
+    '''records the number of each object type in the report'''
+    for object_type, obj_list in (('acq', acqs), ('slc', slcs), ('acq-list', acq_lists), ('ifg-cfg', ifg_cfgs),
+                                  ('ifg', ifgs), ('audit_trail', audit_trail), ('aoi_track', aoi_tracks)):
+        profiling.count_documents(object_type, len(obj_list))
+
+def write_current_status(wb, acq_list_dict, ifg_cfg_dct, ifg_dct, slc_idx, acq_map_dct, aoi_track_dct,
+                         hash_list=None):
+    '''generate the sheet for enumerated products, in the order of hash_list if given'''
+    ws = excel.first_sheet(wb, 'Current Product Status')
     title = ['date pair', 'acquisition-list', 'ifg-cfg', 'ifg', 'hash', 'missing_slc_ids', 'missing_acq_ids', 'aoi_track_id']
     ws.append(title)
-    for id_hash in sort_into_hash_list(acq_list_dict):
+    if hash_list is None:
+        hash_list = sort_into_hash_list(acq_list_dict)
+    for id_hash in hash_list:
         acq_list = acq_list_dict.get(id_hash, {})
         ifg_cfg = ifg_cfg_dct.get(id_hash, {})
         ifg_cfg_id = ifg_cfg.get('_id', 'MISSING')
@@ -98,47 +151,27 @@ def write_current_status(wb, acq_list_dict, ifg_cfg_dct, ifg_dct, slc_dct, acq_m
         acq_list_id = acq_list.get('_id', 'MISSING')
         ifg_id = ifg.get('_id', 'MISSING')
         aoi_track_id = aoi_track_dct.get(ifg_id, 'MISSING')
-        missing_slcs = []
-        missing_acqs = []
-        acq_list_slcs = acq_list.get('_source').get('metadata').get('master_scenes') + acq_list.get('_source').get('metadata').get('slave_scenes')
-        for slc_id in acq_list_slcs:
-            if not slc_dct.get(slc_id, False):
-                missing_slcs.append(slc_id)
-                missing_acq = acq_map_dct.get(slc_id, False)
-                if missing_acq:
-                    missing_acq_id = missing_acq.get('_id')
-                    missing_acqs.append(missing_acq_id)
+        missing_slcs = slc_index.get_missing_slcs(slc_idx, id_hash)
+        missing_acqs = slc_index.get_missing_acqs(slc_idx, id_hash, acq_map_dct)
         missing_slc_str = ', '.join(missing_slcs)
         missing_acq_str = ', '.join(missing_acqs) 
         ws.append([date_pair, acq_list_id, ifg_cfg_id, ifg_id, id_hash, missing_slc_str, missing_acq_str, aoi_track_id])
 
 def write_slcs(wb, slc_dct):
     '''generates the sheet for slcs'''
-    ws = wb.create_sheet('SLCs')
-    ws.append(['slc_id'])
+    ws = excel.sheet_writer(wb, 'SLCs', ['slc_id'])
     for slc_id in list(slc_dct.keys()):
         ws.append([slc_id])
 
-def write_missing_slcs(wb, slc_dct, acq_lists):
+def write_missing_slcs(wb, slc_idx):
     '''generates the sheet for missing slcs'''
-    ws = wb.create_sheet('Missing SLCs')
-    ws.append(['slc_id'])
-    missing = []
-    for acq_list in acq_lists:
-        master_scenes = acq_list.get('_source', {}).get('metadata', {}).get('master_scenes', [])
-        slave_scenes = acq_list.get('_source', {}).get('metadata', {}).get('slave_scenes', [])
-        all_scenes = master_scenes + slave_scenes
-        for slc_id in all_scenes:
-            if slc_dct.get(slc_id, False) is False:
-                missing.append(slc_id)
-    missing = list(set(missing))
-    for slc_id in missing:
+    ws = excel.sheet_writer(wb, 'Missing SLCs', ['slc_id'])
+    for slc_id in sorted(slc_idx.get('missing')):
         ws.append([slc_id])
 
 def write_acqs(wb, acq_dct):
     '''generates the sheet for acquisitions'''
-    ws = wb.create_sheet('Acquisitions')
-    ws.append(['acq_id', 'slc_id', 'ipf'])
+    ws = excel.sheet_writer(wb, 'Acquisitions', ['acq_id', 'slc_id', 'ipf'])
     for acq_id in list(acq_dct.keys()):
         acq = acq_dct.get(acq_id, {})
         slc_id = acq.get('_source', {}).get('metadata', {}).get('title', 'MISSING')
@@ -180,7 +213,28 @@ def write_hysds_enumerated_date_pairs(wb, acq_list_dct):
         date_pair = gen_date_pair(acq_list_dct.get(id_hash))
         ws.append([date_pair])
 
-def gen_product_met(aoi, product_id, track):
+def gen_input_fingerprint(*obj_dicts):
+    '''returns the fingerprint of the deduplicated product set, the sorted (key, id) pairs of each product dict'''
+    id_lists = [sorted([key, obj.get('_id')] for key, obj in obj_dict.items()) for obj_dict in obj_dicts]
+    return artifact_cache.fingerprint('ops_report-{}'.format(VERSION), *id_lists)
+
+def get_latest_fingerprint(aoi, track):
+    '''returns the input fingerprint in the met.json of the latest ops report for the aoi & track, None if there is
+    none (or it can't be queried)'''
+    grq_url = grq.get_search_url(IDX_DCT.get('ops_report'))
+    grq_query = {"query":{"bool":{"must":[{"term":{"metadata.aoi_id.raw": aoi.get('_id')}},
+                 {"term":{"metadata.track_number": track}}]}}, "sort":[{"creation_timestamp":{"order":"desc"}}],
+                 "_source":["metadata.input_fingerprint"], "from":0, "size":1}
+    try:
+        results = grq.query_es_page(grq_url, grq_query)
+    except Exception as err:
+        print('failed to query the latest report for track {}: {}'.format(track, err))
+        return None
+    if not results:
+        return None
+    return results[0].get('_source', {}).get('metadata', {}).get('input_fingerprint')
+
+def gen_product_met(aoi, product_id, track, input_fingerprint=None):
     '''generates the appropriate product json files in the product directory'''
     location = aoi.get('_source', {}).get('location', False)
     starttime = aoi.get('_source', {}).get('starttime', False)
@@ -189,30 +243,15 @@ def gen_product_met(aoi, product_id, track):
     outpath = os.path.join(product_id, '{}.dataset.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(ds_json, outf)
-    met_json = {'track_number': track}
+    met_json = {'track_number': track, 'aoi_id': aoi.get('_id'), 'input_fingerprint': input_fingerprint}
+    met_json.update(profiling.get_report()) # timing by phase & document counts
     outpath = os.path.join(product_id, '{}.met.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(met_json, outf)
 
 def validate_enumeration(date_pair_string):
     '''validates the enumeration date pair list to be the appropriate format. Returns as a list sorted by endtime'''
-    date_pairs = date_pair_string.replace(' ', '').replace('_', '-').split(',')
-    pair_dict = {}
-    output_pairs = []
-    for date_pair in date_pairs:
-        dates = date_pair.split('-')
-        if len(dates) < 2:
-            print('Failed parsing date pair: {}. skipping.'.format(date_pair))
-            continue
-        first_date = dateutil.parser.parse(dates[0])
-        second_date = dateutil.parser.parse(dates[1])
-        if first_date < second_date:
-            first_date, second_date = second_date, first_date
-        output_date = '{}-{}'.format(first_date.strftime('%Y%m%d'), second_date.strftime('%Y%m%d'))
-        pair_dict[first_date] = output_date
-    for key in sorted(pair_dict.keys()):
-        output_pairs.append(pair_dict.get(key))
-    return output_pairs
+    return enum_compare.load_enumeration(date_pair_string)
 
 def sort_date_pair_list(date_pair_list):
     '''sorts a list of date pair strings by the end date'''
@@ -239,12 +278,13 @@ def store_by_hash(obj_list):
     result_dict = {}
     for obj in obj_list:
         full_id_hash = get_hash(obj)
-        if full_id_hash in list(result_dict.keys()):
+        if full_id_hash in result_dict:
             result_dict[full_id_hash] = get_most_recent(obj, result_dict.get(full_id_hash))
         else:
             result_dict[full_id_hash] = obj
     return result_dict
 
+@profiling.timed('date_parse')
 def get_most_recent(obj1, obj2):
     '''returns the object with the most recent ingest time'''
     ctime1 = dateutil.parser.parse(obj1.get('_source', {}).get('creation_timestamp', False))
@@ -319,6 +359,7 @@ def store_by_date_pair(obj_list):
         result_dict[date_pair] = obj
     return result_dict
 
+@profiling.timed('date_parse')
 def gen_date_pair(obj):
     '''returns the date pair string for the input object'''
     st = dateutil.parser.parse(obj.get('_source').get('starttime')).strftime('%Y%m%d')
@@ -327,12 +368,7 @@ def gen_date_pair(obj):
 
 def sort_into_hash_list(obj_dict):
     '''builds a list of hashes where the hashes are sorted by the objects endtime'''
-    sorted_obj = sorted(list(obj_dict.keys()), key=lambda x: get_endtime(obj_dict.get(x)), reverse=True)
-    return sorted_obj#[obj.get('_source', {}).get('metadata', {}).get('full_id_hash', '') for obj in sorted_obj]
-
-def get_endtime(obj):
-    '''returns the endtime'''
-    return dateutil.parser.parse(obj.get('_source', {}).get('endtime'))
+    return hash_order.sort_by_endtime(obj_dict)
 
 def get_hash(es_obj):
     '''retrieves the full_id_hash. if it doesn't exists, it
@@ -374,8 +410,7 @@ def get_objects(object_type, aoi, track_number=False):
     starttime = aoi.get('_source', {}).get('starttime')
     endtime = aoi.get('_source', {}).get('endtime')
     location = aoi.get('_source', {}).get('location')
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, idx)
+    grq_url = grq.get_search_url(idx)
     track_field = 'track_number'
     if object_type == 'slc' and track_number:
         track_field = 'trackNumber'
@@ -389,53 +424,25 @@ def get_objects(object_type, aoi, track_number=False):
                      "filter":{"bool":{"must":[{"range":{"endtime":{"gte":starttime}}},
                      {"range":{"starttime":{"lte":endtime}}}]}}}},
                      "from":0,"size":1000}
+    if object_type == 'acq-list' and hash_order.get_sort():
+        grq_query['sort'] = hash_order.get_sort() #acq-lists arrive in report order
+    if object_type == 'audit_trail':
+        audit_trail = audit_prefetch.get(aoi.get('_source').get('id'), track_number)
+        if audit_trail is not None:
+            return audit_trail
     if object_type == 'audit_trail' or object_type == 'aoi_track':
         grq_query = {"query":{"bool":{"must":[{"term":{"metadata.aoi.raw": aoi.get('_source').get('id')}},{"term":{"metadata.track_number": track_number}}]}},"from":0,"size":1000}
-    results = query_es(grq_url, grq_query)
+        return grq.query_es(grq_url, grq_query)
+    results = grq.query_es_windowed(grq_url, grq_query, starttime, endtime)
     return results
 
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in list(es_query.keys()):
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10
-        es_query['size'] = iterator_size
-    if 'from' in list(es_query.keys()):
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    #run the query and iterate until all the results have been returned
-    #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    #print('status code: {}'.format(response.status_code))
-    #print('response text: {}'.format(response.text))
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
-
 def get_aoi(aoi_id, aoi_index):
     '''
     retrieves the AOI from ES
     '''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, aoi_index)
+    grq_url = grq.get_search_url(aoi_index)
     es_query = {"query":{"bool":{"must":[{"term":{"id.raw":aoi_id}}]}}}
-    result = query_es(grq_url, es_query)
+    result = grq.query_es(grq_url, es_query)
     if len(result) < 1:
         raise Exception('Found no results for AOI: {}'.format(aoi_id))
     return result[0]
@@ -452,4 +459,10 @@ def load_context():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grq_url', help='GRQ endpoint, defaults to $GRQ_URL or the hysds celery GRQ_ES_URL')
+    args = parser.parse_args()
+    try:
+        main(grq_url=args.grq_url)
+    finally:
+        grq.write_metrics('ops_report')
@@ -2,22 +2,27 @@
 from __future__ import print_function
 from builtins import str
 from builtins import range
+import os
 import json
-import urllib3
 import hashlib
 import datetime
-import requests
 import argparse
 import dateutil.parser
-from hysds.celery import app
-from hysds_commons.net_utils import get_container_host_ip
+import slc_index
+import email_delta
+import email_attachment
+import audit_prefetch
+import doc_cache
+import hash_order
+import product_store
+import profiling
+import grq
 
 import smtplib
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from email.mime.application import MIMEApplication
 
 VERSION = 'v2.0'
 PRODUCT_NAME = 'AOI_Ops_Report-{}-TN{}-{}-{}'
@@ -34,94 +39,164 @@ IDX_DCT = {
     'aoi_track': 'grq_*_s1-gunw-aoi_track'
 }
 
-
-def generate_aoi_track_report(aoi_idx, aoi_id):
+HASH_FIELD = 'metadata.full_id_hash'
+# the only acq-list fields needed to compute the summary counts
+SUMMARY_SOURCE_FIELDS = ['id', 'metadata.full_id_hash', 'metadata.master_scenes', 'metadata.slave_scenes',
+                         'metadata.reference_scenes', 'metadata.secondary_scenes']
+# the acq-list fields the report rows of a track with gaps need, on top of the summary fields
+GAP_SOURCE_FIELDS = SUMMARY_SOURCE_FIELDS + ['starttime', 'endtime', 'creation_timestamp']
+GAP_PAGE_SIZE = 1000
+
+FONT_FAMILY = 'Arial, Helvetica, sans-serif'
+CELL_STYLE = {
+    'border': '1px solid #dddddd',
+    'text-align': 'left',
+    'padding': '5px',
+    'font-size': '10px',
+    'font-family': FONT_FAMILY
+}
+ALT_ROW_COLOR = '#dddddd'
+# shared style block of the compact markup. cellpadding & bgcolor attributes are kept on the tables & alternate rows
+# as a fallback for mail clients that strip <style>
+STYLE_BLOCK = '<style>.r th,.r td{{{cell}}}h3,p{{font-family:{font};}}p{{font-size:12px;}}</style>'.format(
+    cell=''.join('{}:{};'.format(key, value) for key, value in CELL_STYLE.items()), font=FONT_FAMILY)
+# inline styles on every element instead of the style block, for clients that need them
+_html = {'inline_styles': False}
+# html over the limit is sent as a summary, with the table rows streamed into an attachment as they are generated
+DEFAULT_MAX_EMAIL_KB = 1024
+_detail = {'writer': None}
+
+
+def generate_aoi_track_report(aoi_idx, aoi_id, summary_mode=False, delta=None):
     """
     Queries for relevant products & builds the report by track.
     :param aoi_idx, str, ES index for AOI's
     :param aoi_id: area of interest id in elasticsearch, ex. AOI_monitoring_hawaiian_chain_tn124_hawaii
+    :param summary_mode: bool, if True only pulls full documents for tracks the summary counts show gaps for
+    :param delta: dict, delta from email_delta.new_delta to only report new & resolved rows, None for all rows
     :return: str, html with consisting of 2 <table>'s
     """
     if not aoi_id or not aoi_idx:
         raise Exception('invalid inputs of aoi_id: {}, aoi_index: {}'.format(aoi_id, aoi_idx))
 
     aoi = get_aoi(aoi_id, aoi_idx)
-    track_acq_lists = sort_by_track(get_objects('acq-list', aoi))
+    if summary_mode:
+        tracks = sorted(get_term_set('acq-list', aoi, False, 'metadata.track_number'))
+    else:
+        tracks = list(sort_by_track(get_objects('acq-list', aoi)).keys())
 
     html_email_template = ''
-    for track in list(track_acq_lists.keys()):
+    for track in tracks:
+        profiling.reset()
+        if summary_mode:
+            summary = get_track_summary(aoi, track)
+            print('track {} summary: {}'.format(track, json.dumps(summary)))
+            if not summary['has_gaps']:
+                html_email_template += generate_resolved_track(aoi_id, track, delta)
+                continue  # nothing to report on, skip pulling the full documents
+
         acqs = get_objects('acq', aoi, track)
         slcs = get_objects('slc', aoi, track)
 
         audit_trail = get_objects('audit_trail', aoi, track)
         if len(audit_trail) < 1:
             print('no audit trail products found for track {}'.format(track))
+            html_email_template += generate_resolved_track(aoi_id, track, delta)
             continue
         else:
             print('Generating report for track: {}'.format(track))
 
-        allowed_hashes = list(set(store_by_hash(audit_trail).keys()))  # allow only hashes foud in audit-trail
-        acq_lists = filter_hashes(get_objects('acq-list', aoi, track), allowed_hashes)
+        allowed_hashes = set(store_by_hash(audit_trail).keys())  # allow only hashes foud in audit-trail
+        if summary_mode:  # the track has gaps, re-fetch only the acq-list fields of the report rows
+            acq_lists = get_objects('acq-list', aoi, track, source_fields=GAP_SOURCE_FIELDS, page_size=GAP_PAGE_SIZE)
+        else:
+            acq_lists = get_objects('acq-list', aoi, track)
+        acq_lists = filter_hashes(acq_lists, allowed_hashes)
         ifg_cfgs = filter_hashes(get_objects('ifg-cfg', aoi, track), allowed_hashes)
         ifgs = filter_hashes(get_objects('ifg', aoi, track), allowed_hashes)
         aoi_tracks = get_objects('aoi_track', aoi, track)
 
         now = datetime.datetime.now().strftime('%Y%m%dT%H%M')
         product_id = PRODUCT_NAME.format(aoi_id, track, now, VERSION)
-        aoi_track_html = generate(aoi_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks)
+        aoi_track_html = generate(aoi_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks,
+                                  delta=delta)
 
         html_email_template += aoi_track_html
         print('generated {} for track: {}'.format(product_id, track))
+        profiling.log_report(product_id)
     return html_email_template
 
 
-def generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks):
-    """generates an enumeration comparison report for the given aoi & track"""
-    acq_dct = store_by_id(acqs)
-    acq_map_dct = store_by_slc_id(acqs)
-    slc_dct = store_by_id(slcs)
-    acq_list_dct = store_by_hash(acq_lists)  # converts dict where key is hash of master/slave slc ids
-    ifg_cfg_dct = store_by_hash(ifg_cfgs)  # converts dict where key is hash of master/slave slc ids
-    ifg_dct = store_by_hash(ifgs)  # converts dict where key is hash of master/slave slc ids
-    aoi_track_dct = store_by_gunw(aoi_tracks)
-
-    missing_slcs_data = generate_missing_slcs_data(slc_dct, acq_lists)  # get missing SLCs data
-    # generate data for the product status report
-    product_status_data, product_status_summary = generate_product_status_data(acq_list_dct, ifg_cfg_dct, ifg_dct,
-                                                                               slc_dct, acq_map_dct, aoi_track_dct)
-
-    if len(product_status_data) == 0 and len(missing_slcs_data) == 0:
-        return ''  # returning nothing because there is nothing to report on
-
-    aoi_html_report = '<h3 style="font-family:Arial, Helvetica, sans-serif;">{track}</h3>'.format(track=product_id)
-
-    if missing_slcs_data:
-        missing_slcs_html_table = create_html_table(['Missing SLCs'], missing_slcs_data)
-        aoi_html_report += missing_slcs_html_table
-
-    if product_status_data:
-        title = ['Date Pair', 'Missing ACQ IDs', 'Acquisition-List', 'Missing SLC IDs', 'IFG-CFG', 'GUNW']
-        product_status_html_table = create_html_table(title, product_status_data, product_status_summary)
-        aoi_html_report += product_status_html_table
+def generate(product_id, aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, aoi_tracks, delta=None):
+    """generates an enumeration comparison report for the given aoi & track, only the new & resolved rows if given
+    the delta of the run"""
+    for object_type, obj_list in (('acq', acqs), ('slc', slcs), ('acq-list', acq_lists), ('ifg-cfg', ifg_cfgs),
+                                  ('ifg', ifgs), ('audit_trail', audit_trail), ('aoi_track', aoi_tracks)):
+        profiling.count_documents(object_type, len(obj_list))
+    with profiling.phase('hash_index'):
+        acq_dct = store_by_id(acqs)
+        acq_map_dct = store_by_slc_id(acqs)
+        slc_dct = store_by_id(slcs)
+        acq_list_dct = store_by_hash(acq_lists)  # converts dict where key is hash of master/slave slc ids
+        ifg_cfg_dct = store_by_hash(ifg_cfgs)  # converts dict where key is hash of master/slave slc ids
+        ifg_dct = store_by_hash(ifgs)  # converts dict where key is hash of master/slave slc ids
+        aoi_track_dct = store_by_gunw(aoi_tracks)
+        hash_list = sort_into_hash_list(acq_list_dct)  # acq-list hashes by endtime, once per track
+        if not product_store.enabled():
+            slc_idx = slc_index.build_slc_index(acq_list_dct, slc_dct)  # referenced & missing slcs by acq-list hash
+    if product_store.enabled():
+        slc_idx = product_store.sync_track(aoi.get('_id'), track, get_hash, slcs, acq_lists)  # joined in sqlite
+
+    with profiling.phase('html'):
+        missing_slcs_data = generate_missing_slcs_data(slc_idx)  # get missing SLCs data
+        # generate data for the product status report
+        row_status = {}
+        product_status_data, product_status_summary = generate_product_status_data(acq_list_dct, ifg_cfg_dct,
+                                                                                   ifg_dct, slc_idx, acq_map_dct,
+                                                                                   aoi_track_dct, row_status,
+                                                                                   hash_list)
+        if delta is not None:
+            return generate_delta(product_id, track, delta, missing_slcs_data, product_status_data, row_status,
+                                  acq_list_dct, slc_idx)
+
+        if len(product_status_data) == 0 and len(missing_slcs_data) == 0:
+            return ''  # returning nothing because there is nothing to report on
+
+        aoi_html_report = create_html_heading(product_id)
+
+        if missing_slcs_data:
+            missing_slcs_html_table = create_report_table(product_id, track, ['Missing SLCs'], missing_slcs_data)
+            aoi_html_report += missing_slcs_html_table
+
+        if product_status_data:
+            title = ['Date Pair', 'Missing ACQ IDs', 'Acquisition-List', 'Missing SLC IDs', 'IFG-CFG', 'GUNW']
+            product_status_html_table = create_report_table(product_id, track, title, product_status_data,
+                                                            product_status_summary)
+            aoi_html_report += product_status_html_table
 
     return aoi_html_report
 
 
-def generate_product_status_data(acq_list_dict, ifg_cfg_dct, ifg_dct, slc_dct, acq_map_dct, aoi_track_dct):
+def generate_product_status_data(acq_list_dict, ifg_cfg_dct, ifg_dct, slc_idx, acq_map_dct, aoi_track_dct,
+                                 row_status=None, hash_list=None):
     """
     generate the sheet for enumerated products
     :param acq_list_dict: dict type,
     :param ifg_cfg_dct: dict type,
     :param ifg_dct: dict type,
-    :param slc_dct: dict type,
+    :param slc_idx: dict type, slc index from slc_index.build_slc_index
     :param acq_map_dct: dict type,
     :param aoi_track_dct: dict type,
+    :param row_status: dict type, if given filled with the email_delta status of each row by hash, in row order
+    :param hash_list: list type, acq-list hashes in row order, sorted by endtime if not given
     :return: list[list[]], list[]  # main report data and summary row
     """
     grey_list, black_list = pull_black_and_grey_list()  # pulling black and grey lists to compare missing GUNWs to
 
     report_rows = []
-    for id_hash in sort_into_hash_list(acq_list_dict):
+    if hash_list is None:
+        hash_list = sort_into_hash_list(acq_list_dict)
+    for id_hash in hash_list:
         acq_list = acq_list_dict.get(id_hash, {})
         ifg_cfg = ifg_cfg_dct.get(id_hash, {})
         ifg_cfg_id = ifg_cfg.get('_id', 'MISSING')
@@ -131,24 +206,17 @@ def generate_product_status_data(acq_list_dict, ifg_cfg_dct, ifg_dct, slc_dct, a
         ifg_id = ifg.get('_id', 'MISSING')
         aoi_track_id = aoi_track_dct.get(ifg_id, 'MISSING')
 
-        missing_slcs = []
-        missing_acqs = []
-
-        acq_list_slcs = acq_list.get('_source', {}).get('metadata', {}).get('master_scenes', {}) + \
-                        acq_list.get('_source', {}).get('metadata', {}).get('slave_scenes', {})
-
-        for slc_id in acq_list_slcs:
-            if not slc_dct.get(slc_id, False):
-                missing_slcs.append(slc_id)
-                missing_acq = acq_map_dct.get(slc_id, False)
-                if missing_acq:
-                    missing_acq_id = missing_acq.get('_id')
-                    missing_acqs.append(missing_acq_id)
+        missing_slcs = slc_index.get_missing_slcs(slc_idx, id_hash)
+        missing_acqs = slc_index.get_missing_acqs(slc_idx, id_hash, acq_map_dct)
 
         missing_slc_str = ', '.join(missing_slcs)
         missing_acq_str = ', '.join(missing_acqs)
         if ifg_cfg_id == 'MISSING' or ifg_id == 'MISSING' or len(missing_acqs) > 0 or len(missing_slcs) > 0:
             # [date_pair, acq_list_id, ifg_cfg_id, ifg_id, id_hash, missing_slc_str, missing_acq_str, aoi_track_id]
+            if row_status is not None:
+                row_status[id_hash] = email_delta.gen_status(missing_acqs, missing_slcs, ifg_cfg_id == 'MISSING',
+                                                             ifg_id == 'MISSING', id_hash in grey_list,
+                                                             id_hash in black_list)
             if id_hash in grey_list:
                 ifg_id = '<strong>GREYLIST</strong>'
             elif id_hash in black_list:
@@ -168,6 +236,161 @@ def generate_product_status_data(acq_list_dict, ifg_cfg_dct, ifg_dct, slc_dct, a
     return report_rows, numerical_summary_row
 
 
+def generate_delta(product_id, track, delta, missing_slcs_data, product_status_data, row_status, acq_list_dct,
+                   slc_idx):
+    """
+    records the outstanding rows of the track in the delta & generates the html of the new & resolved rows
+    :param product_id: str, aoi id
+    :param track: int, track number
+    :param delta: dict, from email_delta.new_delta
+    :param missing_slcs_data: list[str], missing slc ids
+    :param product_status_data: list[list[]], product status rows
+    :param row_status: dict, status of each product status row by acq-list hash, in row order
+    :param acq_list_dct: dict, acq-lists by hash
+    :param slc_idx: dict, slc index from slc_index.build_slc_index
+    :return: str, html
+    """
+    key = email_delta.track_key(product_id, track)
+    previous = delta['previous'].get(key, {})
+    slc_status = dict((email_delta.slc_hash(slc_id), email_delta.SLC_STATUS) for slc_id in missing_slcs_data)
+    if slc_status or row_status:
+        delta['current'][key] = {'slcs': slc_status, 'products': row_status}
+    new_slcs, resolved_slcs, unchanged_slcs = email_delta.diff(previous.get('slcs', {}), slc_status)
+    new_rows, resolved_rows, unchanged_rows = email_delta.diff(previous.get('products', {}), row_status)
+    if not new_slcs and not resolved_slcs and not new_rows and not resolved_rows:
+        return generate_unchanged_counts(product_id, track, unchanged_slcs, unchanged_rows)
+
+    aoi_html_report = create_html_heading(product_id)
+    aoi_html_report += generate_unchanged_counts(product_id, track, unchanged_slcs, unchanged_rows, title=False)
+    new_slc_data = [slc_id for slc_id in missing_slcs_data if email_delta.slc_hash(slc_id) in new_slcs]
+    aoi_html_report += create_report_table(product_id, track, ['New Missing SLCs'], new_slc_data)
+    slc_ids = dict((email_delta.slc_hash(slc_id), slc_id) for slc_id in slc_idx.get('referenced'))
+    aoi_html_report += create_report_table(product_id, track, ['Resolved Missing SLCs'],
+                                           sorted(slc_ids.get(slc_hash, slc_hash) for slc_hash in resolved_slcs))
+    title = ['Date Pair', 'Missing ACQ IDs', 'Acquisition-List', 'Missing SLC IDs', 'IFG-CFG', 'GUNW']
+    new_row_data = [row for id_hash, row in zip(row_status, product_status_data) if id_hash in new_rows]
+    aoi_html_report += create_report_table(product_id, track, ['New: {}'.format(title[0])] + title[1:],
+                                           new_row_data)
+    resolved_row_data = []
+    for id_hash in resolved_rows:
+        acq_list = acq_list_dct.get(id_hash)
+        date_pair = gen_date_pair(acq_list) if acq_list else ''
+        acq_list_id = acq_list.get('_id') if acq_list else id_hash
+        status = email_delta.describe_status(previous['products'][id_hash])
+        resolved_row_data.append([date_pair, acq_list_id, status])
+    aoi_html_report += create_report_table(product_id, track, ['Resolved: Date Pair', 'Acquisition-List',
+                                                               'Previously'], sorted(resolved_row_data))
+    return aoi_html_report
+
+
+def generate_resolved_track(aoi_id, track, delta):
+    """
+    generates the html of a track without outstanding rows, listing the count of rows resolved since the last run
+    :param aoi_id: str, aoi id
+    :param track: int, track number
+    :param delta: dict, from email_delta.new_delta, or None
+    :return: str, html
+    """
+    if delta is None:
+        return ''
+    previous = delta['previous'].get(email_delta.track_key(aoi_id, track), {})
+    resolved = len(previous.get('slcs', {})) + len(previous.get('products', {}))
+    if resolved == 0:
+        return ''
+    return create_html_paragraph('{} track {}: all {} previously outstanding rows resolved'.format(aoi_id, track,
+                                                                                                   resolved))
+
+
+def generate_unchanged_counts(aoi_id, track, unchanged_slcs, unchanged_rows, title=True):
+    """
+    generates the html line counting the rows still outstanding since the last run
+    :param aoi_id: str, aoi id
+    :param track: int, track number
+    :param unchanged_slcs: int, unchanged missing slc rows
+    :param unchanged_rows: int, unchanged product status rows
+    :param title: bool, if True the line is prefixed by the aoi & track
+    :return: str, html
+    """
+    if unchanged_slcs == 0 and unchanged_rows == 0:
+        return ''
+    prefix = '{} track {}: '.format(aoi_id, track) if title else ''
+    return create_html_paragraph('{}{} missing SLCs & {} product rows unchanged since the last report'.format(
+        prefix, unchanged_slcs, unchanged_rows))
+
+
+def get_track_summary(aoi, track):
+    """
+    computes the product counts for the aoi & track from ES aggregations & hash set comparisons, only the
+    scene lists of the acquisition-lists are pulled
+    :param aoi: dict, AOI object from elasticsearch
+    :param track: int, track number
+    :return: dict, counts of acq-lists, ifg-cfgs, GUNWs & missing products for the track
+    """
+    allowed_hashes = get_hash_set('audit_trail', aoi, track)  # allow only hashes found in audit-trail
+    acq_lists = filter_hashes(get_objects('acq-list', aoi, track, source_fields=SUMMARY_SOURCE_FIELDS),
+                              allowed_hashes)
+    acq_list_dct = dict((get_hash(acq_list), acq_list) for acq_list in acq_lists)
+    acq_list_hashes = set(acq_list_dct.keys())
+    ifg_cfg_hashes = get_hash_set('ifg-cfg', aoi, track) & acq_list_hashes
+    ifg_hashes = get_hash_set('ifg', aoi, track) & acq_list_hashes
+    slc_idx = slc_index.build_slc_index(acq_list_dct, get_term_set('slc', aoi, track, 'id.raw'))
+
+    summary = {
+        'acq-lists': len(acq_list_hashes),
+        'ifg-cfgs': len(ifg_cfg_hashes),
+        'gunws': len(ifg_hashes),
+        'missing_slcs': len(slc_idx.get('missing')),
+        'missing_ifg-cfgs': len(acq_list_hashes - ifg_cfg_hashes),
+        'missing_gunws': len(acq_list_hashes - ifg_hashes)
+    }
+    summary['has_gaps'] = summary['missing_slcs'] + summary['missing_ifg-cfgs'] + summary['missing_gunws'] > 0
+    return summary
+
+
+def get_term_set(object_type, aoi, track_number, field):
+    """
+    returns the set of unique values of the field over the matching objects, using a terms aggregation
+    :param object_type: str, key in IDX_DCT
+    :param aoi: dict, AOI object from elasticsearch
+    :param track_number: int or False
+    :param field: str, not analyzed field to aggregate on
+    :return: set
+    """
+    grq_url, es_query = build_objects_query(object_type, aoi, track_number)
+    es_query['aggs'] = {'terms': {'terms': {'field': field, 'size': 0}}}
+    aggs = grq.query_es_aggs(grq_url, es_query)
+    return set(bucket['key'] for bucket in aggs['terms']['buckets'])
+
+
+def get_hash_set(object_type, aoi, track_number):
+    """
+    returns the set of full_id_hashes of the matching objects, using a terms aggregation. documents that don't
+    store a full_id_hash are pulled with only their scene lists & hashed locally
+    :param object_type: str, key in IDX_DCT
+    :param aoi: dict, AOI object from elasticsearch
+    :param track_number: int
+    :return: set[str]
+    """
+    if object_type == 'audit_trail':
+        audit_trail = audit_prefetch.get(aoi.get('_source').get('id'), track_number)
+        if audit_trail is not None:
+            return set(get_hash(obj) for obj in audit_trail)
+    grq_url, es_query = build_objects_query(object_type, aoi, track_number)
+    es_query['aggs'] = {
+        'hashes': {'terms': {'field': HASH_FIELD, 'size': 0}},
+        'no_hash': {'missing': {'field': HASH_FIELD}}
+    }
+    aggs = grq.query_es_aggs(grq_url, es_query)
+    hashes = set(bucket['key'] for bucket in aggs['hashes']['buckets'])
+
+    if aggs['no_hash']['doc_count'] > 0:
+        grq_url, es_query = build_objects_query(object_type, aoi, track_number)
+        es_query['query'] = {'filtered': {'query': es_query['query'], 'filter': {'missing': {'field': HASH_FIELD}}}}
+        es_query['_source'] = SUMMARY_SOURCE_FIELDS
+        hashes.update(get_hash(obj) for obj in grq.query_es(grq_url, es_query))
+    return hashes
+
+
 def pull_black_and_grey_list():
     '''
     pulling all grey and blacklist products from GRQ
@@ -186,12 +409,10 @@ def pull_black_and_grey_list():
       }
     }
 
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, greylist_index)
-    grey_list = query_es(grq_url, es_query)
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, blacklist_index)
-    black_list = query_es(grq_url, es_query)
+    grq_url = grq.get_search_url(greylist_index)
+    grey_list = grq.query_es(grq_url, es_query)
+    grq_url = grq.get_search_url(blacklist_index)
+    black_list = grq.query_es(grq_url, es_query)
 
     black_list = {row['fields']['metadata.full_id_hash'][0] for row in black_list}
     grey_list = {row['fields']['metadata.full_id_hash'][0] for row in grey_list}
@@ -199,25 +420,13 @@ def pull_black_and_grey_list():
     return grey_list, black_list
 
 
-def generate_missing_slcs_data(slc_dct, acq_lists):
+def generate_missing_slcs_data(slc_idx):
     """
     generates the sheet for missing slcs
-    :param slc_dct:
-    :param acq_lists:
-    :return: str, html string for the missing SLCs table
+    :param slc_idx: dict, slc index from slc_index.build_slc_index
+    :return: list[str], missing slc ids
     """
-    missing = []
-    for acq_list in acq_lists:
-        master_scenes = acq_list.get('_source', {}).get('metadata', {}).get('master_scenes', [])
-        slave_scenes = acq_list.get('_source', {}).get('metadata', {}).get('slave_scenes', [])
-        all_scenes = master_scenes + slave_scenes
-
-        for slc_id in all_scenes:
-            if slc_dct.get(slc_id, False) is False:
-                missing.append(slc_id)
-
-    missing = list(set(missing))
-    return missing
+    return sorted(slc_idx.get('missing'))
 
 
 def filter_hashes(obj_list, allowed_hashes):
@@ -235,13 +444,14 @@ def store_by_hash(obj_list):
     result_dict = {}
     for obj in obj_list:
         full_id_hash = get_hash(obj)
-        if full_id_hash in list(result_dict.keys()):
+        if full_id_hash in result_dict:
             result_dict[full_id_hash] = get_most_recent(obj, result_dict.get(full_id_hash))
         else:
             result_dict[full_id_hash] = obj
     return result_dict
 
 
+@profiling.timed('date_parse')
 def get_most_recent(obj1, obj2):
     """returns the object with the most recent ingest time"""
     ctime1 = dateutil.parser.parse(obj1.get('_source', {}).get('creation_timestamp', False))
@@ -314,6 +524,7 @@ def get_track(es_obj):
     raise Exception('unable to find track for: {}'.format(es_obj.get('_id', '')))
 
 
+@profiling.timed('date_parse')
 def gen_date_pair(obj):
     """returns the date pair string for the input object"""
     st = dateutil.parser.parse(obj.get('_source').get('starttime')).strftime('%Y%m%d')
@@ -323,13 +534,7 @@ def gen_date_pair(obj):
 
 def sort_into_hash_list(obj_dict):
     """builds a list of hashes where the hashes are sorted by the objects endtime"""
-    sorted_obj = sorted(list(obj_dict.keys()), key=lambda x: get_endtime(obj_dict.get(x)), reverse=True)
-    return sorted_obj  # [obj.get('_source', {}).get('metadata', {}).get('full_id_hash', '') for obj in sorted_obj]
-
-
-def get_endtime(obj):
-    """returns the endtime"""
-    return dateutil.parser.parse(obj.get('_source', {}).get('endtime'))
+    return hash_order.sort_by_endtime(obj_dict)
 
 
 def get_hash(es_obj):
@@ -366,17 +571,45 @@ def gen_hash(es_obj):
     return id_hash
 
 
-def get_objects(object_type, aoi, track_number=False):
+def get_objects(object_type, aoi, track_number=False, source_fields=None, page_size=None):
     """
     returns all objects of the object type ['ifg, acq-list, 'ifg-blacklist'] that intersect both
     temporally and spatially with the aoi
+    :param source_fields: list[str], if given only these _source fields are returned
+    :param page_size: int, if given the objects are paged by from/size in pages of this many objects
+    """
+    grq_url, grq_query = build_objects_query(object_type, aoi, track_number)
+    if source_fields:
+        grq_query['_source'] = source_fields
+    if page_size:
+        grq_query.update({'from': 0, 'size': page_size})
+    if object_type == 'acq-list' and hash_order.get_sort():
+        grq_query['sort'] = hash_order.get_sort()  # acq-lists arrive in report order
+    if object_type == 'audit_trail':
+        audit_trail = audit_prefetch.get(aoi.get('_source').get('id'), track_number)
+        if audit_trail is not None:
+            return audit_trail
+    if object_type == 'audit_trail' or object_type == 'aoi_track':
+        return grq.query_es(grq_url, grq_query)
+    starttime = aoi.get('_source', {}).get('starttime')
+    endtime = aoi.get('_source', {}).get('endtime')
+    if doc_cache.enabled() and not source_fields:  # only full documents are cached
+        return doc_cache.fetch(grq_url, grq_query,
+                               lambda es_query: grq.query_es_windowed(grq_url, es_query, starttime, endtime))
+    results = grq.query_es_windowed(grq_url, grq_query, starttime, endtime)
+    return results
+
+
+def build_objects_query(object_type, aoi, track_number=False):
+    """
+    builds the query for all objects of the object type that intersect both temporally and spatially with the aoi
+    :return: str, dict  # search url and es query
     """
     idx = IDX_DCT.get(object_type)  # determine index
     starttime = aoi.get('_source', {}).get('starttime')
     endtime = aoi.get('_source', {}).get('endtime')
     location = aoi.get('_source', {}).get('location')
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, idx)
+    grq_url = grq.get_search_url(idx)
     track_field = 'track_number'
     if object_type == 'slc' and track_number:
         track_field = 'trackNumber'
@@ -426,48 +659,12 @@ def get_objects(object_type, aoi, track_number=False):
             "size": 1000
         }
 
-    results = query_es(grq_url, grq_query)
-    return results
-
-
-def query_es(grq_url, es_query):
-    """
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    """
-    # make sure the fields from & size are in the es_query
-    if 'size' in list(es_query.keys()):
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10
-        es_query['size'] = iterator_size
-    if 'from' in list(es_query.keys()):
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-
-    return results_list
+    return grq_url, grq_query
 
 
 def get_aoi(aoi_id, index):
     'retrieves the AOI from ES'
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, index)
+    grq_url = grq.get_search_url(index)
     es_query = {
         "query": {
             "bool": {
@@ -478,7 +675,7 @@ def get_aoi(aoi_id, index):
         }
     }
 
-    result = query_es(grq_url, es_query)
+    result = grq.query_es(grq_url, es_query)
     if len(result) < 1:
         raise Exception('Found no results for AOI: {}'.format(aoi_id))
     return result[0]
@@ -497,8 +694,7 @@ def load_context():
 
 
 def get_all_aois(es_index):
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, es_index)
+    grq_url = grq.get_search_url(es_index)
 
     es_query = {
         "size": 1000,
@@ -512,7 +708,7 @@ def get_all_aois(es_index):
         }
     }
 
-    res = query_es(grq_url, es_query)
+    res = grq.query_es(grq_url, es_query)
     list_aoi = [row['fields']['_id'] for row in res]
     return list_aoi
 
@@ -530,66 +726,121 @@ def dict_to_inline_style(css_styles):
     return inline_styles
 
 
-def create_html_table_header(header):
-    style_dict = {
-        'border': '1px solid #dddddd',
-        'text-align': 'left',
-        'padding': '5px',
-        'font-size': '10px',
-        'font-family': 'Arial, Helvetica, sans-serif'
-    }
-    inline_style = dict_to_inline_style(style_dict)
+def set_inline_styles(inline_styles):
+    """
+    sets whether the html is styled inline on every element, or by the shared style block
+    :param inline_styles: bool
+    """
+    _html['inline_styles'] = inline_styles
 
-    html_string = '<tr>'
-    for cell in header:
-        html_string += '<th style=' + inline_style + '>' + str(cell) + '</th>\n'
-    return html_string
+
+def create_html_document(body):
+    """
+    wraps the report body in the html document, with the shared style block unless styled inline
+    :param body: str, html
+    :return: str, html document
+    """
+    if _html['inline_styles']:
+        return '<html> <div style="padding:10px;">' + body + '</html>'
+    return '<html><head>' + STYLE_BLOCK + '</head><body><div style="padding:10px;">' + body + '</div></body></html>'
+
+
+def create_html_heading(text):
+    if _html['inline_styles']:
+        return '<h3 style="font-family:{};">{}</h3>'.format(FONT_FAMILY, text)
+    return '<h3>{}</h3>'.format(text)
+
+
+def create_html_paragraph(text):
+    if _html['inline_styles']:
+        return '<p style="font-family:{};font-size:12px;">{}</p>\n'.format(FONT_FAMILY, text)
+    return '<p>{}</p>\n'.format(text)
+
+
+def create_html_table_header(header):
+    th = '<th style=' + dict_to_inline_style(CELL_STYLE) + '>' if _html['inline_styles'] else '<th>'
+    return '<tr>' + ''.join(th + str(cell) + '</th>\n' for cell in header)
 
 
 def create_html_table_row(row, counter):
-    style_dict = {
-        'border': '1px solid #dddddd',
-        'text-align': 'left',
-        'padding': '5px',
-        'font-size': '10px',
-        'font-family': 'Arial, Helvetica, sans-serif'
-    }
-    html_string = '<tr>' if counter % 2 == 0 else '<tr style="background-color:#dddddd">'
-    td_style = dict_to_inline_style(style_dict)
+    if _html['inline_styles']:
+        tr = '<tr>' if counter % 2 == 0 else '<tr style="background-color:{}">'.format(ALT_ROW_COLOR)
+        td = '<td style=' + dict_to_inline_style(CELL_STYLE) + '>'
+    else:
+        tr = '<tr>' if counter % 2 == 0 else '<tr bgcolor="{}">'.format(ALT_ROW_COLOR)
+        td = '<td>'
+    return tr + ''.join(td + str(cell) + '</td>\n' for cell in row) + '</tr>\n'
 
-    for cell in row:
-        html_string += '<td style=' + td_style + '>' + str(cell) + '</td>\n'
-    html_string += '</tr>\n'
-    return html_string
 
+def set_detail_writer(writer):
+    """
+    sets the email_attachment.detail_writer recording the rows of every report table, None to stop recording
+    :param writer: email_attachment.detail_writer
+    """
+    _detail['writer'] = writer
 
-def create_html_table(header, data, summary_row=[]):
-    html_rows = ''
 
-    if len(data) > 0:
-        html_rows += '<table>'
-        html_rows += create_html_table_header(header)
-        if summary_row:
-            html_rows += create_html_table_header(summary_row)
+def create_report_table(aoi_id, track, header, data, summary_row=[]):
+    """
+    creates the html table of the aoi & track, recording its rows in the detail attachment if one is being written
+    :param aoi_id: str, aoi id
+    :param track: int, track number
+    :param header: list[str], table header
+    :param data: list[list[]], table rows
+    :param summary_row: list[], summary row shown under the header
+    :return: str, html
+    """
+    if _detail['writer'] is not None:
+        _detail['writer'].write(aoi_id, track, header, data)
+    return create_html_table(header, data, summary_row)
+
 
-        counter = 1
-        for row in data:
-            row = [row] if type(row) != list else row
-            html_rows += create_html_table_row(row, counter)
-            counter += 1
-        html_rows += '</table><br>\n'
-    return html_rows
+def create_summary_html(writer, html_size, max_size):
+    """
+    creates the html summary of the row counts per aoi & table, sent in place of an oversized report
+    :param writer: email_attachment.detail_writer, holding the row counts & attachment filename
+    :param html_size: int, size of the full html report in bytes
+    :param max_size: int, email size limit in bytes
+    :return: str, html
+    """
+    tables = []
+    for aoi_counts in writer.counts.values():
+        tables.extend(table for table in aoi_counts if table not in tables)
+    data = [[aoi_id] + [writer.counts[aoi_id].get(table, 0) for table in tables] for aoi_id in sorted(writer.counts)]
+    text = 'The full report ({:.0f} KB) exceeds the {:.0f} KB email limit. Its {} rows are attached as {}'.format(
+        html_size / 1024.0, max_size / 1024.0, writer.rows, os.path.basename(writer.filename))
+    return create_html_paragraph(text) + create_html_table(['AOI'] + tables, data)
 
 
-def send_email(html_content, sender, receiver, subject):
-    msg = MIMEMultipart('alternative')
+def create_html_table(header, data, summary_row=[]):
+    if len(data) == 0:
+        return ''
+    html_rows = ['<table>' if _html['inline_styles'] else '<table class="r" cellpadding="5">',
+                 create_html_table_header(header)]
+    if summary_row:
+        html_rows.append(create_html_table_header(summary_row))
+    for counter, row in enumerate(data, 1):
+        row = [row] if type(row) != list else row
+        html_rows.append(create_html_table_row(row, counter))
+    html_rows.append('</table><br>\n')
+    return ''.join(html_rows)
+
+
+def send_email(html_content, sender, receiver, subject, attachment=None):
+    msg = MIMEMultipart('mixed' if attachment else 'alternative')
     msg['Subject'] = subject
     msg['From'] = sender
     msg['To'] = receiver
 
     email_message = MIMEText(html_content, 'html')
     msg.attach(email_message)
+    if attachment:
+        with open(attachment, 'rb') as fin:
+            attachment_part = MIMEApplication(fin.read(), Name=os.path.basename(attachment))
+        attachment_part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(attachment))
+        msg.attach(attachment_part)
 
+    from hysds_commons.net_utils import get_container_host_ip  # only needed when sending
     s = smtplib.SMTP(get_container_host_ip())  # "smtp://%s:25" % get_container_host_ip()
     s.sendmail(sender, receiver, msg.as_string())
     print("Email sent to: {}!".format(receiver))
@@ -599,26 +850,112 @@ def send_email(html_content, sender, receiver, subject):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--aoi_index')
+    parser.add_argument('--grq_url', help='GRQ endpoint, defaults to $GRQ_URL or the hysds celery GRQ_ES_URL')
+    parser.add_argument('--summary_mode', action='store_true',
+                        help='only pull full documents for tracks with gaps in their aggregated counts')
+    parser.add_argument('--delta_state', help='state file of the previous run, only new & resolved rows are emailed')
+    parser.add_argument('--inline_styles', action='store_true',
+                        help='style every html element inline instead of by a shared style block')
+    parser.add_argument('--max_email_kb', type=float, default=None,
+                        help='html size limit, larger reports are sent as a summary with the rows attached')
+    parser.add_argument('--attachment_format', choices=email_attachment.FORMATS, default=None,
+                        help='format of the attached rows of oversized reports, csv (gzipped) by default')
+    parser.add_argument('--audit_prefetch', action='store_true',
+                        help='fetch the audit trail of batches of AOIs in one query instead of per AOI & track')
+    parser.add_argument('--doc_cache_mb', type=float, default=None,
+                        help='approximate MB of product documents cached across the AOIs, 0 (default) disables')
+    parser.add_argument('--endtime_sort', action='store_true',
+                        help='query the acquisition-lists sorted on endtime, the order of the report rows')
+    parser.add_argument('--product_store', default=None,
+                        help='path of a local sqlite store of the slc ids & acquisition-list scenes, joined in sql')
+    parser.add_argument('--fetch_window', choices=grq.WINDOW_MODES, default=None,
+                        help='split the product queries into starttime windows, by month or adaptively sized')
+    parser.add_argument('--fetch_workers', type=int, default=None,
+                        help='number of windows queried concurrently, {} by default'.format(grq.WINDOW_WORKERS))
     args = parser.parse_args()
 
+    summary_mode = args.summary_mode
+    inline_styles = args.inline_styles
+    max_email_kb = args.max_email_kb
+    attachment_format = args.attachment_format
+    fetch_window = args.fetch_window
+    fetch_workers = args.fetch_workers
+    prefetch = args.audit_prefetch
+    doc_cache_mb = args.doc_cache_mb
+    endtime_sort = args.endtime_sort
+    store_path = args.product_store
+    ctx = {}
     if args.aoi_index:  # aoi index as python argument
         aoi_index = args.aoi_index
     else:  # handles on demand job submission
         ctx = load_context()
         aoi_index = ctx.get('aoi_index', False)
         aoi_index = ','.join(list(set(aoi_index)))
-
-    aoi_list = get_all_aois(aoi_index)
-    print(json.dumps(sorted(aoi_list), indent=2))
-
-    complete_aoi_reports = '<html> <div style="padding:10px;">'
-    for _id in sorted(aoi_list):
-        aoi_report_html = generate_aoi_track_report(aoi_index, _id)
-        complete_aoi_reports += aoi_report_html
-    complete_aoi_reports += '</html>'
-
-    current_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    email_subject_line = 'AOI Ops Report - {}'.format(current_timestamp)
-    email_sender = email_recipient = 'grfn-ops@jpl.nasa.gov'
-    send_email(complete_aoi_reports, email_sender, email_recipient, email_subject_line)
-    print("AOI Ops Report sent to {}!".format(email_recipient))
+        summary_mode = summary_mode or str(ctx.get('summary_mode', False)).lower() == 'true'
+        inline_styles = inline_styles or str(ctx.get('inline_styles', False)).lower() == 'true'
+        max_email_kb = max_email_kb or ctx.get('max_email_kb')
+        attachment_format = attachment_format or ctx.get('attachment_format')
+        fetch_window = fetch_window or ctx.get('fetch_window')
+        fetch_workers = fetch_workers or ctx.get('fetch_workers')
+        prefetch = prefetch or str(ctx.get('audit_prefetch', False)).lower() == 'true'
+        doc_cache_mb = doc_cache_mb or ctx.get('doc_cache_mb')
+        endtime_sort = endtime_sort or str(ctx.get('endtime_sort', False)).lower() == 'true'
+        store_path = store_path or ctx.get('product_store')
+    set_inline_styles(inline_styles)
+    profiling.configure_memory(ctx)  # memory profiling & budget from the context or environment
+    grq.set_grq_url(args.grq_url or ctx.get('grq_url'))
+    grq.configure_snapshot(ctx)
+    grq.set_fetch_window(fetch_window, fetch_workers)
+    doc_cache.configure(doc_cache_mb)
+    hash_order.set_endtime_sort(endtime_sort)
+    product_store.configure({'product_store': store_path} if store_path else {})
+    try:
+        delta_state = args.delta_state or ctx.get('delta_state')
+        delta = email_delta.new_delta(email_delta.load_state(delta_state)) if delta_state else None
+
+        aoi_list = get_all_aois(aoi_index)
+        print(json.dumps(sorted(aoi_list), indent=2))
+
+        current_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        max_email_size = float(max_email_kb or DEFAULT_MAX_EMAIL_KB) * 1024
+        attachment_name = 'AOI_Ops_Report-{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+        writer = email_attachment.detail_writer(attachment_name, attachment_format or 'csv')
+        set_detail_writer(writer)
+        aoi_reports = []
+        html_size = 0
+        try:
+            aoi_ids = audit_prefetch.batches(sorted(aoi_list)) if prefetch else sorted(aoi_list)
+            for _id in aoi_ids:
+                aoi_report_html = generate_aoi_track_report(aoi_index, _id, summary_mode=summary_mode, delta=delta)
+                html_size += len(aoi_report_html)
+                if html_size <= max_email_size:
+                    aoi_reports.append(aoi_report_html)
+                else:  # past the limit only the attachment is kept, its buffered rows are written out
+                    writer.open()
+        except Exception:
+            writer.discard()
+            raise
+        finally:
+            set_detail_writer(None)
+            writer.close()
+        attachment = None
+        if html_size > max_email_size:
+            print('report html of {} bytes exceeds the {:.0f} byte limit, attaching {}'.format(
+                html_size, max_email_size, writer.filename))
+            complete_aoi_reports = create_html_document(create_summary_html(writer, html_size, max_email_size))
+            attachment = writer.filename
+        else:
+            complete_aoi_reports = create_html_document(''.join(aoi_reports))
+
+        email_subject_line = 'AOI Ops Report - {}'.format(current_timestamp)
+        if delta is not None:
+            email_subject_line = 'AOI Ops Report (changes) - {}'.format(current_timestamp)
+        email_sender = email_recipient = 'grfn-ops@jpl.nasa.gov'
+        send_email(complete_aoi_reports, email_sender, email_recipient, email_subject_line, attachment=attachment)
+        print("AOI Ops Report sent to {}!".format(email_recipient))
+        if delta is not None:
+            email_delta.save_state(delta_state, delta['current'])  # only once sent, so no changes are lost
+        if doc_cache.enabled():
+            print('document cache: {}'.format(json.dumps(doc_cache.get_stats())))
+    finally:
+        grq.write_metrics('ops_report_email')
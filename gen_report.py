@@ -8,22 +8,26 @@ from builtins import range
 import os
 import re
 import json
-import requests
+import argparse
 from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor
 import dateutil.parser
-import urllib3
-#import gantt
-import coverage_chart
 import excel
-from hysds.celery import app
+import enumeration as enum_compare
+import profiling
+import artifact_cache
+import grq
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-def main():
+def main(grq_url=None, chart_workers=None):
     '''
     Determines the proper AOI, queries for relevant products & builds the report.
     '''
     ctx = load_context()
+    profiling.configure_memory(ctx)
+    artifact_cache.configure(ctx)
+    grq.set_grq_url(grq_url or ctx.get('grq_url'))
+    grq.configure_snapshot(ctx)
+    grq.set_fetch_window(ctx.get('fetch_window'), ctx.get('fetch_workers'))
     aoi_id = ctx.get('aoi_id', False)
     aoi_index = ctx.get('aoi_index', False)
     if aoi_id is False or aoi_index is False:
@@ -32,6 +36,11 @@ def main():
     enumeration = ctx.get('date_pairs', False) #list of date pairs
     if enumeration:
         enumeration = validate_enumeration(enumeration)
+    #charts render in worker processes while the workbooks are generated, 0 workers skips the charts
+    if chart_workers is None:
+        chart_workers = int(ctx.get('chart_workers', 0))
+    pool = ProcessPoolExecutor(chart_workers) if chart_workers > 0 else None
+    chart_futures = []
     track_acq_lists = sort_by_track(get_objects('acq-list', aoi))
     for track in list(track_acq_lists.keys()):
         print('for track: {}'.format(track))
@@ -45,7 +54,15 @@ def main():
         if enumeration:
             product_id = 'AOI_enumeration_report-{}'.format(aoi_id)
         print_results(track, acqs, slcs, acq_lists, ifg_cfgs, ifgs)
+        for object_type, obj_list in (('acq', acqs), ('slc', slcs), ('acq-list', acq_lists), ('ifg-cfg', ifg_cfgs),
+                                      ('ifg', ifgs), ('audit_trail', audit_trail)):
+            profiling.count_documents(object_type, len(obj_list))
+        if pool is not None:
+            chart_futures.extend(render_charts(pool, aoi, track, ifgs, acq_lists))
         excel.generate(aoi, track, acqs, slcs, acq_lists, ifg_cfgs, ifgs, audit_trail, enumeration=enumeration)
+    if pool is not None:
+        wait_for_charts(chart_futures)
+        pool.shutdown()
     
     #attempt to plot a coverage chart by track
     #try:
@@ -71,6 +88,7 @@ def main():
     os.mkdir(product_id)
     os.system('mv AOI* ./{}'.format(product_id))
     gen_product_jsons(aoi, product_id)
+    profiling.log_report(product_id)
 
 def gen_product_jsons(aoi, product_id):
     '''generates the appropriate product json files in the product directory'''
@@ -81,27 +99,14 @@ def gen_product_jsons(aoi, product_id):
     outpath = os.path.join(product_id, '{}.dataset.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(ds, outf)
-    met = {}
+    met = profiling.get_report() # timing by phase & document counts across all tracks
     outpath = os.path.join(product_id, '{}.met.json'.format(product_id))
     with open(outpath, 'w') as outf:
         json.dump(met, outf)
 
 def validate_enumeration(date_pair_string):
-    '''validates the enumeration date pair list to be the appropriate format. Returns as a list'''
-    date_pairs = date_pair_string.replace(' ','').replace('_', '-').split(',')
-    output_pairs = []
-    for date_pair in date_pairs:
-        dates = date_pair.split('-')
-        if len(dates) < 2:
-            print('Failed parsing date pair: {}. skipping.'.format(date_pair))
-            continue
-        first_date = dateutil.parser.parse(dates[0])
-        second_date = dateutil.parser.parse(dates[1])
-        if first_date < second_date:
-            first_date, second_date = second_date, first_date
-        output_date = '{}-{}'.format(first_date.strftime('%Y%m%d'), second_date.strftime('%Y%m%d'))
-        output_pairs.append(output_date)
-    return output_pairs
+    '''validates the enumeration date pair list to be the appropriate format. Returns as a list sorted by endtime'''
+    return enum_compare.load_enumeration(date_pair_string)
 
 def print_results(track, acqs, slcs, acq_lists, ifg_cfgs, ifgs):
     print('Track {} Acquisitions:      {}'.format(track, len(acqs)))
@@ -119,8 +124,8 @@ def parse_start_end_times(obj):
         end = int(result[1])
         if end < start:
             start, end = end, start
-        end = dateutil.parser.parse(str(end)[0:4] + '-' + str(end)[4:6] + '-' + str(end)[6:8])
-        start = dateutil.parser.parse(str(start)[0:4] + '-' + str(start)[4:6] + '-' + str(start)[6:8])
+        end = datetime(end // 10000, end // 100 % 100, end % 100)
+        start = datetime(start // 10000, start // 100 % 100, start % 100)
         return start, end
     except:
         obj_s = obj.get('_source', {})
@@ -137,6 +142,20 @@ def parse_start_time(obj):
     #else:
     return str(parse_start_end_times(obj)[0])
 
+def get_start_end_times(obj):
+    '''returns the start & end datetimes of the object, parsed from its id when possible'''
+    try:
+        return parse_start_end_times(obj) # attempt to parse from the id dt
+    except:
+        startdt = dateutil.parser.parse(obj.get('_source', {}).get('starttime', False))
+        enddt = dateutil.parser.parse(obj.get('_source', {}).get('endtime', False))
+        return startdt, enddt
+
+def sort_by_start_time(obj_list):
+    '''returns a list of (starttime, endtime, obj) sorted by starttime, parsing the times once per object'''
+    timed_objs = [tuple(get_start_end_times(obj)) + (obj,) for obj in obj_list]
+    return sorted(timed_objs, key=lambda x: str(x[0]))
+
 def sort_by_frame(obj_list):
     '''
     Goes through the objects in the result list, and places them in a dict where key is frame
@@ -150,63 +169,130 @@ def sort_by_frame(obj_list):
             sorted_dict[frame] = [result]
     return sorted_dict
 
-def plot_obj(es_obj_dict, aoi, product_name):
+def plot_obj(es_obj_dict, aoi, product_name, layout='aggregate', pool=None):
+    '''plots a gantt chart per track. past gantt.MAX_ROWS objects the rows are aggregated by frame (layout aggregate)
+    or paginated into multiple images (layout paginate). Each chart is rendered in the pool if given, returns the
+    list of futures'''
     aoi_name = aoi.get('_id', 'AOI_err')
     gantt_reg = '{}_{}_track_{}_chart'
     col = get_color()
+    futures = []
     for track in list(es_obj_dict.keys()):
         es_obj_list = es_obj_dict.get(track, [])
         title = 'Coverage Report for {} over {}, Track {}'.format(product_name, aoi_name, track)
         gantt_filename = gantt_reg.format(aoi_name, product_name, track)
-        chart = gantt.gantt_chart()
+        bars = []
         #sort by frame
         es_frame_dict = sort_by_frame(es_obj_list)
         for frame in sorted(es_frame_dict.keys()):
             es_frame_list = es_frame_dict.get(frame, [])
             #print('found {} ifgs for frame {}'.format(len(es_frame_list), frame))
-            es_frame_list = sorted(es_frame_list, key=lambda x: parse_start_time(x))
             color = next(col)
-            for obj in es_frame_list:
-                uid = obj.get('_id')
+            for startdt, enddt, obj in sort_by_start_time(es_frame_list):
                 obj_name = 'F:{}, S:{}'.format(frame, obj.get('_source', {}).get('starttime', '')[0:10])
-                try:
-                    startdt, enddt = parse_start_end_times(obj) # attempt to parse from the id dt
-                except:
-                    startdt = dateutil.parser.parse(obj.get('_source', {}).get('starttime', False))
-                    enddt = dateutil.parser.parse(obj.get('_source', {}).get('endtime', False))
-                chart.add(startdt, enddt, obj_name, color=color)
-        chart.build_gantt(gantt_filename + '.png', title)
+                bars.append((startdt, enddt, obj_name, color, 'F:{}'.format(frame)))
+        key = artifact_cache.fingerprint('gantt', gantt_filename, title, layout, bars)
+        futures.append(submit_cached(pool, key, render_gantt, gantt_filename + '.png', title, bars, layout))
+    return futures
 
-def gen_coverage_plot(es_obj_dict, aoi, product_name):
+def gen_coverage_plot(es_obj_dict, aoi, product_name, pool=None):
+    '''plots a latitude coverage chart per track. Each chart is rendered in the pool if given, returns the list of
+    futures'''
     aoi_name = aoi.get('_id', 'AOI_err')
     fn_reg = '{}_{}_track_{}_coverage-plot'
     color = 'gray'
+    futures = []
     for track in list(es_obj_dict.keys()):
         es_obj_list = es_obj_dict.get(track, [])
         title = 'Coverage Plot for {} over {}, Track {}'.format(product_name, aoi_name, track)
         plot_filename = fn_reg.format(aoi_name, product_name, track)
-        chart = coverage_chart.coverage_chart()
+        bars = []
         #sort by frame
         es_frame_dict = sort_by_frame(es_obj_list)
         for frame in sorted(es_frame_dict.keys()):
             es_frame_list = es_frame_dict.get(frame, [])
             #print('found {} ifgs for frame {}'.format(len(es_frame_list), frame))
-            es_frame_list = sorted(es_frame_list, key=lambda x: parse_start_time(x))
             #color = col.next()
-            for obj in es_frame_list:
-                uid = obj.get('_id')
+            for startdt, enddt, obj in sort_by_start_time(es_frame_list):
                 obj_name = 'F:{}, S:{}'.format(frame, obj.get('_source', {}).get('starttime', '')[0:10])
                 location = obj.get('_source', {}).get('location', {}).get('coordinates', False)[0]
                 lat_list = [x[1] for x in location]
                 minlat = min(lat_list)
                 maxlat = max(lat_list)
-                try:
-                    startdt, enddt = parse_start_end_times(obj) # attempt to parse from the id dt
-                except:
-                    startdt = dateutil.parser.parse(obj.get('_source', {}).get('starttime', False))
-                    enddt = dateutil.parser.parse(obj.get('_source', {}).get('endtime', False))
-                chart.add(startdt, enddt, minlat, maxlat, obj_name, color=color)
-        chart.build(plot_filename + '.png', title)
+                bars.append((startdt, enddt, minlat, maxlat, obj_name, color))
+        key = artifact_cache.fingerprint('coverage', plot_filename, title, bars)
+        futures.append(submit_cached(pool, key, render_coverage, plot_filename + '.png', title, bars))
+    return futures
+
+def render_gantt(filename, title, bars, layout):
+    '''renders the gantt chart of the (starttime, endtime, label, color, row) bars, releasing its figures'''
+    import gantt # matplotlib is only loaded when a chart is rendered
+    import matplotlib.pyplot as plt
+    try:
+        chart = gantt.gantt_chart()
+        for startdt, enddt, obj_name, color, row in bars:
+            chart.add(startdt, enddt, obj_name, color=color, row=row)
+        return chart.build_gantt(filename, title, layout=layout)
+    finally:
+        plt.close('all')
+
+def render_coverage(filename, title, bars):
+    '''renders the coverage chart of the (starttime, endtime, minlat, maxlat, label, color) bars, releasing its
+    figures'''
+    import coverage_chart # matplotlib is only loaded when a chart is rendered
+    import matplotlib.pyplot as plt
+    try:
+        chart = coverage_chart.coverage_chart()
+        for startdt, enddt, minlat, maxlat, obj_name, color in bars:
+            chart.add(startdt, enddt, minlat, maxlat, obj_name, color=color)
+        return chart.build(filename, title)
+    finally:
+        plt.close('all')
+
+def submit(pool, func, *args):
+    '''submits the function to the pool, or runs it in process if there is none. returns a future'''
+    if pool is not None:
+        return pool.submit(func, *args)
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+def submit_cached(pool, key, func, *args):
+    '''restores the chart images of the fingerprint from the artifact cache, or submits the render function and
+    caches its images once rendered. returns a future of the image filenames'''
+    restored = artifact_cache.restore(key)
+    if restored:
+        future = Future()
+        future.set_result(restored)
+        return future
+    future = submit(pool, func, *args)
+    future.add_done_callback(lambda done: done.exception() is None and artifact_cache.store(key, done.result()))
+    return future
+
+def render_charts(pool, aoi, track, ifgs, acq_lists):
+    '''submits the gantt & coverage charts of the track's ifgs & acquisition lists, returns the futures'''
+    futures = []
+    for product_name, obj_list in (('ifgs', ifgs), ('acq-lists', acq_lists)):
+        if not obj_list:
+            continue
+        try:
+            futures.extend(gen_coverage_plot({track: obj_list}, aoi, product_name, pool=pool))
+            futures.extend(plot_obj({track: obj_list}, aoi, product_name, pool=pool))
+        except Exception as err:
+            print('failed to generate charts for {} on track {}: {}'.format(product_name, track, err))
+    return futures
+
+@profiling.timed('charts')
+def wait_for_charts(futures):
+    '''waits for the submitted charts, logging the failed ones'''
+    for future in futures:
+        try:
+            print('rendered chart: {}'.format(', '.join(future.result())))
+        except Exception as err:
+            print('failed to generate chart: {}'.format(err))
 
 def get_color():
     while True:
@@ -217,10 +303,9 @@ def get_aoi(aoi_id, aoi_index):
     '''
     retrieves the AOI from ES
     '''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, aoi_index)
+    grq_url = grq.get_search_url(aoi_index)
     es_query = {"query":{"bool":{"must":[{"term":{"id.raw":aoi_id}}]}}}
-    result = query_es(grq_url, es_query)
+    result = grq.query_es(grq_url, es_query)
     if len(result) < 1:
         raise Exception('Found no results for AOI: {}'.format(aoi_id))
     return result[0]
@@ -265,8 +350,7 @@ def get_objects(object_type, aoi, track_number = False):
     starttime = aoi.get('_source', {}).get('starttime')
     endtime = aoi.get('_source', {}).get('endtime')
     location = aoi.get('_source', {}).get('location')
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, idx)
+    grq_url = grq.get_search_url(idx)
     track_field = 'track_number' 
     if object_type == 'slc' and track_number:
         track_field = 'trackNumber'
@@ -276,43 +360,9 @@ def get_objects(object_type, aoi, track_number = False):
         grq_query = {"query":{"filtered":{"query":{"geo_shape":{"location": {"shape":location}}},"filter":{"bool":{"must":[{"range":{"endtime":{"gte":starttime}}},{"range":{"starttime":{"lte":endtime}}}]}}}},"from":0,"size":1000}
 
     
-    results = query_es(grq_url, grq_query)
+    results = grq.query_es_windowed(grq_url, grq_query, starttime, endtime)
     return results
 
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in list(es_query.keys()):
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10
-        es_query['size'] = iterator_size
-    if 'from' in list(es_query.keys()):
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    #run the query and iterate until all the results have been returned
-    #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    #print('status code: {}'.format(response.status_code))
-    #print('response text: {}'.format(response.text))
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
-    
 def load_context():
     '''loads the context file into a dict'''
     try:
@@ -325,5 +375,13 @@ def load_context():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grq_url', help='GRQ endpoint, defaults to $GRQ_URL or the hysds celery GRQ_ES_URL')
+    parser.add_argument('--chart_workers', type=int, default=None,
+                        help='processes rendering the track charts, defaults to chart_workers in the context or 0 (no charts)')
+    args = parser.parse_args()
+    try:
+        main(grq_url=args.grq_url, chart_workers=args.chart_workers)
+    finally:
+        grq.write_metrics('standard_product_report')
 
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+'''
+Queries GRQ's elasticsearch for the Standard Product Reports, recording request metrics (requests, pages, hits,
+response bytes & latency) per index, which are exported as json & prometheus textfile metrics at job end.
+
+The GRQ endpoint is resolved from (in order) a url set by the job (--grq_url or grq_url in the context), the
+GRQ_URL environment variable, and finally GRQ_ES_URL of the hysds celery config, which is only loaded if needed
+
+Time range queries can be split into starttime windows (per month, or adaptively sized from a date histogram of the
+matching documents) that are queried concurrently & concatenated in window order, or merged on the sort of the query
+
+All requests & responses of a run can be recorded into a snapshot (a zip of the responses, keyed by a hash of the index
+& query, with an index.json listing the requests), which is then replayed with no network to reproduce the run
+'''
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import zipfile
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import dateutil.parser
+import requests
+import urllib3
+import profiling
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+TIMEOUT = 60
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+METRICS_JSON = 'grq_metrics.json'
+METRICS_PROM = 'grq_metrics.prom'
+GRQ_URL_ENV = 'GRQ_URL'
+WINDOW_MODES = ['month', 'adaptive']
+WINDOW_FIELD = 'starttime'
+WINDOW_DOCS = 10000 # documents per adaptive window
+WINDOW_WORKERS = 4
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INDEX = 'index.json'
+SNAPSHOT_URL = 'https://grq-snapshot' # endpoint of replayed runs without a GRQ url
+SCROLL = '1m' # keep alive of scroll cursors between pages
+
+_lock = threading.Lock()
+_metrics = {}
+_endpoint = {'url': None}
+_window = {'mode': None, 'workers': WINDOW_WORKERS}
+_snapshot_lock = threading.Lock()
+_snapshot = {'mode': None, 'path': None, 'zip': None, 'requests': [], 'keys': set()}
+
+def set_grq_url(grq_url):
+    '''sets the GRQ endpoint (serving /es/<index>/_search) for all queries, None to fall back to the defaults'''
+    _endpoint['url'] = grq_url.rstrip('/') if grq_url else None
+
+def get_grq_url():
+    '''returns the GRQ endpoint'''
+    if _endpoint['url']:
+        return _endpoint['url']
+    if os.environ.get(GRQ_URL_ENV):
+        return os.environ.get(GRQ_URL_ENV).rstrip('/')
+    if _snapshot['mode'] == 'replay':
+        return SNAPSHOT_URL
+    from hysds.celery import app
+    return app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
+
+def get_search_url(index):
+    '''returns the search url of the index pattern'''
+    return '{0}/es/{1}/_search'.format(get_grq_url(), index)
+
+def get_scroll_url():
+    '''returns the url continuing & clearing scroll cursors'''
+    return '{0}/es/_search/scroll'.format(get_grq_url())
+
+def set_fetch_window(mode, workers=None):
+    '''splits the time range queries into windows (month or adaptive) queried by at most workers threads, None to
+    run them as single queries'''
+    if mode not in (None, '', 'none') and mode not in WINDOW_MODES:
+        raise Exception('invalid fetch window: {}, expected one of {}'.format(mode, WINDOW_MODES))
+    _window['mode'] = None if mode in (None, '', 'none') else mode
+    _window['workers'] = int(workers) if workers else WINDOW_WORKERS
+
+@profiling.timed('grq_query')
+def query_es(grq_url, es_query):
+    '''
+    Runs the query through Elasticsearch, iterates until
+    all results are generated, & returns the compiled result
+    '''
+    return fetch_all(grq_url, es_query)
+
+@profiling.timed('grq_query')
+def query_es_windowed(grq_url, es_query, starttime, endtime):
+    '''runs the query of objects overlapping the starttime - endtime range. if a fetch window is set, the query is
+    split into starttime windows that are queried concurrently. Returns the results of the windows merged on the sort
+    of the query, or by index & id if it has none, so the order depends on neither scoring nor the window bounds'''
+    if _window['mode'] is None or not starttime or not endtime:
+        return fetch_all(grq_url, es_query)
+    if _window['mode'] == 'month':
+        bounds = get_month_bounds(starttime, endtime)
+    else:
+        bounds = get_adaptive_bounds(grq_url, es_query)
+    queries = [window_query(es_query, start, end) for start, end in zip([None] + bounds, bounds + [None])]
+    with ThreadPoolExecutor(_window['workers']) as pool:
+        window_results = list(pool.map(lambda query: fetch_all(grq_url, query), queries))
+    results = []
+    for window in window_results:
+        results.extend(window)
+    sort_fields = get_sort_fields(es_query)
+    if not sort_fields:
+        results.sort(key=lambda obj: (obj.get('_index'), obj.get('_id')))
+    # the windows are sorted runs, which the stable sort merges
+    for field, descending in reversed(sort_fields):
+        results.sort(key=lambda obj: get_source_field(obj, field), reverse=descending)
+    return results
+
+def get_sort_fields(es_query):
+    '''returns the (field, descending) pairs of the sort of the query'''
+    sort = es_query.get('sort', [])
+    fields = []
+    for entry in sort if isinstance(sort, list) else [sort]:
+        if not isinstance(entry, dict):
+            fields.append((entry, False))
+            continue
+        for field, order in entry.items():
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+            fields.append((field, order == 'desc'))
+    return fields
+
+def get_source_field(obj, field):
+    '''returns the value of the (dotted) source field of the object, '' if missing'''
+    val = obj.get('_source', {})
+    for key in field.split('.'):
+        val = val.get(key) if isinstance(val, dict) else None
+    return '' if val is None else val
+
+def get_month_bounds(starttime, endtime):
+    '''returns the month starts between the start & end times, as window boundaries'''
+    start = dateutil.parser.parse(starttime).replace(tzinfo=None)
+    end = dateutil.parser.parse(endtime).replace(tzinfo=None)
+    bounds = []
+    month = datetime.datetime(start.year, start.month, 1)
+    while True:
+        month = datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        if month > end:
+            return bounds
+        bounds.append(month.strftime(DATE_FORMAT))
+
+def get_adaptive_bounds(grq_url, es_query):
+    '''returns the window boundaries grouping the months of a starttime histogram of the query into windows of about
+    WINDOW_DOCS documents'''
+    histogram_query = json.loads(json.dumps(es_query))
+    histogram_query['aggs'] = {'months': {'date_histogram': {'field': WINDOW_FIELD, 'interval': 'month'}}}
+    histogram_query.pop('from', None)
+    histogram_query['size'] = 0
+    buckets = post(grq_url, histogram_query).get('aggregations', {}).get('months', {}).get('buckets', [])
+    bounds = []
+    window_docs = 0
+    for bucket in buckets:
+        if window_docs and window_docs + bucket['doc_count'] > WINDOW_DOCS:
+            bounds.append(datetime.datetime.utcfromtimestamp(bucket['key'] / 1000.0).strftime(DATE_FORMAT))
+            window_docs = 0
+        window_docs += bucket['doc_count']
+    return bounds
+
+def window_query(es_query, start, end):
+    '''returns a copy of the query filtered to the starttime window, unbounded if start or end is None'''
+    query = json.loads(json.dumps(es_query))
+    window = {}
+    if start:
+        window['gte'] = start
+    if end:
+        window['lt'] = end
+    if window:
+        query['query'] = {'filtered': {'query': query['query'], 'filter': {'range': {WINDOW_FIELD: window}}}}
+    return query
+
+def fetch_all(grq_url, es_query):
+    '''pages through all the results of the query, returns the hits'''
+    # make sure the fields from & size are in the es_query
+    if 'size' in list(es_query.keys()):
+        iterator_size = es_query['size']
+    else:
+        iterator_size = 10
+        es_query['size'] = iterator_size
+    if 'from' not in list(es_query.keys()):
+        es_query['from'] = 0
+    #run the query and iterate until all the results have been returned
+    results = post(grq_url, es_query)
+    results_list = results.get('hits', {}).get('hits', [])
+    total_count = results.get('hits', {}).get('total', 0)
+    for i in range(es_query['from'] + iterator_size, total_count, iterator_size):
+        es_query['from'] = i
+        results = post(grq_url, es_query)
+        results_list.extend(results.get('hits', {}).get('hits', []))
+    return results_list
+
+def scroll_pages(grq_url, es_query):
+    '''streams the pages of hits of the query through a scroll cursor (pages of the query size), so large results
+    are neither deep paged nor held in memory at once. The scroll id is sent as the raw body, as ES 1.x expects, &
+    the cursor is cleared once done or abandoned'''
+    index = get_index(grq_url)
+    scroll_url = '{}?scroll={}'.format(get_scroll_url(), SCROLL)
+    results = post('{}?scroll={}'.format(grq_url, SCROLL), es_query, index=index)
+    try:
+        while results.get('hits', {}).get('hits'):
+            yield results['hits']['hits']
+            results = post(scroll_url, results.get('_scroll_id'), index=index)
+    finally:
+        clear_scroll(results.get('_scroll_id'))
+
+def clear_scroll(scroll_id):
+    '''deletes the scroll cursor on the cluster instead of waiting for it to time out, failures are only printed'''
+    if not scroll_id or _snapshot['mode'] == 'replay':
+        return
+    try:
+        requests.delete(get_scroll_url(), data=scroll_id, timeout=TIMEOUT, verify=False).raise_for_status()
+    except Exception as err:
+        print('failed to clear scroll: {}'.format(err))
+
+@profiling.timed('grq_query')
+def query_es_page(grq_url, es_query):
+    '''runs the query for its first page only (from/size as given) & returns the hits'''
+    return post(grq_url, es_query).get('hits', {}).get('hits', [])
+
+@profiling.timed('grq_query')
+def query_es_aggs(grq_url, es_query):
+    '''runs an aggregation only query (no hits returned) & returns the aggregations of the response'''
+    es_query['size'] = 0
+    return post(grq_url, es_query).get('aggregations', {})
+
+def post(grq_url, es_query, index=None):
+    '''posts the query (or reads it from the replayed snapshot), recording the request in the metrics of its index
+    (taken from the url if not given). A query that is not a dict, like a scroll id, is posted as is. returns the
+    parsed response'''
+    index = index or get_index(grq_url)
+    start = time.time()
+    try:
+        if _snapshot['mode'] == 'replay':
+            content = read_snapshot(grq_url, es_query)
+        else:
+            data = json.dumps(es_query) if isinstance(es_query, dict) else es_query
+            response = requests.post(grq_url, data=data, timeout=TIMEOUT, verify=False)
+            response.raise_for_status()
+            content = response.content
+    except Exception:
+        record(index, time.time() - start, error=True)
+        raise
+    latency = time.time() - start
+    if _snapshot['mode'] == 'record':
+        write_snapshot(grq_url, es_query, content, latency, index)
+    results = json.loads(content.decode('utf-8'))
+    hits = len(results.get('hits', {}).get('hits', []))
+    page = not isinstance(es_query, dict) or es_query.get('size') != 0
+    record(index, latency, hits=hits, size=len(content), page=page)
+    return results
+
+def configure_snapshot(ctx=None):
+    '''records the run into the grq_record snapshot, or replays it from the grq_replay snapshot, given in the context
+    or the GRQ_RECORD / GRQ_REPLAY environment variables'''
+    ctx = ctx or {}
+    record_path = ctx.get('grq_record', os.environ.get('GRQ_RECORD'))
+    replay_path = ctx.get('grq_replay', os.environ.get('GRQ_REPLAY'))
+    if record_path and replay_path:
+        raise Exception('a GRQ snapshot can not be both recorded & replayed')
+    if replay_path:
+        _snapshot['zip'] = zipfile.ZipFile(replay_path, 'r')
+        with _snapshot['zip'].open(SNAPSHOT_INDEX) as fin:
+            snapshot_index = json.loads(fin.read().decode('utf-8'))
+        if snapshot_index.get('version') != SNAPSHOT_VERSION:
+            raise Exception('unsupported GRQ snapshot version: {}'.format(snapshot_index.get('version')))
+        _snapshot.update({'mode': 'replay', 'path': replay_path, 'requests': snapshot_index['requests']})
+        print('replaying {} GRQ requests from {}'.format(len(_snapshot['requests']), replay_path))
+    elif record_path:
+        _snapshot['zip'] = zipfile.ZipFile(record_path, 'w', zipfile.ZIP_DEFLATED)
+        _snapshot.update({'mode': 'record', 'path': record_path, 'requests': [], 'keys': set()})
+        atexit.register(close_snapshot) # the snapshot is also kept if the run fails
+        print('recording GRQ requests into {}'.format(record_path))
+
+def get_snapshot_key(grq_url, es_query):
+    '''returns the key of the request, from the index path (not the host) & the query'''
+    path = re.sub('^[a-z]+://[^/]+', '', grq_url)
+    return hashlib.sha256(json.dumps([path, es_query], sort_keys=True).encode('utf-8')).hexdigest()
+
+def write_snapshot(grq_url, es_query, content, latency, index):
+    '''adds the response to the recorded snapshot, once per distinct request'''
+    key = get_snapshot_key(grq_url, es_query)
+    with _snapshot_lock:
+        if _snapshot['zip'] is None or key in _snapshot['keys']:
+            return
+        _snapshot['keys'].add(key)
+        _snapshot['zip'].writestr('responses/{}.json'.format(key), content)
+        _snapshot['requests'].append({'key': key, 'index': index,
+                                      'query': json.loads(json.dumps(es_query)), # pages reuse the query object
+                                      'bytes': len(content), 'latency': round(latency, 6)})
+
+def read_snapshot(grq_url, es_query):
+    '''returns the recorded response of the request'''
+    key = get_snapshot_key(grq_url, es_query)
+    with _snapshot_lock:
+        try:
+            return _snapshot['zip'].read('responses/{}.json'.format(key))
+        except KeyError:
+            raise Exception('request not in the GRQ snapshot {}: {} {}'.format(_snapshot['path'],
+                                                                               get_index(grq_url),
+                                                                               json.dumps(es_query)))
+
+def close_snapshot():
+    '''writes the index of the recorded snapshot & closes it'''
+    with _snapshot_lock:
+        if _snapshot['zip'] is None:
+            return
+        if _snapshot['mode'] == 'record':
+            snapshot_index = {'version': SNAPSHOT_VERSION, 'created': datetime.datetime.now().isoformat(),
+                              'requests': _snapshot['requests']}
+            _snapshot['zip'].writestr(SNAPSHOT_INDEX, json.dumps(snapshot_index, indent=1))
+            print('recorded {} GRQ requests into {}'.format(len(_snapshot['requests']), _snapshot['path']))
+        _snapshot['zip'].close()
+        _snapshot['zip'] = None
+
+def get_index(grq_url):
+    '''returns the index pattern of the search url'''
+    match = re.search('/([^/]+)/_search', grq_url)
+    if match:
+        return match.group(1)
+    return 'unknown'
+
+def record(index, latency, hits=0, size=0, page=False, error=False):
+    '''adds a request to the metrics of the index'''
+    with _lock:
+        metrics = _metrics.get(index)
+        if metrics is None:
+            metrics = {'requests': 0, 'errors': 0, 'pages': 0, 'hits': 0, 'bytes': 0, 'latency_sum': 0.0,
+                       'latency_max': 0.0, 'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            _metrics[index] = metrics
+        metrics['requests'] += 1
+        metrics['latency_sum'] += latency
+        metrics['latency_max'] = max(metrics['latency_max'], latency)
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        metrics['latency_buckets'][bucket] += 1
+        if error:
+            metrics['errors'] += 1
+            return
+        metrics['hits'] += hits
+        metrics['bytes'] += size
+        if page:
+            metrics['pages'] += 1
+
+def get_metrics():
+    '''returns a copy of the metrics by index'''
+    with _lock:
+        return json.loads(json.dumps(_metrics))
+
+def reset_metrics():
+    '''clears the recorded metrics'''
+    with _lock:
+        _metrics.clear()
+
+def write_metrics(job_name, work_dir='.'):
+    '''writes the metrics as json & prometheus textfile format into the work dir'''
+    metrics = get_metrics()
+    totals = {}
+    for index_metrics in metrics.values():
+        for key in ('requests', 'errors', 'pages', 'hits', 'bytes', 'latency_sum'):
+            totals[key] = totals.get(key, 0) + index_metrics[key]
+    bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+    with open(os.path.join(work_dir, METRICS_JSON), 'w') as outf:
+        json.dump({'job': job_name, 'latency_bucket_bounds': bounds, 'totals': totals, 'indices': metrics}, outf,
+                  indent=2, sort_keys=True)
+    with open(os.path.join(work_dir, METRICS_PROM), 'w') as outf:
+        outf.write(gen_prometheus(job_name, metrics))
+    print('GRQ requests: {}, hits: {}, bytes: {}, seconds: {:.3f}'.format(
+        totals.get('requests', 0), totals.get('hits', 0), totals.get('bytes', 0), totals.get('latency_sum', 0.0)))
+
+def gen_prometheus(job_name, metrics):
+    '''returns the metrics in prometheus textfile format'''
+    lines = []
+    counters = [('requests', 'grq_requests_total', 'requests sent to GRQ'),
+                ('errors', 'grq_request_errors_total', 'failed GRQ requests'),
+                ('pages', 'grq_pages_total', 'result pages returned by GRQ'),
+                ('hits', 'grq_hits_total', 'documents returned by GRQ'),
+                ('bytes', 'grq_response_bytes_total', 'response bytes returned by GRQ')]
+    for key, name, description in counters:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for index in sorted(metrics.keys()):
+            lines.append('{}{} {}'.format(name, gen_labels(job_name, index), metrics[index][key]))
+    name = 'grq_request_duration_seconds'
+    lines.append('# HELP {} GRQ request latency'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for index in sorted(metrics.keys()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], metrics[index]['latency_buckets']):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, gen_labels(job_name, index, le=bound), cumulative))
+        lines.append('{}_sum{} {}'.format(name, gen_labels(job_name, index), metrics[index]['latency_sum']))
+        lines.append('{}_count{} {}'.format(name, gen_labels(job_name, index), metrics[index]['requests']))
+    return '\n'.join(lines) + '\n'
+
+def gen_labels(job_name, index, le=None):
+    '''returns the prometheus label set'''
+    labels = 'job="{}",index="{}"'.format(job_name, index)
+    if le is not None:
+        labels += ',le="{}"'.format(le)
+    return '{' + labels + '}'
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+'''
+Local HTTP stand-in for GRQ's elasticsearch, serving the grq_* indices from fixture files so the report generators
+can be run & benchmarked offline. Supports the subset of the ES 1.x API the generators use: _search with from/size,
+scroll cursors, _msearch, _count, _source/fields filtering, sort & aggregations, with optional injected latency &
+errors. Geo shape queries match everything, the stand-in does no spatial filtering.
+'''
+from __future__ import print_function
+import os
+import re
+import ssl
+import json
+import gzip
+import time
+import uuid
+import random
+import fnmatch
+import argparse
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+DATE_REG = re.compile('^([0-9]{4}-[0-9]{2}-[0-9]{2})(?:[T ]([0-9]{2}:[0-9]{2}(?::[0-9]{2})?)([.][0-9]+)?)?Z?$')
+DEFAULT_SIZE = 10
+INTERVAL_FORMATS = {'year': '%Y-01-01T00:00:00.000Z', 'month': '%Y-%m-01T00:00:00.000Z',
+                    'day': '%Y-%m-%dT00:00:00.000Z'}
+
+def load_fixtures(fixture_dir):
+    '''loads the fixture files in the dir into a dict of index name to list of hits. files are json lines (one hit
+    per line, optionally gzipped) or json (a list of hits or an ES response), named <index>.jsonl[.gz]/.json'''
+    indices = {}
+    for filename in sorted(os.listdir(fixture_dir)):
+        match = re.match('^(.+?)[.](jsonl|json)([.]gz)?$', filename)
+        if not match:
+            continue
+        path = os.path.join(fixture_dir, filename)
+        fin = gzip.open(path, 'rt') if match.group(3) else open(path, 'r')
+        with fin:
+            if match.group(2) == 'jsonl':
+                hits = [json.loads(line) for line in fin if line.strip()]
+            else:
+                hits = json.load(fin)
+                if isinstance(hits, dict):
+                    hits = hits.get('hits', {}).get('hits', [])
+        for obj in hits:
+            obj.setdefault('_index', match.group(1))
+            obj.setdefault('_type', obj.get('_source', {}).get('dataset', 'doc'))
+            indices.setdefault(obj['_index'], []).append(obj)
+    return indices
+
+def resolve_indices(indices, pattern):
+    '''returns the index names matching the comma separated index pattern. raises KeyError for a missing concrete
+    index, as ES would 404'''
+    names = []
+    for idx in pattern.split(','):
+        if idx in ('_all', '*', ''):
+            matched = list(indices.keys())
+        else:
+            matched = fnmatch.filter(list(indices.keys()), idx)
+            if not matched and '*' not in idx:
+                raise KeyError(idx)
+        for name in sorted(matched):
+            if name not in names:
+                names.append(name)
+    return names
+
+def search(indices, pattern, es_query):
+    '''runs the es query over the indices matching the pattern. returns the full list of matched hits (sorted) and
+    the aggregations'''
+    query = es_query.get('query', {'match_all': {}})
+    matched = []
+    for name in resolve_indices(indices, pattern):
+        for obj in indices[name]:
+            if matches(obj, query):
+                matched.append(obj)
+    for sort_field, order in reversed(get_sort(es_query)):
+        matched.sort(key=lambda obj: sort_key(obj, sort_field), reverse=order == 'desc')
+    aggs = es_query.get('aggs', es_query.get('aggregations', {}))
+    return matched, run_aggs(matched, aggs)
+
+def get_sort(es_query):
+    '''returns the sort of the query as a list of (field, order)'''
+    sort = es_query.get('sort', [])
+    if not isinstance(sort, list):
+        sort = [sort]
+    result = []
+    for entry in sort:
+        if isinstance(entry, dict):
+            for field, order in entry.items():
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+                result.append((field, order))
+        else:
+            result.append((entry, 'asc'))
+    return result
+
+def sort_key(obj, field):
+    '''returns a key that sorts missing values last'''
+    values = get_values(obj, field)
+    if not values:
+        return (1, '')
+    return (0, normalize(values[0]))
+
+def get_values(obj, field):
+    '''returns the list of values of the (dotted) field in the hit. not analyzed .raw fields map to the field'''
+    if field in ('_id', '_index', '_type'):
+        return [obj.get(field)]
+    if field.endswith('.raw'):
+        field = field[:-4]
+    values = [obj.get('_source', {})]
+    for key in field.split('.'):
+        next_values = []
+        for val in values:
+            if isinstance(val, dict) and key in val:
+                val = val[key]
+                next_values.extend(val if isinstance(val, list) else [val])
+        values = next_values
+    return [val for val in values if val is not None]
+
+def normalize(value):
+    '''normalizes dates to a comparable string, other values are returned as is'''
+    if isinstance(value, str):
+        match = DATE_REG.match(value)
+        if match:
+            day, clock, fraction = match.groups()
+            clock = clock or '00:00:00'
+            if len(clock) == 5:
+                clock += ':00'
+            return '{}T{}{}'.format(day, clock, (fraction or '.0').ljust(7, '0')[:7])
+    return value
+
+def equals(value, other):
+    '''term equality, numbers & strings match on their string form as ES coerces them'''
+    if value == other:
+        return True
+    return str(value).lower() == str(other).lower()
+
+def compare(value, other):
+    '''compares the two values as -1, 0 or 1, after normalizing dates'''
+    value, other = normalize(value), normalize(other)
+    if isinstance(value, str) != isinstance(other, str):
+        value, other = str(value), str(other)
+    return (value > other) - (value < other)
+
+def matches(obj, query):
+    '''returns True if the hit matches the query/filter clause'''
+    for clause_type, clause in query.items():
+        if not match_clause(obj, clause_type, clause):
+            return False
+    return True
+
+def match_clause(obj, clause_type, clause):
+    '''evaluates a single query/filter clause'''
+    if clause_type in ('match_all', 'geo_shape', 'geo_bounding_box', 'geo_polygon'):
+        return True
+    if clause_type == 'filtered':
+        return matches(obj, clause.get('query', {'match_all': {}})) and matches(obj, clause.get('filter', {}))
+    if clause_type == 'bool':
+        return match_bool(obj, clause)
+    if clause_type in ('and', 'or'):
+        filters = clause.get('filters', []) if isinstance(clause, dict) else clause
+        results = [matches(obj, sub) for sub in filters]
+        return all(results) if clause_type == 'and' else any(results)
+    if clause_type == 'not':
+        return not matches(obj, clause.get('filter', clause))
+    if clause_type in ('term', 'match', 'match_phrase'):
+        for field, value in clause.items():
+            if isinstance(value, dict):
+                value = value.get('value', value.get('query'))
+            if not any(equals(val, value) for val in get_values(obj, field)):
+                return False
+        return True
+    if clause_type == 'terms':
+        for field, values in clause.items():
+            if field in ('execution', 'minimum_should_match'):
+                continue
+            if not any(equals(val, value) for val in get_values(obj, field) for value in values):
+                return False
+        return True
+    if clause_type == 'range':
+        return all(match_range(get_values(obj, field), bounds) for field, bounds in clause.items())
+    if clause_type == 'ids':
+        return obj.get('_id') in clause.get('values', [])
+    if clause_type == 'exists':
+        return len(get_values(obj, clause.get('field'))) > 0
+    if clause_type == 'missing':
+        return len(get_values(obj, clause.get('field'))) == 0
+    if clause_type == 'query':
+        return matches(obj, clause)
+    raise ValueError('unsupported query clause: {}'.format(clause_type))
+
+def match_bool(obj, clause):
+    '''evaluates a bool clause'''
+    def as_list(val):
+        return val if isinstance(val, list) else [val]
+    for sub in as_list(clause.get('must', [])) + as_list(clause.get('filter', [])):
+        if not matches(obj, sub):
+            return False
+    for sub in as_list(clause.get('must_not', [])):
+        if matches(obj, sub):
+            return False
+    should = as_list(clause.get('should', []))
+    if should and not any(matches(obj, sub) for sub in should):
+        return False
+    return True
+
+def match_range(values, bounds):
+    '''returns True if any of the values is within the range bounds'''
+    for val in values:
+        if 'gte' in bounds and compare(val, bounds['gte']) < 0:
+            continue
+        if 'gt' in bounds and compare(val, bounds['gt']) <= 0:
+            continue
+        if 'lte' in bounds and compare(val, bounds['lte']) > 0:
+            continue
+        if 'lt' in bounds and compare(val, bounds['lt']) >= 0:
+            continue
+        return True
+    return False
+
+def run_aggs(matched, aggs):
+    '''runs the (nested) aggregations over the matched hits'''
+    results = {}
+    for name, agg in aggs.items():
+        sub_aggs = agg.get('aggs', agg.get('aggregations', {}))
+        agg_type = [key for key in agg.keys() if key not in ('aggs', 'aggregations')][0]
+        params = agg[agg_type]
+        if agg_type == 'terms':
+            results[name] = terms_agg(matched, params, sub_aggs)
+        elif agg_type == 'date_histogram':
+            results[name] = date_histogram_agg(matched, params, sub_aggs)
+        elif agg_type == 'missing':
+            missing = [obj for obj in matched if not get_values(obj, params['field'])]
+            results[name] = dict({'doc_count': len(missing)}, **run_aggs(missing, sub_aggs))
+        elif agg_type == 'filter':
+            filtered = [obj for obj in matched if matches(obj, params)]
+            results[name] = dict({'doc_count': len(filtered)}, **run_aggs(filtered, sub_aggs))
+        elif agg_type in ('min', 'max'):
+            values = [normalize(val) for obj in matched for val in get_values(obj, params['field'])]
+            value = (min(values) if agg_type == 'min' else max(values)) if values else None
+            results[name] = {'value': value}
+        elif agg_type == 'value_count':
+            results[name] = {'value': sum(len(get_values(obj, params['field'])) for obj in matched)}
+        elif agg_type == 'cardinality':
+            results[name] = {'value': len(set(json.dumps(val) for obj in matched
+                                              for val in get_values(obj, params['field'])))}
+        else:
+            raise ValueError('unsupported aggregation: {}'.format(agg_type))
+    return results
+
+def terms_agg(matched, params, sub_aggs):
+    '''terms aggregation, size 0 returns all buckets as in ES 1.x'''
+    groups = {}
+    for obj in matched:
+        for val in set(json.dumps(val) for val in get_values(obj, params['field'])):
+            groups.setdefault(val, []).append(obj)
+    ordered = sorted(groups.items(), key=lambda item: (-len(item[1]), item[0]))
+    size = params.get('size', 10)
+    if size:
+        ordered = ordered[:size]
+    buckets = []
+    for key, objs in ordered:
+        bucket = {'key': json.loads(key), 'doc_count': len(objs)}
+        bucket.update(run_aggs(objs, sub_aggs))
+        buckets.append(bucket)
+    return {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': buckets}
+
+def date_histogram_agg(matched, params, sub_aggs):
+    '''date histogram aggregation over year, month or day intervals'''
+    interval = params.get('interval', 'month')
+    if interval not in INTERVAL_FORMATS:
+        raise ValueError('unsupported date_histogram interval: {}'.format(interval))
+    groups = {}
+    for obj in matched:
+        values = get_values(obj, params['field'])
+        if not values:
+            continue
+        date = datetime.datetime.strptime(normalize(values[0])[:19], '%Y-%m-%dT%H:%M:%S')
+        groups.setdefault(date.strftime(INTERVAL_FORMATS[interval]), []).append(obj)
+    buckets = []
+    for key in sorted(groups.keys()):
+        epoch = datetime.datetime.strptime(key, '%Y-%m-%dT%H:%M:%S.000Z') - datetime.datetime(1970, 1, 1)
+        bucket = {'key_as_string': key, 'key': int(epoch.total_seconds() * 1000), 'doc_count': len(groups[key])}
+        bucket.update(run_aggs(groups[key], sub_aggs))
+        buckets.append(bucket)
+    return {'buckets': buckets}
+
+def format_hits(hits, es_query):
+    '''applies the _source & fields filtering of the query to the hits'''
+    source_filter = es_query.get('_source', True)
+    fields = es_query.get('fields', None)
+    formatted = []
+    for obj in hits:
+        out = dict((key, obj[key]) for key in ('_index', '_type', '_id') if key in obj)
+        out['_score'] = 1.0
+        if fields is not None:
+            out['fields'] = {}
+            for field in fields:
+                values = get_values(obj, field)
+                if field == '_id':
+                    out['fields'][field] = obj.get('_id')
+                elif values:
+                    out['fields'][field] = values
+        elif source_filter is not False:
+            out['_source'] = filter_source(obj.get('_source', {}), source_filter)
+        formatted.append(out)
+    return formatted
+
+def filter_source(source, source_filter):
+    '''returns the source with only the included fields'''
+    if source_filter is True:
+        return source
+    includes = source_filter
+    if isinstance(source_filter, dict):
+        includes = source_filter.get('includes', source_filter.get('include', []))
+    if isinstance(includes, str):
+        includes = [includes]
+    if not includes:
+        return source
+    result = {}
+    for field in includes:
+        keys = field.split('.')
+        val = source
+        for key in keys:
+            val = val.get(key) if isinstance(val, dict) else None
+        if val is None:
+            continue
+        target = result
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = val
+    return result
+
+class grq_standin(ThreadingMixIn, HTTPServer):
+    '''threaded http server holding the fixture indices, scroll contexts & fault injection settings'''
+    daemon_threads = True
+
+    def __init__(self, address, indices, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, quiet=False):
+        HTTPServer.__init__(self, address, grq_handler)
+        self.indices = indices
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.quiet = quiet
+        self.scrolls = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+class grq_handler(BaseHTTPRequestHandler):
+    '''routes the ES api requests'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.respond(server.error_status, {'error': 'injected failure', 'status': server.error_status})
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        if parts and parts[0] == 'es':
+            parts = parts[1:]
+        try:
+            if self.command == 'DELETE' and parts[:2] == ['_search', 'scroll']:
+                return self.respond(200, self.clear_scroll(body, parts))
+            if parts[:2] == ['_search', 'scroll']:
+                return self.respond(200, self.scroll(body, params, parts))
+            if parts and parts[-1] == '_msearch':
+                return self.respond(200, self.msearch(body, parts[0] if len(parts) > 1 else '_all'))
+            if parts and parts[-1] in ('_search', '_count'):
+                pattern = parts[0] if len(parts) > 1 else '_all'
+                es_query = json.loads(body) if body.strip() else {}
+                if parts[-1] == '_count':
+                    matched, _ = search(server.indices, pattern, es_query)
+                    return self.respond(200, {'count': len(matched), '_shards': shards()})
+                return self.respond(200, self.search(pattern, es_query, params))
+            return self.respond(404, {'error': 'unsupported endpoint: {}'.format(url.path), 'status': 404})
+        except KeyError as err:
+            return self.respond(404, {'error': 'IndexMissingException[[{}] missing]'.format(err.args[0]),
+                                      'status': 404})
+        except ValueError as err:
+            return self.respond(400, {'error': 'SearchParseException[{}]'.format(err), 'status': 400})
+
+    def search(self, pattern, es_query, params):
+        '''runs a search, opening a scroll context if requested'''
+        start = time.time()
+        matched, aggs = search(self.server.indices, pattern, es_query)
+        size = int(params.get('size', [es_query.get('size', DEFAULT_SIZE)])[0])
+        offset = int(params.get('from', [es_query.get('from', 0)])[0])
+        result = {'took': 0, 'timed_out': False, '_shards': shards(),
+                  'hits': {'total': len(matched), 'max_score': 1.0,
+                           'hits': format_hits(matched[offset:offset + size], es_query)}}
+        if aggs:
+            result['aggregations'] = aggs
+        if 'scroll' in params:
+            scroll_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.scrolls[scroll_id] = {'hits': matched, 'position': offset + size, 'size': size,
+                                                  'query': es_query}
+            result['_scroll_id'] = scroll_id
+        result['took'] = int((time.time() - start) * 1000)
+        return result
+
+    def scroll(self, body, params, parts):
+        '''returns the next page of a scroll context'''
+        scroll_id = params.get('scroll_id', [None])[0] or (parts[2] if len(parts) > 2 else None)
+        if scroll_id is None and body.strip():
+            try:
+                scroll_id = json.loads(body).get('scroll_id')
+            except ValueError:
+                scroll_id = body.strip()
+        with self.server.lock:
+            context = self.server.scrolls.get(scroll_id)
+            if context is None:
+                raise KeyError('scroll {}'.format(scroll_id))
+            position = context['position']
+            context['position'] += context['size']
+        page = context['hits'][position:position + context['size']]
+        return {'took': 0, 'timed_out': False, '_shards': shards(), '_scroll_id': scroll_id,
+                'hits': {'total': len(context['hits']), 'max_score': 1.0,
+                         'hits': format_hits(page, context['query'])}}
+
+    def clear_scroll(self, body, parts):
+        '''removes scroll contexts'''
+        scroll_ids = parts[2:] or [scroll_id for scroll_id in re.split('[,\\s]+', body.strip()) if scroll_id]
+        with self.server.lock:
+            for scroll_id in scroll_ids:
+                self.server.scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    def msearch(self, body, default_pattern):
+        '''runs the header/body pairs of a multi search'''
+        lines = [line for line in body.split('\n') if line.strip()]
+        responses = []
+        for header_line, query_line in zip(lines[0::2], lines[1::2]):
+            header = json.loads(header_line)
+            pattern = header.get('index', default_pattern)
+            if isinstance(pattern, list):
+                pattern = ','.join(pattern)
+            try:
+                responses.append(self.search(pattern, json.loads(query_line), {}))
+            except KeyError as err:
+                responses.append({'error': 'IndexMissingException[[{}] missing]'.format(err.args[0])})
+        return {'responses': responses}
+
+    def respond(self, status, result):
+        data = json.dumps(result).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def shards():
+    '''the _shards block of a response'''
+    return {'total': 1, 'successful': 1, 'failed': 0}
+
+def serve(fixture_dir, host='localhost', port=9201, certfile=None, keyfile=None, **kwargs):
+    '''loads the fixtures & serves them until interrupted'''
+    indices = load_fixtures(fixture_dir)
+    for name in sorted(indices.keys()):
+        print('loaded {}: {} hits'.format(name, len(indices[name])))
+    server = grq_standin((host, port), indices, **kwargs)
+    scheme = 'http'
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    print('serving GRQ stand-in on {}://{}:{}/es/'.format(scheme, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('served {} requests'.format(server.request_count))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serves grq_* indices from fixture files as a local ES stand-in')
+    parser.add_argument('--fixtures', required=True, help='dir of <index>.jsonl[.gz] or <index>.json files')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max random seconds added on top of latency')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error_status', type=int, default=503, help='http status of injected failures')
+    parser.add_argument('--certfile', help='serve https with this certificate (the generators rewrite to https)')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    args = parser.parse_args()
+    serve(args.fixtures, host=args.host, port=args.port, certfile=args.certfile, keyfile=args.keyfile,
+          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status,
+          quiet=args.quiet)
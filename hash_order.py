@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+'''
+Orders the products of a track by endtime, newest first, once per track. Endtimes are converted to epoch seconds with a
+fast path for the ISO timestamps of GRQ documents. If the products were fetched sorted on endtime (ENDTIME_SORT) the
+order is only verified, without parsing
+'''
+import re
+import calendar
+import dateutil.parser
+import profiling
+
+ENDTIME_SORT = [{"endtime": {"order": "desc"}}]
+ISO_REG = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(\.\d+)?Z?$')
+
+_sort = {'endtime': False}
+
+def set_endtime_sort(endtime_sort):
+    '''requests the product queries sorted on endtime from ES'''
+    _sort['endtime'] = bool(endtime_sort)
+
+def get_sort():
+    '''returns the ES sort of the product queries, None if unsorted'''
+    return ENDTIME_SORT if _sort['endtime'] else None
+
+@profiling.timed('date_parse')
+def sort_by_endtime(obj_dict):
+    '''returns the keys of the dict of objects sorted by the objects endtime, newest first'''
+    keys = list(obj_dict.keys())
+    endtimes = [obj_dict[key].get('_source', {}).get('endtime') for key in keys]
+    if is_ordered(endtimes):
+        return keys
+    epochs = dict(zip(keys, (to_epoch(endtime) for endtime in endtimes)))
+    return sorted(keys, key=epochs.get, reverse=True)
+
+def is_ordered(endtimes):
+    '''returns True if the endtimes are ISO timestamps of the same format, in descending order'''
+    if not endtimes or any(not endtime or len(endtime) != len(endtimes[0]) for endtime in endtimes):
+        return False
+    if ISO_REG.match(endtimes[0]) is None:
+        return False
+    return all(earlier >= later for earlier, later in zip(endtimes, endtimes[1:]))
+
+def to_epoch(timestamp):
+    '''returns the epoch seconds of the timestamp, timestamps without a timezone are taken as UTC'''
+    match = ISO_REG.match(timestamp)
+    if match is None:
+        dt = dateutil.parser.parse(timestamp)
+        tt = dt.utctimetuple() if dt.tzinfo else dt.timetuple()
+        return calendar.timegm(tt) + dt.microsecond / 1e6
+    return calendar.timegm([int(part) for part in match.groups()[:6]]) + float(match.group(7) or 0)
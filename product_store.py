@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+'''
+Optional local SQLite store of the localized SLC ids & acquisition-list scenes of each AOI & track, in WAL mode &
+indexed on full_id_hash, slc id & track. The report generators sync the fetched SLCs & acquisition-lists into it,
+detecting changes by product id & creation_timestamp, so only new, changed or removed products are written. The
+acquisition-list scenes are then joined against the localized SLCs in SQL instead of in python dicts.
+
+Only what the join needs is stored, the product documents themselves stay in memory for the reports. The store is
+enabled by setting its path (product_store in the context or PRODUCT_STORE in the environment)
+'''
+from __future__ import print_function
+import os
+import sqlite3
+import slc_index
+import profiling
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS slcs (aoi TEXT NOT NULL, track TEXT NOT NULL, id TEXT NOT NULL,
+       slc_id TEXT NOT NULL, PRIMARY KEY (aoi, track, id))''',
+    'CREATE INDEX IF NOT EXISTS slcs_slc ON slcs (aoi, track, slc_id)',
+    '''CREATE TABLE IF NOT EXISTS acq_lists (aoi TEXT NOT NULL, track TEXT NOT NULL, id TEXT NOT NULL,
+       full_id_hash TEXT NOT NULL, version TEXT NOT NULL, PRIMARY KEY (aoi, track, id))''',
+    'CREATE INDEX IF NOT EXISTS acq_lists_hash ON acq_lists (aoi, track, full_id_hash)',
+    '''CREATE TABLE IF NOT EXISTS scenes (aoi TEXT NOT NULL, track TEXT NOT NULL, full_id_hash TEXT NOT NULL,
+       position INTEGER NOT NULL, slc_id TEXT NOT NULL, PRIMARY KEY (aoi, track, full_id_hash, position))''',
+    'CREATE INDEX IF NOT EXISTS scenes_slc ON scenes (aoi, track, slc_id)'
+]
+
+_store = {'path': None, 'conn': None}
+
+def configure(ctx=None):
+    '''opens the store from the context, falling back to the environment'''
+    ctx = ctx or {}
+    path = ctx.get('product_store', os.environ.get('PRODUCT_STORE', None))
+    if not path:
+        return
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    _store.update({'path': path, 'conn': conn})
+    print('product store: {}'.format(path))
+
+def enabled():
+    '''returns True if a store is open'''
+    return _store['conn'] is not None
+
+def close():
+    '''closes the store'''
+    if _store['conn'] is not None:
+        _store['conn'].close()
+    _store.update({'path': None, 'conn': None})
+
+@profiling.timed('store')
+def sync_track(aoi_id, track, get_hash, slcs, acq_lists):
+    '''syncs the slcs & acquisition-lists of the aoi & track into the store. Returns the slc index of the track joined
+    by the store'''
+    slc_counts = sync_slcs(aoi_id, track, slcs)
+    acq_list_counts = sync_acq_lists(aoi_id, track, acq_lists, get_hash)
+    print('product store: {} products written & {} removed for {} track {}'.format(
+        slc_counts[0] + acq_list_counts[0], slc_counts[1] + acq_list_counts[1], aoi_id, track))
+    return build_slc_index(aoi_id, track)
+
+def sync_slcs(aoi_id, track, slcs):
+    '''makes the stored slcs of the aoi & track match the slc list. Returns the number of written & removed slcs'''
+    conn = _store['conn']
+    track = str(track)
+    with conn:
+        stored = set(row[0] for row in conn.execute('SELECT id FROM slcs WHERE aoi = ? AND track = ?',
+                                                    (aoi_id, track)))
+        current = dict((slc.get('_id'), slc.get('_source', {}).get('id')) for slc in slcs)
+        added = [(aoi_id, track, obj_id, slc_id) for obj_id, slc_id in current.items() if obj_id not in stored]
+        removed = stored.difference(current.keys())
+        conn.executemany('INSERT INTO slcs VALUES (?, ?, ?, ?)', added)
+        conn.executemany('DELETE FROM slcs WHERE aoi = ? AND track = ? AND id = ?',
+                         [(aoi_id, track, obj_id) for obj_id in removed])
+    return len(added), len(removed)
+
+def sync_acq_lists(aoi_id, track, acq_lists, get_hash):
+    '''makes the stored acquisition-lists of the aoi & track match the list, replacing the scenes of the new or changed
+    ones (by id & creation_timestamp). Returns the number of written & removed acquisition-lists'''
+    conn = _store['conn']
+    track = str(track)
+    with conn:
+        stored = dict(conn.execute('SELECT id, version FROM acq_lists WHERE aoi = ? AND track = ?', (aoi_id, track)))
+        changed = {} # one changed acquisition-list per hash
+        current = set()
+        rows = []
+        for acq_list in acq_lists:
+            obj_id = acq_list.get('_id')
+            version = acq_list.get('_source', {}).get('creation_timestamp') or ''
+            current.add(obj_id)
+            if stored.get(obj_id) == version:
+                continue
+            id_hash = get_hash(acq_list)
+            rows.append((aoi_id, track, obj_id, id_hash, version))
+            changed[id_hash] = acq_list
+        removed = set(stored.keys()).difference(current)
+        conn.executemany('INSERT OR REPLACE INTO acq_lists VALUES (?, ?, ?, ?, ?)', rows)
+        conn.executemany('DELETE FROM acq_lists WHERE aoi = ? AND track = ? AND id = ?',
+                         [(aoi_id, track, obj_id) for obj_id in removed])
+        for id_hash, acq_list in changed.items():
+            conn.execute('DELETE FROM scenes WHERE aoi = ? AND track = ? AND full_id_hash = ?',
+                         (aoi_id, track, id_hash))
+            conn.executemany('INSERT INTO scenes VALUES (?, ?, ?, ?, ?)',
+                             [(aoi_id, track, id_hash, position, slc_id)
+                              for position, slc_id in enumerate(slc_index.get_all_scenes(acq_list))])
+        conn.execute('''DELETE FROM scenes WHERE aoi = ? AND track = ? AND full_id_hash NOT IN
+                        (SELECT full_id_hash FROM acq_lists WHERE aoi = ? AND track = ?)''',
+                     (aoi_id, track, aoi_id, track))
+    return len(rows), len(removed)
+
+def build_slc_index(aoi_id, track):
+    '''builds the slc index of slc_index.build_slc_index, joining the stored acquisition-list scenes against the
+    stored slcs of the aoi & track'''
+    scene_to_acq_lists = {}
+    missing = set()
+    missing_by_hash = {}
+    rows = _store['conn'].execute('''SELECT s.full_id_hash, s.slc_id, NOT EXISTS
+        (SELECT 1 FROM slcs l WHERE l.aoi = s.aoi AND l.track = s.track AND l.slc_id = s.slc_id)
+        FROM scenes s WHERE s.aoi = ? AND s.track = ? ORDER BY s.full_id_hash, s.position''', (aoi_id, str(track)))
+    for id_hash, slc_id, is_missing in rows:
+        scene_to_acq_lists.setdefault(slc_id, []).append(id_hash)
+        if is_missing:
+            missing.add(slc_id)
+            missing_by_hash.setdefault(id_hash, []).append(slc_id)
+    return {'referenced': set(scene_to_acq_lists.keys()), 'scene_to_acq_lists': scene_to_acq_lists,
+            'missing': missing, 'missing_by_hash': missing_by_hash}
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+'''
+Phase timers & document counts for the Standard Product Report generators. Phases nest & are timed exclusively, so
+time spent parsing dates while building a workbook is only counted under date_parse. Timing accumulates until reset.
+
+Optionally (memory_profile in the context or REPORT_MEMORY_PROFILE in the environment) traces the peak allocations
+of each phase & the top allocation sites, and enforces a memory budget (memory_budget_mb / REPORT_MEMORY_BUDGET_MB)
+by failing fast or switching the generators to their low memory code paths (memory_budget_action, stream or fail)
+'''
+from __future__ import print_function
+import os
+import time
+import threading
+import tracemalloc
+from functools import wraps
+
+PHASES = ['grq_query', 'fingerprint', 'hash_index', 'store', 'date_parse', 'workbook', 'html', 'charts', 'save']
+# phases called per document, too fine grained to snapshot or check the budget on
+FINE_PHASES = ['date_parse']
+BUDGET_ACTIONS = ['stream', 'fail']
+TOP_SITES = 10
+MB = 1024.0 * 1024.0
+
+_lock = threading.Lock()
+_local = threading.local()
+_totals = {}
+_calls = {}
+_counts = {}
+_peaks = {}
+_memory = {'profile': False, 'budget': None, 'action': 'stream', 'low_memory': False, 'top_sites': [],
+           'snapshot_size': 0}
+
+class phase(object):
+    '''context manager timing the named phase, pausing the enclosing phase while it runs'''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = get_stack()
+        if self.name not in FINE_PHASES:
+            check_budget(self.name)
+        now = time.time()
+        if stack:
+            add_time(stack[-1][0], now - stack[-1][1], 0)
+        if _memory['profile']:
+            if stack:
+                stack[-1][2] = max(stack[-1][2], tracemalloc.get_traced_memory()[1])
+            reset_peak()
+        stack.append([self.name, now, 0])
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        stack = get_stack()
+        now = time.time()
+        name, start, peak = stack.pop()
+        add_time(name, now - start, 1)
+        if _memory['profile']:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            add_peak(name, peak)
+            if name not in FINE_PHASES:
+                snapshot_sites()
+            reset_peak()
+            if stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+        if stack:
+            stack[-1][1] = time.time()
+        if exc_type is None and name not in FINE_PHASES:
+            check_budget(name)
+        return False
+
+def timed(name):
+    '''decorator timing every call of the function under the named phase'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_stack():
+    '''returns the phase stack of the current thread'''
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def add_time(name, seconds, calls):
+    '''adds the elapsed seconds & calls to the phase totals'''
+    with _lock:
+        _totals[name] = _totals.get(name, 0.0) + seconds
+        _calls[name] = _calls.get(name, 0) + calls
+
+def add_peak(name, peak):
+    '''keeps the highest traced memory peak of the phase'''
+    with _lock:
+        _peaks[name] = max(_peaks.get(name, 0), peak)
+
+def count_documents(object_type, count):
+    '''adds to the document count for the object type'''
+    with _lock:
+        _counts[object_type] = _counts.get(object_type, 0) + count
+
+def configure_memory(ctx=None):
+    '''enables memory profiling & the memory budget from the context, falling back to the environment'''
+    ctx = ctx or {}
+    profile = ctx.get('memory_profile', os.environ.get('REPORT_MEMORY_PROFILE', False))
+    budget = ctx.get('memory_budget_mb', os.environ.get('REPORT_MEMORY_BUDGET_MB', None))
+    action = ctx.get('memory_budget_action', os.environ.get('REPORT_MEMORY_BUDGET_ACTION', 'stream'))
+    if action not in BUDGET_ACTIONS:
+        raise Exception('invalid memory_budget_action: {}, expected one of {}'.format(action, BUDGET_ACTIONS))
+    _memory['profile'] = str(profile).lower() in ('true', '1', 'yes')
+    _memory['budget'] = float(budget) * MB if budget not in (None, '', False) else None
+    _memory['action'] = action
+    if _memory['profile'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if _memory['profile'] or _memory['budget']:
+        budget_str = 'none' if _memory['budget'] is None else '{:.0f} MB ({})'.format(_memory['budget'] / MB, action)
+        print('memory profiling: {}, budget: {}'.format(_memory['profile'], budget_str))
+
+def low_memory():
+    '''returns True once the memory budget has been exceeded with the stream action'''
+    return _memory['low_memory']
+
+def get_rss():
+    '''returns the resident memory of the process in bytes'''
+    try:
+        with open('/proc/self/statm', 'r') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def check_budget(name):
+    '''fails, or switches to the low memory code paths, if the process is over the memory budget'''
+    if _memory['budget'] is None or _memory['low_memory']:
+        return
+    rss = get_rss()
+    if rss <= _memory['budget']:
+        return
+    message = 'memory budget of {:.0f} MB exceeded at {}: {:.1f} MB'.format(_memory['budget'] / MB, name, rss / MB)
+    if _memory['action'] == 'fail':
+        raise Exception(message)
+    print('{}, switching to low memory mode'.format(message))
+    _memory['low_memory'] = True
+
+def reset_peak():
+    '''resets the traced peak, if supported by this python'''
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+def snapshot_sites():
+    '''stores the top allocation sites if more memory is held than at any previous snapshot'''
+    size = tracemalloc.get_traced_memory()[0]
+    if size <= _memory['snapshot_size']:
+        return
+    stats = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    sites = []
+    for stat in stats.statistics('lineno')[:TOP_SITES]:
+        frame = stat.traceback[0]
+        sites.append({'site': '{}:{}'.format(frame.filename, frame.lineno), 'mb': round(stat.size / MB, 3),
+                      'count': stat.count})
+    with _lock:
+        _memory['snapshot_size'] = size
+        _memory['top_sites'] = sites
+
+def reset():
+    '''clears the accumulated timing, document counts & memory peaks. the low memory switch is kept'''
+    with _lock:
+        _totals.clear()
+        _calls.clear()
+        _counts.clear()
+        _peaks.clear()
+        _memory['top_sites'] = []
+        _memory['snapshot_size'] = 0
+
+def get_report():
+    '''returns the timing (seconds by phase & total) and document counts, as stored in the product met.json, plus
+    the memory peaks (MB by phase) & top allocation sites if memory is profiled or budgeted'''
+    with _lock:
+        timing = dict((name, round(seconds, 3)) for name, seconds in _totals.items())
+        timing['total'] = round(sum(_totals.values()), 3)
+        report = {'timing': timing, 'document_counts': dict(_counts)}
+        if _memory['profile'] or _memory['budget']:
+            report['memory'] = {'peak_mb': dict((name, round(peak / MB, 3)) for name, peak in _peaks.items()),
+                                'rss_mb': round(get_rss() / MB, 1), 'low_memory': _memory['low_memory'],
+                                'top_allocations': list(_memory['top_sites'])}
+        return report
+
+def log_report(label):
+    '''prints the timing breakdown, document counts & memory peaks'''
+    with _lock:
+        totals = dict(_totals)
+        calls = dict(_calls)
+        counts = dict(_counts)
+        peaks = dict(_peaks)
+        top_sites = list(_memory['top_sites'])
+    total = sum(totals.values())
+    print('timing for {}: {:.3f}s'.format(label, total))
+    names = [name for name in PHASES if name in totals] + sorted(set(totals.keys()).difference(PHASES))
+    for name in names:
+        percent = 100.0 * totals[name] / total if total else 0.0
+        peak = '{:>9.1f} MB peak'.format(peaks[name] / MB) if name in peaks else ''
+        print('    {:<12} {:>10.3f}s {:>6.1f}% {:>9} calls {}'.format(name, totals[name], percent,
+                                                                    calls.get(name, 0), peak).rstrip())
+    for object_type in sorted(counts.keys()):
+        print('    {:<12} {:>10} docs'.format(object_type, counts[object_type]))
+    if top_sites:
+        print('top allocation sites:')
+        for site in top_sites:
+            print('    {:>9.1f} MB {:>9} blocks  {}'.format(site['mb'], site['count'], site['site']))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+'''
+Builds the inverted SLC index used to determine missing SLCs & acquisitions for the Standard Product Reports
+'''
+
+def build_slc_index(acq_list_dct, localized_slcs, conversion_dict=False):
+    '''builds the index for a track from a dict of acquisition-lists (keyed by hash) and the localized slc ids.
+    if the acquisition-lists enumerate acquisition ids, the conversion dict maps them to slc ids. Returns a dict of:
+        referenced: set of all slc ids enumerated by the acquisition-lists
+        scene_to_acq_lists: dict of slc id to the list of acquisition-list hashes enumerating it
+        missing: set of referenced slc ids that have not been localized
+        missing_by_hash: dict of acquisition-list hash to its missing slc ids, in scene order'''
+    scene_to_acq_lists = {}
+    for id_hash, acq_list in acq_list_dct.items():
+        for slc_id in get_all_scenes(acq_list, conversion_dict):
+            scene_to_acq_lists.setdefault(slc_id, []).append(id_hash)
+    referenced = set(scene_to_acq_lists.keys())
+    missing = referenced.difference(localized_slcs)
+    missing_by_hash = {}
+    for slc_id in missing:
+        for id_hash in scene_to_acq_lists.get(slc_id):
+            missing_by_hash.setdefault(id_hash, set()).add(slc_id)
+    for id_hash, missing_slcs in missing_by_hash.items():
+        scenes = get_all_scenes(acq_list_dct.get(id_hash), conversion_dict)
+        missing_by_hash[id_hash] = [slc_id for slc_id in scenes if slc_id in missing_slcs]
+    return {'referenced': referenced, 'scene_to_acq_lists': scene_to_acq_lists, 'missing': missing,
+            'missing_by_hash': missing_by_hash}
+
+def get_missing_slcs(slc_index, id_hash):
+    '''returns the list of missing slc ids for the acquisition-list hash'''
+    return slc_index.get('missing_by_hash').get(id_hash, [])
+
+def get_missing_acqs(slc_index, id_hash, acq_map_dct):
+    '''returns the list of acquisition ids for the missing slcs of the acquisition-list hash, where the acq map
+    dict stores acquisitions by their slc id'''
+    missing_acqs = []
+    for slc_id in get_missing_slcs(slc_index, id_hash):
+        missing_acq = acq_map_dct.get(slc_id, False)
+        if missing_acq:
+            missing_acqs.append(missing_acq.get('_id'))
+    return missing_acqs
+
+def get_all_scenes(acq_list, conversion_dict=False):
+    '''returns the master/reference + slave/secondary scenes of the acquisition-list, de-duplicated in order'''
+    met = acq_list.get('_source', {}).get('metadata', {})
+    scenes = (met.get('master_scenes') or met.get('reference_scenes') or []) + \
+             (met.get('slave_scenes') or met.get('secondary_scenes') or [])
+    if conversion_dict:
+        scenes = [conversion_dict.get(x, 'slc_id_not_found') for x in scenes]
+    unique_scenes = []
+    seen = set()
+    for slc_id in scenes:
+        if slc_id not in seen:
+            seen.add(slc_id)
+            unique_scenes.append(slc_id)
+    return unique_scenes
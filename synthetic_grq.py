@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+'''
+Generates synthetic GRQ hits (acq-lists, ifg-cfgs, GUNWs, SLCs, acquisitions, audit-trail & aoi_track products)
+over a single AOI & track, for benchmarking the report generators without a live GRQ
+'''
+from __future__ import print_function
+import os
+import json
+import gzip
+import hashlib
+import argparse
+import datetime
+
+# synthetic index name for each object type, matching the grq_* patterns of the report generators
+INDEX_NAMES = {'aoi': 'grq_v1.0_area_of_interest', 'audit_trail': 'grq_v2.0_s1-gunw-acqlist-audit_trail',
+               'ifg': 'grq_v2.0.3_s1-gunw', 'acq-list': 'grq_v2.0_s1-gunw-acq-list',
+               'ifg-cfg': 'grq_v2.0_s1-gunw-ifg-cfg', 'slc': 'grq_v1.1_s1-iw_slc',
+               'acq': 'grq_v2.0_acquisition-s1-iw_slc', 'aoi_track': 'grq_v2.0_s1-gunw-aoi_track'}
+DEFAULTS = {'track': 64, 'neighbors': 3, 'frames': 3, 'slc_ratio': 0.98, 'ifg_cfg_ratio': 0.97, 'ifg_ratio': 0.93,
+            'aoi_id': 'AOI_synthetic_benchmark', 'start': '2014-10-01T00:00:00'}
+REPEAT_DAYS = 12
+CREATION_TIMESTAMP = '2020-01-01T00:00:00.000000Z'
+LOCATION = {'type': 'polygon', 'coordinates': [[[-155.0, 19.0], [-154.0, 19.0], [-154.0, 21.0], [-155.0, 21.0],
+                                                [-155.0, 19.0]]]}
+
+def gen_fixtures(count, **kwargs):
+    '''returns a dict of object type to a generator of hits, for count acquisition-lists'''
+    opts = get_options(kwargs)
+    return {'aoi': iter([gen_aoi(count, opts)]), 'acq-list': gen_acq_lists(count, opts),
+            'ifg-cfg': gen_ifg_cfgs(count, opts), 'ifg': gen_ifgs(count, opts), 'slc': gen_slcs(count, opts),
+            'acq': gen_acqs(count, opts), 'audit_trail': gen_audit_trail(count, opts),
+            'aoi_track': gen_aoi_tracks(count, opts)}
+
+def get_options(kwargs):
+    '''fills in the default generator options'''
+    opts = dict(DEFAULTS)
+    opts.update(dict((key, val) for key, val in kwargs.items() if val is not None))
+    opts['start_dt'] = datetime.datetime.strptime(opts['start'], '%Y-%m-%dT%H:%M:%S')
+    return opts
+
+def gen_aoi(count, opts):
+    '''returns the AOI covering all generated products'''
+    start = opts['start_dt']
+    end = get_date(start, count // opts['neighbors'] + opts['neighbors'] + 1)
+    obj = hit(INDEX_NAMES['aoi'], opts['aoi_id'], start, end, {'dataset_type': 'area_of_interest'},
+              dataset='area_of_interest')
+    obj['_source']['dataset_type'] = 'area_of_interest'
+    return obj
+
+def gen_acq_lists(count, opts):
+    '''yields count acquisition-lists, each date paired with its next n neighbors'''
+    for i in range(count):
+        yield pair_hit('acq-list', 'S1-GUNW-acq-list', i, opts)
+
+def gen_ifg_cfgs(count, opts):
+    '''yields the ifg-cfgs for the fraction (ifg_cfg_ratio) of acquisition-lists that have been configured'''
+    for i in range(count):
+        if fraction(i, 'ifg-cfg') < opts['ifg_cfg_ratio']:
+            yield pair_hit('ifg-cfg', 'S1-GUNW-ifg-cfg', i, opts)
+
+def gen_ifgs(count, opts):
+    '''yields the GUNWs for the fraction (ifg_ratio) of acquisition-lists that have been processed'''
+    for i in range(count):
+        if fraction(i, 'ifg-cfg') < opts['ifg_cfg_ratio'] and fraction(i, 'ifg') < opts['ifg_ratio']:
+            yield pair_hit('ifg', 'S1-GUNW-A-R-{:03d}-tops'.format(opts['track']), i, opts)
+
+def gen_slcs(count, opts):
+    '''yields the localized SLCs, the fraction (slc_ratio) of all enumerated SLCs'''
+    for date_idx, frame in iter_scenes(count, opts):
+        slc_id = gen_slc_id(date_idx, frame, opts)
+        if fraction(date_idx * opts['frames'] + frame, 'slc') < opts['slc_ratio']:
+            start = get_date(opts['start_dt'], date_idx)
+            yield hit(INDEX_NAMES['slc'], slc_id, start, start, {'trackNumber': opts['track']},
+                      dataset='S1-IW_SLC')
+
+def gen_acqs(count, opts):
+    '''yields the acquisitions of all enumerated SLCs'''
+    for date_idx, frame in iter_scenes(count, opts):
+        slc_id = gen_slc_id(date_idx, frame, opts)
+        start = get_date(opts['start_dt'], date_idx)
+        met = {'track_number': opts['track'], 'title': slc_id, 'identifier': slc_id, 'processing_version': '002.91'}
+        yield hit(INDEX_NAMES['acq'], 'acquisition-{}-esa_scihub'.format(slc_id), start, start, met,
+                  dataset='acquisition-S1-IW_SLC')
+
+def gen_audit_trail(count, opts):
+    '''yields an audit-trail product for every acquisition-list'''
+    for i in range(count):
+        obj = pair_hit('audit_trail', 'S1-GUNW-acqlist-audit_trail', i, opts)
+        met = obj['_source']['metadata']
+        met.update({'aoi': opts['aoi_id'], 'failure_reason': '', 'comment': 'enumerated', 'context': {},
+                    'union_geojson': {}})
+        yield obj
+
+def gen_aoi_tracks(count, opts):
+    '''yields the aoi_track products, one per reference date, listing that date's GUNWs'''
+    neighbors = opts['neighbors']
+    for first in range(0, count, neighbors):
+        gunw_ids = []
+        for i in range(first, min(first + neighbors, count)):
+            if fraction(i, 'ifg-cfg') < opts['ifg_cfg_ratio'] and fraction(i, 'ifg') < opts['ifg_ratio']:
+                gunw_ids.append(pair_hit('ifg', 'S1-GUNW-A-R-{:03d}-tops'.format(opts['track']), i, opts)['_id'])
+        start = get_date(opts['start_dt'], first // neighbors)
+        met = {'aoi': opts['aoi_id'], 'track_number': opts['track'], 's1-gunw-ids': gunw_ids}
+        aoi_track_id = 'S1-GUNW-AOI_TRACK-{}-TN{}-{}'.format(opts['aoi_id'], opts['track'], first // neighbors)
+        yield hit(INDEX_NAMES['aoi_track'], aoi_track_id, start, start, met, dataset='S1-GUNW-aoi_track')
+
+def pair_hit(object_type, prefix, i, opts):
+    '''builds the hit for the ith date pair of the object type'''
+    secondary_idx, reference_idx = get_pair(i, opts)
+    start = opts['start_dt']
+    secondary = get_date(start, secondary_idx)
+    reference = get_date(start, reference_idx)
+    master_scenes = [gen_slc_id(reference_idx, frame, opts) for frame in range(opts['frames'])]
+    slave_scenes = [gen_slc_id(secondary_idx, frame, opts) for frame in range(opts['frames'])]
+    met = {'track_number': opts['track'], 'master_scenes': master_scenes, 'slave_scenes': slave_scenes,
+           'full_id_hash': gen_hash(master_scenes, slave_scenes), 'reference_date': format_time(reference),
+           'secondary_date': format_time(secondary)}
+    obj_id = '{}-{}_{}-{:06d}'.format(prefix, reference.strftime('%Y%m%dT%H%M%S'),
+                                       secondary.strftime('%Y%m%dT%H%M%S'), i)
+    return hit(INDEX_NAMES[object_type], obj_id, secondary, reference, met, dataset=object_type)
+
+def hit(index, obj_id, starttime, endtime, met, dataset):
+    '''builds an elasticsearch hit'''
+    source = {'id': obj_id, 'dataset': dataset, 'starttime': format_time(starttime), 'endtime': format_time(endtime),
+              'creation_timestamp': CREATION_TIMESTAMP, 'location': LOCATION, 'metadata': met}
+    return {'_index': index, '_type': dataset, '_id': obj_id, '_score': 1.0, '_source': source}
+
+def format_time(dt):
+    '''formats the datetime as GRQ stores it'''
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def get_pair(i, opts):
+    '''returns the (secondary, reference) date indices of the ith date pair'''
+    neighbors = opts['neighbors']
+    secondary_idx = i // neighbors
+    return secondary_idx, secondary_idx + i % neighbors + 1
+
+def iter_scenes(count, opts):
+    '''yields (date index, frame) for every SLC enumerated by the count acquisition-lists'''
+    if count < 1:
+        return
+    last_date = get_pair(count - 1, opts)[1]
+    for date_idx in range(last_date + 1):
+        for frame in range(opts['frames']):
+            yield date_idx, frame
+
+def gen_slc_id(date_idx, frame, opts):
+    '''returns a sentinel-1 style slc id for the date index & frame'''
+    start = get_date(opts['start_dt'], date_idx) + datetime.timedelta(seconds=frame * 25)
+    end = start + datetime.timedelta(seconds=27)
+    orbit = 1000 + date_idx * 175
+    return 'S1A_IW_SLC__1SDV_{}_{}_{:06d}_{:06X}_{:04X}'.format(start.strftime('%Y%m%dT%H%M%S'),
+                                                             end.strftime('%Y%m%dT%H%M%S'), orbit,
+                                                             (orbit * 7 + frame) % 0xFFFFFF, frame)
+
+def gen_hash(master_slcs, slave_slcs):
+    '''copy of hash used in the enumerator'''
+    id_str = json.dumps([' '.join(sorted(master_slcs)), ' '.join(sorted(slave_slcs))])
+    return hashlib.md5(id_str.encode("utf8")).hexdigest()
+
+def fraction(i, salt):
+    '''deterministic pseudo random fraction in [0, 1) for the index'''
+    digest = hashlib.md5('{}-{}'.format(salt, i).encode('utf8')).hexdigest()
+    return int(digest[:8], 16) / float(0x100000000)
+
+def get_date(start, date_idx):
+    '''returns the acquisition datetime of the date index on the repeat cycle'''
+    return start + datetime.timedelta(days=REPEAT_DAYS * date_idx)
+
+def write_fixtures(count, outdir, compress=True, **kwargs):
+    '''writes each object type as json lines (one hit per line) into outdir, named by synthetic index'''
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    written = {}
+    for object_type, hits in gen_fixtures(count, **kwargs).items():
+        filename = '{}.jsonl'.format(INDEX_NAMES[object_type])
+        if compress:
+            filename += '.gz'
+        path = os.path.join(outdir, filename)
+        fout = gzip.open(path, 'wt') if compress else open(path, 'w')
+        with fout:
+            total = 0
+            for obj in hits:
+                fout.write(json.dumps(obj) + '\n')
+                total += 1
+        written[path] = total
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='writes synthetic GRQ fixtures as (gzipped) json lines')
+    parser.add_argument('--count', type=int, default=1000, help='number of acquisition-lists')
+    parser.add_argument('--outdir', default='grq_fixtures')
+    parser.add_argument('--track', type=int)
+    parser.add_argument('--neighbors', type=int, help='number of secondary dates paired with each date')
+    parser.add_argument('--frames', type=int, help='number of SLC frames per date')
+    parser.add_argument('--aoi_id')
+    parser.add_argument('--no_compress', action='store_true')
+    args = parser.parse_args()
+    fixture_paths = write_fixtures(args.count, args.outdir, compress=not args.no_compress, track=args.track,
+                                   neighbors=args.neighbors, frames=args.frames, aoi_id=args.aoi_id)
+    for fixture_path in sorted(fixture_paths.keys()):
+        print('{}: {} hits'.format(fixture_path, fixture_paths[fixture_path]))
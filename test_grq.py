@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+'''
+Checks the GRQ fetch paths against an in-process grq_standin serving synthetic fixtures. Run with pytest
+'''
+import threading
+import pytest
+import synthetic_grq
+import grq_standin
+import grq
+import audit_prefetch
+
+SCALE = 300
+
+@pytest.fixture(scope='module')
+def standin():
+    '''serves the synthetic fixtures over http on a free port, with the GRQ url pointed at it'''
+    indices = {}
+    for object_type, hits in synthetic_grq.gen_fixtures(SCALE).items():
+        indices[synthetic_grq.INDEX_NAMES[object_type]] = list(hits)
+    server = grq_standin.grq_standin(('localhost', 0), indices, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    grq.set_grq_url('http://localhost:{}'.format(server.server_address[1]))
+    yield server
+    grq.set_grq_url(None)
+    server.shutdown()
+    server.server_close()
+
+def test_scroll_pages(standin):
+    es_query = {"query":{"match_all":{}},"size":64}
+    pages = list(grq.scroll_pages(grq.get_search_url(audit_prefetch.AUDIT_TRAIL_IDX), es_query))
+    assert len(pages) > 1
+    ids = [obj['_id'] for page in pages for obj in page]
+    assert len(ids) == len(set(ids)) == len(standin.indices[synthetic_grq.INDEX_NAMES['audit_trail']])
+    assert not standin.scrolls
+
+def test_scroll_pages_abandoned(standin):
+    pages = grq.scroll_pages(grq.get_search_url(audit_prefetch.AUDIT_TRAIL_IDX), {"query":{"match_all":{}},"size":16})
+    assert len(next(pages)) == 16
+    assert standin.scrolls
+    pages.close()
+    assert not standin.scrolls
+
+@pytest.mark.parametrize('sort', [None, [{"endtime": {"order": "desc"}}]])
+def test_query_es_windowed(standin, sort):
+    aoi = standin.indices[synthetic_grq.INDEX_NAMES['aoi']][0]['_source']
+    grq_url = grq.get_search_url(synthetic_grq.INDEX_NAMES['acq-list'])
+    es_query = {"query":{"match_all":{}},"from":0,"size":50}
+    if sort:
+        es_query['sort'] = sort
+    expected = grq.fetch_all(grq_url, dict(es_query))
+    grq.set_fetch_window('month')
+    try:
+        bounds = grq.get_month_bounds(aoi['starttime'], aoi['endtime'])
+        results = grq.query_es_windowed(grq_url, dict(es_query), aoi['starttime'], aoi['endtime'])
+    finally:
+        grq.set_fetch_window(None)
+    assert len(bounds) > 1
+    # acquisition-lists span 12 - 36 days, so documents of neighbouring windows overlap in time
+    assert any(obj['_source']['starttime'] < bounds[0] < obj['_source']['endtime'] for obj in expected)
+    assert sorted(obj['_id'] for obj in results) == sorted(obj['_id'] for obj in expected)
+    if sort:
+        endtimes = [obj['_source']['endtime'] for obj in results]
+        assert endtimes == sorted(endtimes, reverse=True)
+    else:
+        assert [obj['_id'] for obj in results] == sorted(obj['_id'] for obj in expected)
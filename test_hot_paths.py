@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+Checks the optimized hot paths of the report generators against the straightforward implementations they replaced,
+over synthetic GRQ fixtures. Run with pytest
+'''
+import copy
+import dateutil.parser
+import pytest
+import synthetic_grq
+import slc_index
+import enumeration as enum_compare
+import hash_order
+import product_store
+import gen_ops_report
+import benchmark
+
+SCALE = 600
+
+@pytest.fixture(scope='module')
+def fixtures():
+    '''synthetic fixtures as lists, with a newer duplicate of every 10th acquisition-list'''
+    fixtures = dict((object_type, list(hits)) for object_type, hits in synthetic_grq.gen_fixtures(SCALE).items())
+    for acq_list in fixtures['acq-list'][::10]:
+        duplicate = copy.deepcopy(acq_list)
+        duplicate['_id'] += '-dup'
+        duplicate['_source']['creation_timestamp'] = '2021-01-01T00:00:00.000000Z'
+        fixtures['acq-list'].append(duplicate)
+    return fixtures
+
+def reference_store_by_hash(obj_list):
+    '''the list lookup store_by_hash'''
+    result_dict = {}
+    for obj in obj_list:
+        full_id_hash = gen_ops_report.get_hash(obj)
+        if full_id_hash in list(result_dict.keys()):
+            result_dict[full_id_hash] = gen_ops_report.get_most_recent(obj, result_dict.get(full_id_hash))
+        else:
+            result_dict[full_id_hash] = obj
+    return result_dict
+
+def reference_missing_slcs(slc_dct, acq_lists):
+    '''the missing slcs of the acquisition-lists, scanned per acquisition-list'''
+    missing = []
+    for acq_list in acq_lists:
+        met = acq_list.get('_source', {}).get('metadata', {})
+        for slc_id in met.get('master_scenes', []) + met.get('slave_scenes', []):
+            if slc_dct.get(slc_id, False) is False:
+                missing.append(slc_id)
+    return set(missing)
+
+def reference_sort_into_hash_list(obj_dict):
+    '''the hashes sorted by the dateutil parsed endtimes'''
+    return sorted(list(obj_dict.keys()),
+                  key=lambda x: dateutil.parser.parse(obj_dict.get(x).get('_source', {}).get('endtime')),
+                  reverse=True)
+
+def test_store_by_hash(fixtures):
+    result = gen_ops_report.store_by_hash(fixtures['acq-list'])
+    expected = reference_store_by_hash(fixtures['acq-list'])
+    assert list(result.keys()) == list(expected.keys())
+    assert all(result[key] is expected[key] for key in expected)
+    assert sum(obj['_id'].endswith('-dup') for obj in result.values()) == len(fixtures['acq-list'][:SCALE:10])
+
+def test_build_slc_index(fixtures):
+    acq_list_dct = gen_ops_report.store_by_hash(fixtures['acq-list'])
+    slc_dct = gen_ops_report.store_by_id(fixtures['slc'])
+    slc_idx = slc_index.build_slc_index(acq_list_dct, slc_dct)
+    assert slc_idx['missing'] == reference_missing_slcs(slc_dct, acq_list_dct.values())
+    assert slc_idx['missing']
+    for id_hash, acq_list in acq_list_dct.items():
+        scenes = slc_index.get_all_scenes(acq_list)
+        assert slc_index.get_missing_slcs(slc_idx, id_hash) == [slc_id for slc_id in scenes if slc_id not in slc_dct]
+
+def test_product_store_slc_index(fixtures, tmp_path):
+    product_store.configure({'product_store': str(tmp_path / 'products.db')})
+    try:
+        aoi_id = synthetic_grq.DEFAULTS['aoi_id']
+        track = synthetic_grq.DEFAULTS['track']
+        acq_list_dct = gen_ops_report.store_by_hash(fixtures['acq-list'])
+        expected = slc_index.build_slc_index(acq_list_dct, gen_ops_report.store_by_id(fixtures['slc']))
+        slc_idx = product_store.sync_track(aoi_id, track, gen_ops_report.get_hash, fixtures['slc'],
+                                           list(acq_list_dct.values()))
+        for key in ('referenced', 'missing', 'missing_by_hash'):
+            assert slc_idx[key] == expected[key]
+        assert dict((slc_id, sorted(hashes)) for slc_id, hashes in slc_idx['scene_to_acq_lists'].items()) == \
+            dict((slc_id, sorted(hashes)) for slc_id, hashes in expected['scene_to_acq_lists'].items())
+        assert product_store.sync_slcs(aoi_id, track, fixtures['slc']) == (0, 0)
+        assert product_store.sync_acq_lists(aoi_id, track, fixtures['acq-list'], gen_ops_report.get_hash)[1] == 0
+        assert product_store.build_slc_index(aoi_id, track)['missing'] == expected['missing']
+    finally:
+        product_store.close()
+
+def test_sort_into_hash_list(fixtures):
+    acq_list_dct = gen_ops_report.store_by_hash(fixtures['acq-list'])
+    assert hash_order.sort_by_endtime(acq_list_dct) == reference_sort_into_hash_list(acq_list_dct)
+
+def test_merge_date_pairs():
+    input_pairs = benchmark.gen_test_enumeration(SCALE)
+    hysds_pairs = benchmark.gen_test_enumeration(SCALE, offset=SCALE // 6)
+    expected = [(date_pair, (date_pair in input_pairs, date_pair in hysds_pairs))
+                for date_pair in sorted(set(input_pairs + hysds_pairs))]
+    assert list(enum_compare.merge_date_pairs([input_pairs, hysds_pairs])) == expected
+    assert list(enum_compare.merge_date_pairs([input_pairs, hysds_pairs], reverse=True)) == expected[::-1]
+
+def test_load_enumeration():
+    assert enum_compare.load_enumeration('180512-180430, 20141001_20141013') == ['20141013-20141001',
+                                                                                '20180512-20180430']